@@ -1,15 +1,35 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, flash, session, send_file
+from flask import Flask, request, jsonify, render_template, redirect, url_for, flash, session, send_file, g, has_request_context, make_response, Response, stream_with_context
 from flask_cors import CORS
 import sqlite3
 import os
+import sys
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
 import json
 import re
+import itertools
+import math
+import bisect
 import base64
-from io import BytesIO
+import codecs
+import csv
+import zlib
+import hashlib
+import hmac
+import ipaddress
+import mimetypes
+import tempfile
+from io import BytesIO, StringIO
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
+from collections import OrderedDict, deque
 
 # กำหนดสาขา 11 สาขา
 BRANCHES = {
@@ -30,27 +50,1066 @@ app = Flask(__name__)
 app.secret_key = 'jms_secret_key_2025'
 CORS(app)
 
+# ==================== logging ====================
+
+# ระดับ log กำหนดด้วย LOG_LEVEL (ค่าเริ่มต้น INFO - ข้อความ DEBUG ไม่ถูกสร้างเลยใน production)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# จำนวนข้อความที่รอเขียนได้สูงสุด ถ้าเต็มจะทิ้งข้อความใหม่แทนการให้ request รอ
+LOG_QUEUE_SIZE = 10000
+
+class AsyncLogHandler(logging.handlers.QueueHandler):
+    """ส่ง log เข้า queue แล้วให้ thread แยกเขียนลง stdout - request ไม่ต้องรอ I/O ของ log pipe
+    
+    queue เต็มจะทิ้งข้อความ (นับใน dropped) และเริ่ม thread เขียนใหม่เมื่อถูก fork (เช่น gunicorn ที่ใช้ --preload)
+    """
+    
+    def __init__(self, target, maxsize=LOG_QUEUE_SIZE):
+        super().__init__(queue.Queue(maxsize=maxsize))
+        self.target = target
+        self.dropped = 0
+        self._pid = None
+        self._listener = None
+        self._start_lock = threading.Lock()
+    
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # thread เขียนของ process แม่ไม่ตามมาหลัง fork - เริ่ม queue และ thread ใหม่ใน process นี้
+            self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            self._listener = logging.handlers.QueueListener(self.queue, self.target)
+            self._listener.start()
+            self._pid = os.getpid()
+    
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+    
+    def flush(self):
+        """รอให้ข้อความที่ค้างใน queue ถูกเขียนจนหมด (เรียกก่อน process จบ)"""
+        if self._pid == os.getpid() and self._listener is not None and self._listener._thread is not None:
+            self.queue.join()
+        self.target.flush()
+
+def setup_logging():
+    """ตั้งค่า logger 'daex' ของระบบ: ระดับจาก LOG_LEVEL และเขียนผ่าน AsyncLogHandler"""
+    daex_logger = logging.getLogger('daex')
+    if not daex_logger.handlers:
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s [%(process)d] %(levelname)s: %(message)s'))
+        daex_logger.addHandler(AsyncLogHandler(stream_handler))
+        daex_logger.setLevel(LOG_LEVEL)
+        daex_logger.propagate = False
+    return daex_logger
+
+logger = setup_logging()
+
+# log ที่เกิดต่อแถวข้อมูลจะเขียนครั้งแรกและทุกๆ กี่ครั้ง
+LOG_SAMPLE_EVERY = 100
+_log_sample_counts = {}
+
+def log_sampled(key, every, level, msg, *args):
+    """log ข้อความที่เกิดซ้ำต่อแถว/ต่อรายการ เฉพาะครั้งแรกและทุกๆ every ครั้ง (นับแยกตาม key ต่อ process)"""
+    if not logger.isEnabledFor(level):
+        return
+    count = _log_sample_counts.get(key, 0) + 1
+    _log_sample_counts[key] = count
+    if count == 1 or count % every == 0:
+        logger.log(level, msg + ' (ครั้งที่ %d)', *args, count)
+
+# ==================== metrics (รูปแบบ Prometheus) ====================
+
+# แต่ละ process เขียนค่าของตัวเองลงไฟล์นี้เป็นระยะ แล้ว /metrics รวมค่าจากทุก worker
+METRICS_DB = os.path.join('database', 'metrics.db')
+METRICS_FLUSH_SECONDS = 5
+# ถ้าตั้งค่าไว้ /metrics ต้องส่ง header Authorization: Bearer <token> - ถ้าไม่ได้ตั้ง รับเฉพาะ request จาก loopback
+# (ถ้ามี reverse proxy ในเครื่องเดียวกัน ทุก request จะมาจาก loopback - ให้ตั้ง METRICS_TOKEN)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# METRICS_PUBLIC=1 เปิด /metrics ให้ทุกคนโดยไม่ต้องใช้ token (เช่น เครือข่ายภายในที่มี firewall แล้ว)
+METRICS_PUBLIC = os.environ.get('METRICS_PUBLIC') == '1'
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# ชนิดและคำอธิบายของ metric ที่ระบบส่งออก
+METRIC_DEFINITIONS = {
+    'daex_http_requests_total': ('counter', 'จำนวน request แยกตาม method, route และ status'),
+    'daex_http_request_duration_seconds': ('histogram', 'เวลาตอบสนองของ request แยกตาม method, route และ status'),
+    'daex_db_connections_opened_total': ('counter', 'จำนวนครั้งที่เปิดการเชื่อมต่อ SQLite แยกตามไฟล์'),
+    'daex_response_cache_requests_total': ('counter', 'การอ่าน response cache แยกตาม endpoint และผล hit/miss'),
+    'daex_salary_rows_ingested_total': ('counter', 'จำนวนแถวเงินเดือนที่ประมวลผลแล้ว แยกตามผล'),
+    'daex_media_bytes_served_total': ('counter', 'จำนวน byte ของไฟล์ที่ส่งจาก /media แยกตามขนาดรูป'),
+    'daex_salary_upload_jobs': ('gauge', 'จำนวนงานอัพโหลดเงินเดือนที่รอและกำลังประมวลผล'),
+    'daex_process_resident_memory_bytes': ('gauge', 'หน่วยความจำ RSS ของแต่ละ process'),
+}
+
+def process_rss_bytes():
+    """หน่วยความจำ RSS ของ process นี้ (None ถ้าระบบไม่มี /proc)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class MetricsRegistry:
+    """counter/histogram/gauge ของ process นี้ในหน่วยความจำ เขียนลง METRICS_DB ทุก METRICS_FLUSH_SECONDS
+    
+    แต่ละ process เขียนค่าสะสมของตัวเองเป็นแถวแยกตาม process_key (ไม่ซ้ำแม้ pid ถูกใช้ซ้ำ) /metrics จึงรวมด้วย SUM ได้
+    ตอน scrape แถว counter ของ process ที่จบไปแล้วจะถูกรวมเข้าแถว 'retired' เพื่อไม่ให้ค่าลดลงและตารางไม่โตไม่สิ้นสุด
+    """
+    
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.pid = None
+        self._check_process()
+    
+    def _check_process(self):
+        # process ที่ fork มา (เช่น gunicorn ที่ใช้ --preload) เริ่มนับใหม่ - ค่าที่ยังไม่เขียนเป็นของ process แม่
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.process_key = f'{self.pid}-{os.urandom(4).hex()}'
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.conn = None
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.dirty = set()
+        self.last_flush = time.monotonic()
+    
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+    
+    def inc(self, name, value=1, **labels):
+        self._check_process()
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            self.dirty.add(key)
+    
+    def observe(self, name, value, buckets=METRICS_LATENCY_BUCKETS, **labels):
+        self._check_process()
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [buckets, [0] * (len(buckets) + 1), 0.0, 0]
+            histogram[1][bisect.bisect_left(buckets, value)] += 1
+            histogram[2] += value
+            histogram[3] += 1
+            self.dirty.add(key)
+    
+    def set_gauge(self, name, value, **labels):
+        self._check_process()
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+            self.dirty.add(key)
+    
+    def _samples(self, key):
+        """แถว (kind, name, labels JSON, value) ของ metric หนึ่งตัว - histogram แตกเป็น _bucket (สะสม), _sum และ _count"""
+        name, labels = key
+        if key in self.counters:
+            return [('counter', name, json.dumps(labels), self.counters[key])]
+        if key in self.gauges:
+            return [('gauge', name, json.dumps(labels), self.gauges[key])]
+        buckets, counts, total, count = self.histograms[key]
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip((*buckets, '+Inf'), counts):
+            cumulative += bucket_count
+            samples.append(('counter', f'{name}_bucket', json.dumps(labels + (('le', str(bound)),)), cumulative))
+        samples.append(('counter', f'{name}_sum', json.dumps(labels), total))
+        samples.append(('counter', f'{name}_count', json.dumps(labels), count))
+        return samples
+    
+    def connection(self):
+        if self.conn is None:
+            conn = connect_db(self.db_path, timeout=2.0, check_same_thread=False, isolation_level=None)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS metric_samples (
+                    process_key TEXT NOT NULL,
+                    pid INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    labels TEXT NOT NULL,
+                    value REAL NOT NULL,
+                    PRIMARY KEY (process_key, name, labels)
+                )
+            ''')
+            self.conn = conn
+        return self.conn
+    
+    def flush(self, force=False):
+        """เขียนค่าที่เปลี่ยนตั้งแต่ครั้งก่อนลงไฟล์ (ไม่บ่อยกว่าทุก METRICS_FLUSH_SECONDS ยกเว้น force)"""
+        self._check_process()
+        if not force and time.monotonic() - self.last_flush < METRICS_FLUSH_SECONDS:
+            return
+        rss = process_rss_bytes()
+        if rss is not None:
+            self.set_gauge('daex_process_resident_memory_bytes', rss, pid=str(self.pid))
+        with self.lock:
+            keys = list(self.dirty)
+            rows = [(self.process_key, self.pid, *sample) for key in keys for sample in self._samples(key)]
+            self.dirty.clear()
+            self.last_flush = time.monotonic()
+        if not rows:
+            return
+        try:
+            with self.db_lock:
+                conn = self.connection()
+                conn.execute('BEGIN')
+                try:
+                    conn.executemany('''
+                        INSERT INTO metric_samples (process_key, pid, kind, name, labels, value) VALUES (?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (process_key, name, labels) DO UPDATE SET value = excluded.value
+                    ''', rows)
+                    conn.execute('COMMIT')
+                except sqlite3.Error:
+                    conn.execute('ROLLBACK')
+                    raise
+        except sqlite3.Error as e:
+            with self.lock:
+                self.dirty.update(keys)
+            logger.warning('⚠️ เขียน metrics ไม่สำเร็จ: %s', e)
+    
+    def retire_dead_processes(self, conn):
+        """รวม counter ของ process ที่จบแล้วเข้าแถว 'retired' และลบ gauge ของ process นั้น"""
+        pids = [row[0] for row in conn.execute("SELECT DISTINCT pid FROM metric_samples WHERE process_key != 'retired'")]
+        dead = [pid for pid in pids if not process_alive(pid)]
+        if not dead:
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for pid in dead:
+                conn.execute('''
+                    INSERT INTO metric_samples (process_key, pid, kind, name, labels, value)
+                    SELECT 'retired', 0, kind, name, labels, SUM(value) FROM metric_samples
+                    WHERE pid = ? AND kind = 'counter' AND process_key != 'retired'
+                    GROUP BY kind, name, labels
+                    ON CONFLICT (process_key, name, labels) DO UPDATE SET value = value + excluded.value
+                ''', (pid,))
+                conn.execute("DELETE FROM metric_samples WHERE pid = ? AND process_key != 'retired'", (pid,))
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def collect(self):
+        """ค่ารวมของทุก process: list ของ (kind, name, labels dict, value)"""
+        self.flush(force=True)
+        with self.db_lock:
+            conn = self.connection()
+            self.retire_dead_processes(conn)
+            rows = conn.execute('''
+                SELECT kind, name, labels, SUM(value) FROM metric_samples GROUP BY kind, name, labels
+            ''').fetchall()
+        return [(kind, name, dict(json.loads(labels)), value) for kind, name, labels, value in rows]
+
+metrics = MetricsRegistry(METRICS_DB)
+atexit.register(metrics.flush, force=True)
+
+def format_metric_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def format_metric_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels.items()
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+def render_prometheus_metrics(samples):
+    """แปลง (kind, name, labels, value) เป็นข้อความรูปแบบ Prometheus 0.0.4 พร้อม HELP/TYPE ต่อ metric"""
+    suffix_order = {'_bucket': 0, '_sum': 1, '_count': 2}
+    families = {}
+    for kind, name, labels, value in samples:
+        family, suffix = name, ''
+        for candidate in suffix_order:
+            base = name[:-len(candidate)]
+            if name.endswith(candidate) and METRIC_DEFINITIONS.get(base, ('',))[0] == 'histogram':
+                family, suffix = base, candidate
+                break
+        families.setdefault(family, []).append((suffix, labels, value))
+    
+    def sort_key(sample):
+        suffix, labels, value = sample
+        le = labels.get('le')
+        series = sorted((name, value) for name, value in labels.items() if name != 'le')
+        return series, suffix_order.get(suffix, 0), float(le) if le is not None else 0.0
+    
+    lines = []
+    for family in sorted(families):
+        kind, help_text = METRIC_DEFINITIONS.get(family, ('untyped', family))
+        lines.append(f'# HELP {family} {help_text}')
+        lines.append(f'# TYPE {family} {kind}')
+        for suffix, labels, value in sorted(families[family], key=sort_key):
+            lines.append(f'{family}{suffix}{format_metric_labels(labels)} {format_metric_value(value)}')
+    return '\n'.join(lines) + '\n'
+
 # สร้างโฟลเดอร์ database ถ้ายังไม่มี
 os.makedirs('database', exist_ok=True)
 
 def get_database_path():
-    """หาตำแหน่งไฟล์ฐานข้อมูลหลัก"""
+    """หาตำแหน่งไฟล์ฐานข้อมูลหลัก (ตั้ง DAEX_DB_PATH เพื่อใช้ไฟล์อื่น เช่น ฐานข้อมูลทดสอบ)"""
+    if os.environ.get('DAEX_DB_PATH'):
+        return os.environ['DAEX_DB_PATH']
     base_dir = os.path.dirname(os.path.abspath(__file__))
     db_path = os.path.join(base_dir, 'database', 'daex_system.db')
     if not os.path.exists(db_path):
         db_path = os.path.join(base_dir, 'daex_system.db')
     return db_path
 
+# ค่า PRAGMA ที่ตั้งทุกครั้งที่เปิดการเชื่อมต่อ (WAL ทำให้การอ่านไม่ต้องรอ transaction เขียนของการอัพโหลด)
+SQLITE_CACHE_SIZE_KB = 20000
+SQLITE_MMAP_SIZE = 128 * 1024 * 1024
+
+def apply_connection_pragmas(conn, timeout=30.0):
+    """ตั้งค่า WAL, synchronous, cache, mmap, temp_store และ busy_timeout ให้การเชื่อมต่อ"""
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+    except sqlite3.OperationalError as e:
+        # เปลี่ยนเป็น WAL ไม่ได้ขณะมีการเชื่อมต่ออื่นถือ lock อยู่ - ค่านี้ถาวรในไฟล์ จะสำเร็จในครั้งถัดไป
+        logger.warning('⚠️ ไม่สามารถเปิด WAL mode: %s', e)
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute(f'PRAGMA busy_timeout={int(timeout * 1000)}')
+
+def connect_db(db_path=None, timeout=30.0, **kwargs):
+    """เปิดการเชื่อมต่อ SQLite พร้อมตั้งค่า PRAGMA มาตรฐาน - ทุกการเชื่อมต่อในระบบควรเปิดผ่านฟังก์ชันนี้"""
+    db_path = db_path or get_database_path()
+    conn = sqlite3.connect(db_path, timeout=timeout, **kwargs)
+    metrics.inc('daex_db_connections_opened_total', database=os.path.basename(db_path))
+    apply_connection_pragmas(conn, timeout)
+    return conn
+
+def check_database_settings():
+    """ตรวจสอบค่า PRAGMA ที่มีผลจริงตอนเริ่มระบบ และแจ้งเตือนถ้า WAL ใช้ไม่ได้"""
+    conn = connect_db()
+    try:
+        settings = {
+            name: conn.execute(f'PRAGMA {name}').fetchone()[0]
+            for name in ('journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store', 'busy_timeout')
+        }
+    finally:
+        conn.close()
+    
+    logger.info('🗄️ SQLite settings: %s', settings)
+    if str(settings['journal_mode']).lower() != 'wal':
+        logger.warning('⚠️ ฐานข้อมูลไม่ได้อยู่ใน WAL mode (journal_mode=%s) - การอ่านอาจต้องรอการเขียน', settings['journal_mode'])
+    return settings
+
+# process ประมวลผลคิวอัพโหลดเงินเดือน (start_salary_upload_worker) import โมดูลนี้โดยตั้ง DAEX_SALARY_WORKER=1
+# web process ตรวจค่าฐานข้อมูลและรัน migration ไปแล้ว - process นี้จึงข้ามขั้นตอนตอน import เหล่านั้น
+SALARY_WORKER_PROCESS = os.environ.get('DAEX_SALARY_WORKER') == '1'
+
+if not SALARY_WORKER_PROCESS:
+    try:
+        check_database_settings()
+    except sqlite3.Error as e:
+        logger.error('❌ ตรวจสอบการตั้งค่าฐานข้อมูลไม่สำเร็จ: %s', e)
+
+# จำนวนการเชื่อมต่อที่เก็บไว้ใช้ซ้ำต่อ process (gunicorn แต่ละ worker มี pool ของตัวเอง)
+DB_POOL_SIZE = 4
+
+# จำนวนครั้งที่ SQL เดียวกันถูกรันซ้ำใน request เดียวแล้วถือว่าเป็นรูปแบบ N+1
+N_PLUS_ONE_THRESHOLD = 20
+
+class StatementTiming:
+    """เวลาและจำนวนแถวของ SQL หนึ่งคำสั่ง (รวมเวลาที่ใช้ดึงแถวจาก cursor เดียวกันจนกว่าจะ execute ใหม่)"""
+    __slots__ = ('sql', 'parameters', 'seconds', 'rows')
+    
+    def __init__(self, sql, parameters, seconds):
+        self.sql = sql
+        self.parameters = parameters
+        self.seconds = seconds
+        self.rows = 0
+
+class QueryStats:
+    """สถิติ SQL ของ request หนึ่ง: จำนวนคำสั่ง เวลารวม จำนวนแถวที่ดึง จำนวนครั้งต่อข้อความ SQL และเวลาของแต่ละคำสั่ง"""
+    __slots__ = ('count', 'seconds', 'rows', 'statements', 'timings')
+    
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.statements = {}
+        self.timings = []
+    
+    def add_statement(self, sql, parameters, seconds):
+        """บันทึกคำสั่งที่เพิ่ง execute (parameters เป็น None สำหรับ executemany/executescript)"""
+        self.count += 1
+        self.seconds += seconds
+        self.statements[sql] = self.statements.get(sql, 0) + 1
+        timing = StatementTiming(sql, parameters, seconds)
+        self.timings.append(timing)
+        return timing
+    
+    def add_rows(self, timing, rows, seconds):
+        self.rows += rows
+        self.seconds += seconds
+        if timing is not None:
+            timing.rows += rows
+            timing.seconds += seconds
+    
+    def most_repeated(self):
+        """คืน (ข้อความ SQL, จำนวนครั้ง) ที่ถูกรันซ้ำมากที่สุด หรือ (None, 0)"""
+        if not self.statements:
+            return None, 0
+        sql = max(self.statements, key=self.statements.get)
+        return sql, self.statements[sql]
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """cursor ที่จับเวลา execute/fetch และนับแถวลง QueryStats ของการเชื่อมต่อ (ถ้ามี request กำลังวัดอยู่)
+    
+    SQLite ทำงานจริงตอน step ระหว่าง fetch ด้วย จึงต้องนับเวลาทั้งตอน execute และตอนดึงแถว
+    เวลาดึงแถวจะรวมเข้ากับคำสั่งล่าสุดของ cursor นี้ (_timing)
+    """
+    _timing = None
+    
+    def _run(self, method, sql, parameters, bound_parameters):
+        stats = self.connection.query_stats
+        if stats is None:
+            return method(sql, *parameters)
+        started = time.perf_counter()
+        try:
+            return method(sql, *parameters)
+        finally:
+            self._timing = stats.add_statement(sql, bound_parameters, time.perf_counter() - started)
+    
+    def execute(self, sql, parameters=()):
+        return self._run(super().execute, sql, (parameters,), parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self._run(super().executemany, sql, (seq_of_parameters,), None)
+    
+    def executescript(self, sql_script):
+        return self._run(super().executescript, sql_script, (), None)
+    
+    def fetchone(self):
+        stats = self.connection.query_stats
+        if stats is None:
+            return super().fetchone()
+        started = time.perf_counter()
+        row = super().fetchone()
+        stats.add_rows(self._timing, row is not None, time.perf_counter() - started)
+        return row
+    
+    def fetchmany(self, size=None):
+        stats = self.connection.query_stats
+        size = self.arraysize if size is None else size
+        if stats is None:
+            return super().fetchmany(size)
+        started = time.perf_counter()
+        rows = super().fetchmany(size)
+        stats.add_rows(self._timing, len(rows), time.perf_counter() - started)
+        return rows
+    
+    def fetchall(self):
+        stats = self.connection.query_stats
+        if stats is None:
+            return super().fetchall()
+        started = time.perf_counter()
+        rows = super().fetchall()
+        stats.add_rows(self._timing, len(rows), time.perf_counter() - started)
+        return rows
+    
+    def __next__(self):
+        stats = self.connection.query_stats
+        if stats is None:
+            return super().__next__()
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            stats.add_rows(self._timing, 0, time.perf_counter() - started)
+            raise
+        stats.add_rows(self._timing, 1, time.perf_counter() - started)
+        return row
+
+class PooledConnection(sqlite3.Connection):
+    """การเชื่อมต่อที่ยืมจาก pool - conn.close() ในโค้ด route ไม่ปิดจริง แต่คืนเข้า pool ตอนจบ request
+    
+    cursor ทุกตัว (รวมถึง conn.execute) เป็น InstrumentedCursor ซึ่งบันทึกลง query_stats ของ request ที่ยืมอยู่
+    """
+    query_stats = None
+    
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+    
+    # Connection.execute ในตัว C เรียก execute ของ cursor โดยตรง (ข้าม InstrumentedCursor) จึงต้องส่งผ่าน cursor() เอง
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+    
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+    
+    def close(self):
+        pass
+    
+    def close_connection(self):
+        """ปิดการเชื่อมต่อจริง (ใช้เมื่อ pool เต็มหรือการเชื่อมต่อเสีย)"""
+        sqlite3.Connection.close(self)
+
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+def acquire_db_connection():
+    """ยืมการเชื่อมต่อจาก pool หรือเปิดใหม่ถ้า pool ว่าง"""
+    try:
+        return _db_pool.get_nowait()
+    except queue.Empty:
+        return connect_db(factory=PooledConnection, check_same_thread=False)
+
+def release_db_connection(conn):
+    """คืนการเชื่อมต่อเข้า pool - ยกเลิก transaction ที่ค้างไว้ก่อนเพื่อไม่ให้ request ถัดไปได้รับต่อ"""
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.row_factory = None
+        conn.query_stats = None
+        _db_pool.put_nowait(conn)
+    except (queue.Full, sqlite3.Error):
+        conn.close_connection()
+
+def get_db():
+    """การเชื่อมต่อฐานข้อมูลของ request ปัจจุบัน (rows เป็น tuple) - 1 request ใช้การเชื่อมต่อเดียว
+    
+    ห้ามแก้ row_factory ของการเชื่อมต่อนี้ - ถ้าต้องการ sqlite3.Row ให้ใช้ get_db_connection()
+    """
+    if 'db' not in g:
+        g.db = acquire_db_connection()
+        g.db.query_stats = g.get('query_stats')
+    return g.db
+
+@app.teardown_request
+def teardown_request_db(exception=None):
+    """บันทึก slow query ของ request (ถ้ามี) แล้วคืนการเชื่อมต่อเข้า pool"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        try:
+            record_slow_queries(conn)
+        except Exception as e:
+            logger.exception('Error in record_slow_queries: %s', e)
+        release_db_connection(conn)
+
+class RowConnection:
+    """มุมมองของการเชื่อมต่อของ request ที่ cursor คืนแถวเป็น sqlite3.Row
+    
+    ตั้ง row_factory ที่ cursor แต่ละตัว ไม่แก้ row_factory ของการเชื่อมต่อที่ใช้ร่วมกัน
+    โค้ดที่เรียก get_db() ใน request เดียวกันจึงยังได้ tuple เสมอ - คำสั่งอื่น (commit, rollback, ...) ส่งต่อให้การเชื่อมต่อจริง
+    """
+    __slots__ = ('_conn',)
+    
+    def __init__(self, conn):
+        self._conn = conn
+    
+    def cursor(self, factory=InstrumentedCursor):
+        cursor = self._conn.cursor(factory)
+        cursor.row_factory = sqlite3.Row
+        return cursor
+    
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+    
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+    
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
 def get_db_connection(timeout=30.0):
-    """เชื่อมต่อฐานข้อมูลพร้อมกำหนด row_factory ให้คืน dict-like rows"""
-    db_path = get_database_path()
-    conn = sqlite3.connect(db_path, timeout=timeout)
+    """เชื่อมต่อฐานข้อมูลที่คืนแถวแบบ dict-like (sqlite3.Row)
+    
+    ใน request จะใช้การเชื่อมต่อเดียวกับ get_db() ผ่าน RowConnection ส่วนนอก request (เช่น worker) จะเปิดการเชื่อมต่อใหม่
+    """
+    if has_request_context():
+        return RowConnection(get_db())
+    conn = connect_db(timeout=timeout)
     conn.row_factory = sqlite3.Row
     return conn
 
+# ==================== จับเวลา request และ SQL ====================
+
+# จำนวน request ล่าสุดต่อ route ที่ใช้คำนวณ p50/p95/p99
+ROUTE_TIMING_WINDOW = 1000
+
+def percentile(sorted_values, fraction):
+    """ค่า percentile แบบ nearest-rank จากลิสต์ที่เรียงแล้ว"""
+    if not sorted_values:
+        return 0
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+class RouteTimings:
+    """สถิติเวลาตอบสนองแบบหน้าต่างเลื่อนต่อ route ใน process นี้
+    
+    เก็บ (เวลารวม ms, เวลา SQL ms, จำนวน SQL, จำนวนแถว) ของ ROUTE_TIMING_WINDOW request ล่าสุดของแต่ละ route
+    พร้อม SQL ที่ถูกรันซ้ำมากที่สุดที่เคยเห็น (ใช้หารูปแบบ N+1)
+    """
+    
+    def __init__(self, window=ROUTE_TIMING_WINDOW):
+        self.window = window
+        self.routes = {}
+        self.lock = threading.Lock()
+        self.started_at = datetime.now().isoformat(timespec='seconds')
+    
+    def record(self, route, status, wall_ms, stats):
+        repeated_sql, repeated_count = stats.most_repeated()
+        with self.lock:
+            entry = self.routes.get(route)
+            if entry is None:
+                entry = self.routes[route] = {
+                    'samples': deque(maxlen=self.window),
+                    'count': 0,
+                    'errors': 0,
+                    'max_repeated_sql': None,
+                    'max_repeated_count': 0
+                }
+            entry['samples'].append((wall_ms, stats.seconds * 1000, stats.count, stats.rows))
+            entry['count'] += 1
+            if status >= 500:
+                entry['errors'] += 1
+            if repeated_count > entry['max_repeated_count']:
+                entry['max_repeated_sql'] = repeated_sql
+                entry['max_repeated_count'] = repeated_count
+    
+    def clear(self):
+        with self.lock:
+            self.routes.clear()
+            self.started_at = datetime.now().isoformat(timespec='seconds')
+    
+    def summary(self):
+        """สรุป p50/p95/p99 ต่อ route เรียงจาก p95 มากไปน้อย"""
+        with self.lock:
+            snapshot = [(route, list(entry['samples']), dict(entry)) for route, entry in self.routes.items()]
+        
+        routes = []
+        for route, samples, entry in snapshot:
+            wall = sorted(sample[0] for sample in samples)
+            sql_ms = sorted(sample[1] for sample in samples)
+            queries = [sample[2] for sample in samples]
+            rows = [sample[3] for sample in samples]
+            routes.append({
+                'route': route,
+                'count': entry['count'],
+                'errors': entry['errors'],
+                'window': len(samples),
+                'p50_ms': round(percentile(wall, 0.50), 2),
+                'p95_ms': round(percentile(wall, 0.95), 2),
+                'p99_ms': round(percentile(wall, 0.99), 2),
+                'max_ms': round(wall[-1], 2),
+                'sql_p95_ms': round(percentile(sql_ms, 0.95), 2),
+                'avg_queries': round(sum(queries) / len(queries), 1),
+                'max_queries': max(queries),
+                'avg_rows': round(sum(rows) / len(rows), 1),
+                'n_plus_one': entry['max_repeated_count'] >= N_PLUS_ONE_THRESHOLD,
+                'max_repeated_count': entry['max_repeated_count'],
+                'max_repeated_sql': ' '.join(entry['max_repeated_sql'].split())[:300] if entry['max_repeated_sql'] else None
+            })
+        routes.sort(key=lambda item: item['p95_ms'], reverse=True)
+        return routes
+
+_route_timings = RouteTimings()
+
+def request_route_name():
+    """ชื่อ route ของ request ปัจจุบันสำหรับสถิติ เช่น 'GET /api/vehicle/<int:vehicle_id>'"""
+    return f'{request.method} {request.url_rule.rule}' if request.url_rule else f'{request.method} <unmatched>'
+
+@app.before_request
+def start_request_timing():
+    """เริ่มจับเวลา request และเตรียม QueryStats ให้การเชื่อมต่อที่ get_db() จะยืม"""
+    g.request_started = time.perf_counter()
+    g.query_stats = QueryStats()
+    if _profiler_session is not None:
+        _profiler_session.request_started()
+
+@app.after_request
+def record_request_timing(response):
+    """ใส่ header Server-Timing และบันทึกเวลาลงสถิติของ route
+    
+    response แบบ stream จะวัดได้ถึงตอนเริ่มส่งเท่านั้น (เวลาสร้างเนื้อหาระหว่างส่งไม่ถูกนับ)
+    """
+    started = g.get('request_started')
+    stats = g.get('query_stats')
+    if started is None or stats is None:
+        return response
+    
+    wall_ms = (time.perf_counter() - started) * 1000
+    response.headers.add('Server-Timing', f'app;dur={wall_ms:.1f}')
+    response.headers.add('Server-Timing', f'db;dur={stats.seconds * 1000:.1f};desc="{stats.count} queries, {stats.rows} rows"')
+    
+    route = request_route_name()
+    _route_timings.record(route, response.status_code, wall_ms, stats)
+    
+    labels = {
+        'method': request.method,
+        'route': request.url_rule.rule if request.url_rule else '<unmatched>',
+        'status': str(response.status_code)
+    }
+    metrics.inc('daex_http_requests_total', **labels)
+    metrics.observe('daex_http_request_duration_seconds', wall_ms / 1000, **labels)
+    metrics.flush()
+    
+    repeated_sql, repeated_count = stats.most_repeated()
+    if repeated_count >= N_PLUS_ONE_THRESHOLD:
+        log_sampled(('n_plus_one', route), LOG_SAMPLE_EVERY, logging.WARNING,
+                    '⚠️ N+1 ที่ %s: SQL เดียวกันถูกรัน %d ครั้งใน request เดียว: %s',
+                    route, repeated_count, ' '.join(repeated_sql.split())[:200])
+    return response
+
+# ==================== slow query log ====================
+
+# SQL ที่ใช้เวลา (รวมการดึงแถว) ตั้งแต่กี่ ms ขึ้นไปถือว่าช้า - ตั้ง SLOW_QUERY_MS=0 เพื่อปิด
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '200'))
+SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG', os.path.join('logs', 'slow_queries.log'))
+SLOW_QUERY_LOG_MAX_BYTES = 5 * 1024 * 1024
+SLOW_QUERY_LOG_BACKUPS = 5
+# จำนวนคำสั่ง (แยกตาม SQL ที่ normalize แล้ว) ที่เก็บไว้ในตาราง top-N ต่อ process
+SLOW_QUERY_TOP_N = 50
+
+def setup_slow_query_logger():
+    """logger 'daex.slow_queries' ที่เขียนเป็น JSON บรรทัดละรายการลงไฟล์ SLOW_QUERY_LOG แบบหมุนไฟล์
+    
+    ทุก worker เขียนไฟล์เดียวกัน (append) - ตอนหมุนไฟล์ worker อื่นอาจเขียนต่อในไฟล์เก่าจนกว่าจะหมุนเอง
+    """
+    slow_logger = logging.getLogger('daex.slow_queries')
+    if not slow_logger.handlers:
+        os.makedirs(os.path.dirname(SLOW_QUERY_LOG) or '.', exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(
+            SLOW_QUERY_LOG, maxBytes=SLOW_QUERY_LOG_MAX_BYTES, backupCount=SLOW_QUERY_LOG_BACKUPS,
+            encoding='utf-8', delay=True
+        )
+        file_handler.setFormatter(logging.Formatter('%(asctime)s [%(process)d] %(message)s'))
+        slow_logger.addHandler(AsyncLogHandler(file_handler))
+        slow_logger.setLevel(logging.INFO)
+        slow_logger.propagate = False
+    return slow_logger
+
+slow_query_logger = setup_slow_query_logger()
+
+_SQL_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_SQL_PLACEHOLDER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+def normalize_sql(sql):
+    """ทำให้ SQL ที่สร้างแบบ dynamic เป็นรูปเดียวกัน: ค่าคงที่เป็น ? รายการ IN (?, ?, ...) เป็น (?...) และยุบช่องว่าง"""
+    sql = _SQL_STRING_LITERAL.sub('?', sql)
+    sql = _SQL_NUMBER_LITERAL.sub('?', sql)
+    sql = ' '.join(sql.split())
+    return _SQL_PLACEHOLDER_LIST.sub('(?...)', sql)
+
+def parameter_shape(parameters):
+    """รูปแบบของ parameter ที่ bind (ชนิดข้อมูล ไม่ใช่ค่า) เช่น '(str, int×3, null)' หรือ '{month: str}'"""
+    if parameters is None:
+        return 'many'
+    
+    def type_name(value):
+        return 'null' if value is None else type(value).__name__
+    
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(f'{name}: {type_name(value)}' for name, value in parameters.items()) + '}'
+    groups = [(name, len(list(group))) for name, group in itertools.groupby(type_name(value) for value in parameters)]
+    return '(' + ', '.join(name if count == 1 else f'{name}×{count}' for name, count in groups) + ')'
+
+def explain_query_plan(conn, sql, parameters):
+    """ผลของ EXPLAIN QUERY PLAN เป็นบรรทัดที่เยื้องตามลำดับชั้น (ใช้ cursor ธรรมดาเพื่อไม่ให้ถูกนับในสถิติ)"""
+    if parameters is None:
+        return ['(ไม่มี plan สำหรับ executemany/executescript)']
+    try:
+        rows = conn.cursor(sqlite3.Cursor).execute('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+    except sqlite3.Error as e:
+        return [f'(EXPLAIN ไม่สำเร็จ: {e})']
+    depths = {0: -1}
+    plan = []
+    for node_id, parent_id, _, detail in rows:
+        depth = depths.get(parent_id, -1) + 1
+        depths[node_id] = depth
+        plan.append('  ' * depth + detail)
+    return plan
+
+class SlowQueryLog:
+    """ตาราง top-N ของ slow query ต่อ process แยกตาม SQL ที่ normalize แล้ว
+    
+    EXPLAIN QUERY PLAN ถูกเก็บครั้งเดียวต่อคำสั่ง (ตอนพบครั้งแรก) และเขียนลงไฟล์พร้อมรายการแรกของคำสั่งนั้น
+    ถ้าเกิน SLOW_QUERY_TOP_N จะทิ้งคำสั่งที่ max_ms น้อยที่สุด
+    """
+    
+    def __init__(self, top_n=SLOW_QUERY_TOP_N):
+        self.top_n = top_n
+        self.entries = {}
+        self.lock = threading.Lock()
+    
+    def record(self, conn, route, timing):
+        sql = normalize_sql(timing.sql)
+        fingerprint = hashlib.sha1(sql.encode('utf-8')).hexdigest()[:12]
+        duration_ms = round(timing.seconds * 1000, 2)
+        shape = parameter_shape(timing.parameters)
+        now = datetime.now().isoformat(timespec='seconds')
+        
+        with self.lock:
+            known = fingerprint in self.entries
+        plan = None if known else explain_query_plan(conn, timing.sql, timing.parameters)
+        
+        with self.lock:
+            entry = self.entries.get(fingerprint)
+            if entry is None:
+                entry = self.entries[fingerprint] = {
+                    'fingerprint': fingerprint,
+                    'sql': sql,
+                    'count': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'max_rows': 0,
+                    'parameter_shapes': [],
+                    'routes': {},
+                    'plan': plan,
+                    'first_seen': now
+                }
+            entry['count'] += 1
+            entry['total_ms'] += duration_ms
+            entry['max_ms'] = max(entry['max_ms'], duration_ms)
+            entry['last_ms'] = duration_ms
+            entry['last_seen'] = now
+            entry['max_rows'] = max(entry['max_rows'], timing.rows)
+            if shape not in entry['parameter_shapes'] and len(entry['parameter_shapes']) < 10:
+                entry['parameter_shapes'].append(shape)
+            entry['routes'][route] = entry['routes'].get(route, 0) + 1
+            if len(self.entries) > self.top_n:
+                del self.entries[min(self.entries, key=lambda key: self.entries[key]['max_ms'])]
+        
+        slow_query_logger.info('%s', json.dumps({
+            'fingerprint': fingerprint,
+            'route': route,
+            'duration_ms': duration_ms,
+            'rows': timing.rows,
+            'sql': sql,
+            'parameters': shape,
+            'plan': plan
+        }, ensure_ascii=False))
+        log_sampled(('slow_query', fingerprint), LOG_SAMPLE_EVERY, logging.WARNING,
+                    '🐢 slow query %.1f ms ที่ %s [%s]: %s', duration_ms, route, fingerprint, sql[:200])
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+    
+    def summary(self):
+        """รายการ slow query เรียงจาก max_ms มากไปน้อย"""
+        with self.lock:
+            entries = [dict(entry, routes=dict(entry['routes']), parameter_shapes=list(entry['parameter_shapes']))
+                       for entry in self.entries.values()]
+        for entry in entries:
+            entry['avg_ms'] = round(entry['total_ms'] / entry['count'], 2)
+            entry['total_ms'] = round(entry['total_ms'], 2)
+        entries.sort(key=lambda entry: entry['max_ms'], reverse=True)
+        return entries
+
+_slow_query_log = SlowQueryLog()
+
+def record_slow_queries(conn):
+    """บันทึกคำสั่งของ request ที่ใช้เวลาเกิน SLOW_QUERY_MS (เรียกตอนจบ request ก่อนคืนการเชื่อมต่อ)"""
+    stats = conn.query_stats
+    if stats is None or SLOW_QUERY_MS <= 0:
+        return
+    threshold = SLOW_QUERY_MS / 1000
+    slow = [timing for timing in stats.timings if timing.seconds >= threshold]
+    if not slow:
+        return
+    route = request_route_name()
+    for timing in slow:
+        _slow_query_log.record(conn, route, timing)
+
+# ==================== sampling profiler ====================
+
+# ไฟล์ profile (collapsed stacks) ของทุก worker เก็บรวมที่นี่ - เปิดด้วย flamegraph.pl หรือ speedscope ได้
+PROFILES_DIR = os.path.join('logs', 'profiles')
+PROFILER_INTERVAL_MS = 5
+PROFILER_MAX_SECONDS = 600
+PROFILER_MAX_REQUESTS = 100
+# ไฟล์สัญญาณให้ process อัพโหลดเงินเดือนเก็บ profile ของงานถัดไป (อยู่คนละ process กับ web worker)
+PROFILER_SALARY_UPLOAD_FLAG = os.path.join(PROFILES_DIR, 'salary_upload.armed')
+PROFILE_NAME_PATTERN = re.compile(r'^[\w.-]+\.collapsed$')
+
+def collapse_stack(frame):
+    """stack ของ frame เป็นข้อความ 'ฟังก์ชันนอกสุด;...;ฟังก์ชันในสุด' ในรูปแบบ collapsed stacks"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+class ProfilerSession:
+    """การเก็บ profile หนึ่งครั้งใน process นี้: thread เบื้องหลังอ่าน stack ของ thread เป้าหมายทุก interval
+    
+    mode 'seconds' เก็บทุก request ที่เข้ามาจนหมดเวลา, 'requests' เก็บเฉพาะ request ของ route ที่ระบุจนครบ K ครั้ง
+    และ 'thread' เก็บ thread ที่ระบุ (ใช้กับงานอัพโหลดเงินเดือน) จนกว่าจะเรียก stop()
+    ผลถูกเขียนเป็นไฟล์ .collapsed ใน PROFILES_DIR ตอนจบ
+    """
+    
+    def __init__(self, mode, label, seconds=PROFILER_MAX_SECONDS, route=None, requests=0,
+                 interval_ms=PROFILER_INTERVAL_MS, thread_ids=()):
+        self.mode = mode
+        self.route = route
+        self.remaining = requests
+        self.interval = interval_ms / 1000
+        self.deadline = time.monotonic() + seconds
+        self.thread_ids = set(thread_ids)
+        self.counts = {}
+        self.samples = 0
+        self.requests = 0
+        self.started_at = datetime.now()
+        self.name = f'{self.started_at:%Y%m%d-%H%M%S}-{os.getpid()}-{re.sub(r"[^0-9A-Za-z_-]+", "_", label).strip("_")}.collapsed'
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='daex-profiler', daemon=True)
+    
+    def matches(self):
+        if self.mode == 'seconds':
+            return True
+        return self.mode == 'requests' and self.route in (request.path, request.endpoint, request.url_rule.rule if request.url_rule else None)
+    
+    def request_started(self):
+        if self.stopped.is_set() or not self.matches():
+            return
+        with self.lock:
+            self.thread_ids.add(threading.get_ident())
+        g.profiler_session = self
+    
+    def request_finished(self):
+        with self.lock:
+            self.thread_ids.discard(threading.get_ident())
+            self.requests += 1
+            if self.mode == 'requests':
+                self.remaining -= 1
+                if self.remaining <= 0:
+                    self.stopped.set()
+    
+    def run(self):
+        own_id = threading.get_ident()
+        try:
+            while not self.stopped.wait(self.interval) and time.monotonic() < self.deadline:
+                with self.lock:
+                    targets = tuple(self.thread_ids)
+                if not targets:
+                    continue
+                frames = sys._current_frames()
+                for thread_id in targets:
+                    frame = frames.get(thread_id)
+                    if frame is None or thread_id == own_id:
+                        continue
+                    stack = collapse_stack(frame)
+                    self.counts[stack] = self.counts.get(stack, 0) + 1
+                self.samples += 1
+        finally:
+            self.stopped.set()
+            self.save()
+            finish_profiler_session(self)
+    
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(self.counts.items(), key=lambda item: -item[1]))
+    
+    def save(self):
+        try:
+            os.makedirs(PROFILES_DIR, exist_ok=True)
+            with open(os.path.join(PROFILES_DIR, self.name), 'w', encoding='utf-8') as f:
+                f.write(self.collapsed())
+            logger.info('🔬 บันทึก profile %s (%d samples, %d requests)', self.name, self.samples, self.requests)
+        except OSError as e:
+            logger.error('❌ บันทึก profile %s ไม่สำเร็จ: %s', self.name, e)
+    
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive() and self.thread.ident != threading.get_ident():
+            self.thread.join()
+    
+    def describe(self):
+        return {
+            'name': self.name,
+            'mode': self.mode,
+            'route': self.route,
+            'remaining_requests': self.remaining if self.mode == 'requests' else None,
+            'seconds_left': max(0, round(self.deadline - time.monotonic(), 1)),
+            'samples': self.samples,
+            'requests': self.requests,
+            'started_at': self.started_at.isoformat(timespec='seconds')
+        }
+
+# profile ที่กำลังเก็บใน process นี้ (None = ปิด - ไม่มี thread และ request ไม่ต้องทำอะไรเพิ่ม)
+_profiler_session = None
+_profiler_lock = threading.Lock()
+
+def start_profiler_session(session_):
+    global _profiler_session
+    with _profiler_lock:
+        if _profiler_session is not None:
+            return False
+        _profiler_session = session_
+    session_.thread.start()
+    return True
+
+def finish_profiler_session(session_):
+    global _profiler_session
+    with _profiler_lock:
+        if _profiler_session is session_:
+            _profiler_session = None
+
+@app.teardown_request
+def teardown_request_profiler(exception=None):
+    """แจ้ง profiler ว่า request ที่กำลังเก็บจบแล้ว"""
+    if _profiler_session is None:
+        return
+    session_ = g.pop('profiler_session', None)
+    if session_ is not None:
+        session_.request_finished()
+
+def profile_salary_upload_job(job_runner, job):
+    """รันงานอัพโหลดโดยเก็บ profile ถ้ามีไฟล์สัญญาณ PROFILER_SALARY_UPLOAD_FLAG (ใช้ได้ครั้งเดียว)"""
+    try:
+        with open(PROFILER_SALARY_UPLOAD_FLAG, encoding='utf-8') as f:
+            options = json.load(f)
+        os.remove(PROFILER_SALARY_UPLOAD_FLAG)
+    except (OSError, ValueError):
+        return job_runner(job)
+    
+    session_ = ProfilerSession(
+        'thread', f'salary-upload-{job["id"]}', seconds=options.get('seconds', PROFILER_MAX_SECONDS),
+        interval_ms=options.get('interval_ms', PROFILER_INTERVAL_MS), thread_ids=[threading.get_ident()]
+    )
+    session_.thread.start()
+    try:
+        return job_runner(job)
+    finally:
+        session_.stop()
+
 def init_db():
     """สร้างตารางฐานข้อมูลสำหรับระบบ JMS"""
-    conn = sqlite3.connect(get_database_path())
+    conn = connect_db()
     cursor = conn.cursor()
     
     # สร้างตารางผู้ใช้งานระบบ
@@ -184,7 +1243,10 @@ def init_db():
             year INTEGER NOT NULL,
             batch_id TEXT NOT NULL,
             uploaded_by TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            status TEXT DEFAULT 'completed',
+            employee_linked INTEGER DEFAULT 0,
+            rate_linked INTEGER DEFAULT 0
         )
     ''')
     
@@ -202,6 +1264,7 @@ def init_db():
             work_month TEXT NOT NULL,
             total_pieces INTEGER NOT NULL,
             total_amount REAL NOT NULL,
+            weight_range_index INTEGER,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
@@ -314,6 +1377,7 @@ def ensure_vehicle_maintenance_requests_table(cursor):
             estimated_cost REAL,
             quote_attachment TEXT,
             quote_filename TEXT,
+            quote_media_hash TEXT,
             before_images TEXT,
             status TEXT DEFAULT 'requested',
             created_by INTEGER,
@@ -323,22 +1387,446 @@ def ensure_vehicle_maintenance_requests_table(cursor):
             actual_cost REAL,
             receipt_attachment TEXT,
             receipt_filename TEXT,
+            receipt_media_hash TEXT,
             after_images TEXT
         )
     ''')
 
-def encode_file_storage(file_storage):
-    """แปลงไฟล์จาก FormData เป็น base64 string พร้อมชื่อไฟล์"""
+def ensure_salary_upload_columns(cursor):
+    """เพิ่มคอลัมน์สถานะการอัพโหลดให้ตาราง salary_uploads หากยังไม่มี"""
+    cursor.execute("PRAGMA table_info(salary_uploads)")
+    columns = [col[1] for col in cursor.fetchall()]
+    
+    new_columns = {
+        'status': "TEXT DEFAULT 'completed'",
+        'employee_linked': 'INTEGER DEFAULT 0',
+        'rate_linked': 'INTEGER DEFAULT 0'
+    }
+    
+    for col_name, col_type in new_columns.items():
+        if col_name not in columns:
+            cursor.execute(f'ALTER TABLE salary_uploads ADD COLUMN {col_name} {col_type}')
+            logger.info('Added column %s to salary_uploads', col_name)
+
+# ดัชนีที่ได้จากเงื่อนไข WHERE / ORDER BY / GROUP BY ของ query ที่ใช้บ่อยใน app.py: (ชื่อดัชนี, ตาราง, คอลัมน์)
+HOT_QUERY_INDEXES = [
+    # salary: ผลการอัพโหลดรายชุด, ข้อมูลรายเดือน, รายละเอียดพนักงานรายเดือน
+    ('idx_esr_batch_employee', 'employee_salary_records', 'upload_batch_id, employee_id'),
+    ('idx_esr_month_employee', 'employee_salary_records', 'work_month, employee_id'),
+    ('idx_esr_employee_month', 'employee_salary_records', 'employee_id, work_month'),
+    ('idx_usr_batch', 'unmatched_salary_records', 'upload_batch_id'),
+    ('idx_msd_month_year', 'monthly_salary_data', 'month, year'),
+    ('idx_salary_uploads_month_year', 'salary_uploads', 'month, year, created_at'),
+    ('idx_salary_uploads_created', 'salary_uploads', 'created_at'),
+    ('idx_salary_uploads_batch', 'salary_uploads', 'batch_id'),
+    # vehicle: ประวัติการตรวจเช็ค และการใช้น้ำมัน
+    ('idx_vwc_vehicle_date', 'vehicle_weekly_checks', 'vehicle_id, check_date'),
+    ('idx_vwc_check_date', 'vehicle_weekly_checks', 'check_date'),
+    ('idx_vwc_created', 'vehicle_weekly_checks', 'created_at'),
+    ('idx_vfu_fuel_date', 'vehicle_fuel_usage', 'fuel_date'),
+    ('idx_vfu_vehicle_date', 'vehicle_fuel_usage', 'vehicle_id, fuel_date'),
+    # HR: คำขอลาและค่าใช้จ่ายที่รออนุมัติ
+    ('idx_leave_status_created', 'leave_requests', 'status, created_at'),
+    ('idx_leave_employee_created', 'leave_requests', 'employee_id, created_at'),
+    ('idx_expenses_status_created', 'expenses', 'status, created_at'),
+    ('idx_expenses_type_date', 'expenses', 'expense_type, expense_date'),
+    ('idx_employees_branch_status', 'employees', 'branch_code, status'),
+]
+
+def migrate_hot_query_indexes(cursor):
+    """สร้างดัชนีใน HOT_QUERY_INDEXES - คืน False ถ้ายังมีตารางที่ไม่มีอยู่ (จะลองใหม่ตอนเริ่มระบบครั้งถัดไป)"""
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = {row[0] for row in cursor.fetchall()}
+
+    complete = True
+    for index_name, table, columns in HOT_QUERY_INDEXES:
+        if table not in tables:
+            logger.warning('⚠️ ข้ามดัชนี %s: ไม่พบตาราง %s', index_name, table)
+            complete = False
+            continue
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({columns})')
+    return complete
+
+def migrate_salary_weight_range_index(cursor):
+    """เพิ่มคอลัมน์ weight_range_index ให้ employee_salary_records และคำนวณช่วงน้ำหนักของข้อมูลเดิมใหม่จาก WEIGHT_RANGE_BOUNDS"""
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = {row[0] for row in cursor.fetchall()}
+    if not {'employee_salary_records', 'unmatched_salary_records'} <= tables:
+        logger.warning('⚠️ ข้าม migration weight_range_index: ยังไม่มีตารางข้อมูลเงินเดือน')
+        return False
+
+    cursor.execute("PRAGMA table_info(employee_salary_records)")
+    if 'weight_range_index' not in [col[1] for col in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE employee_salary_records ADD COLUMN weight_range_index INTEGER')
+    cursor.execute(f'UPDATE employee_salary_records SET weight_range_index = {weight_range_case_sql()}')
+
+    # ข้อมูลที่ไม่ตรงที่บันทึกจากโค้ดเก่าใช้ขอบช่วงคนละชุด (เช่น 0.505 ไม่ตกช่วงใด) - คำนวณใหม่ให้ตรงกัน
+    range_name_sql = ' '.join(f"WHEN {i} THEN '{name}'" for i, name in enumerate(WEIGHT_RANGE_NAMES))
+    cursor.execute(f'UPDATE unmatched_salary_records SET weight_range_index = {weight_range_case_sql()}')
+    cursor.execute(f'UPDATE unmatched_salary_records SET range_name = CASE weight_range_index {range_name_sql} END')
+
+    # ดัชนีที่ครอบคลุมการสรุปผลรายชุด (batch -> พนักงาน -> ช่วงน้ำหนัก) แทนดัชนีเดิมที่ไม่มีช่วงน้ำหนัก
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_esr_batch_employee_range
+        ON employee_salary_records (upload_batch_id, employee_id, weight_range_index)
+    ''')
+    cursor.execute('DROP INDEX IF EXISTS idx_esr_batch_employee')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_usr_batch_range ON unmatched_salary_records (upload_batch_id, weight_range_index)')
+    cursor.execute('DROP INDEX IF EXISTS idx_usr_batch')
+    return True
+
+def migrate_payroll_snapshot(cursor):
+    """สร้างตาราง payroll_snapshot และคำนวณทุกเดือนที่มีใน monthly_salary_data"""
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = {row[0] for row in cursor.fetchall()}
+    if not {'monthly_salary_data', 'employees', 'piece_rates'} <= tables:
+        logger.warning('⚠️ ข้าม migration payroll_snapshot: ยังไม่มีตารางเงินเดือน/พนักงาน/เรท')
+        return False
+    
+    built = rebuild_payroll_snapshot(cursor)
+    logger.info('🗄️ คำนวณ payroll_snapshot แล้ว %s รายการ', built)
+    return True
+
+def migrate_allowance_tier_table(cursor):
+    """เพิ่มคอลัมน์ allowance_tier_table ให้ piece_rates และแปลง allowance_tiers เดิมทุกแถว (แถวที่ไม่ถูกต้องเป็น NULL)"""
+    cursor.execute("PRAGMA table_info(piece_rates)")
+    columns = [col[1] for col in cursor.fetchall()]
+    if 'allowance_tiers' not in columns:
+        logger.warning('⚠️ ข้าม migration allowance_tier_table: ตาราง piece_rates ยังไม่มีคอลัมน์ allowance_tiers')
+        return False
+    if 'allowance_tier_table' not in columns:
+        cursor.execute('ALTER TABLE piece_rates ADD COLUMN allowance_tier_table TEXT')
+    
+    cursor.execute('SELECT id, allowance_tiers FROM piece_rates')
+    for rate_id, raw_tiers in cursor.fetchall():
+        table, error = compile_allowance_tiers(raw_tiers)
+        if error:
+            logger.warning('⚠️ เรท id=%s: %s - ไม่ใช้ขั้นเงินสมทบจนกว่าจะบันทึกเรทใหม่', rate_id, error)
+        cursor.execute('UPDATE piece_rates SET allowance_tier_table = ? WHERE id = ?',
+                       (table.pack() if table is not None else None, rate_id))
+    bump_data_version(cursor, 'piece_rates')
+    return True
+
+def migrate_media_store(cursor):
+    """ย้ายรูปภาพ/ไฟล์แนบ base64 ใน vehicle_weekly_checks และ vehicle_maintenance_requests ไปไว้ในคลังไฟล์ (MEDIA_DIR)
+    
+    อ่านทีละแถวเพื่อไม่ให้แถวขนาดใหญ่หลายแถวอยู่ในหน่วยความจำพร้อมกัน
+    (พื้นที่ในไฟล์ฐานข้อมูลจะคืนหลังรัน VACUUM - ดู database/optimize_database.py)
+    """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = {row[0] for row in cursor.fetchall()}
+    ensure_media_blobs_table(cursor)
+    moved = 0
+    
+    if 'vehicle_weekly_checks' in tables:
+        cursor.execute("PRAGMA table_info(vehicle_weekly_checks)")
+        image_columns = [col[1] for col in cursor.fetchall() if col[1].endswith('_image')]
+        cursor.execute('SELECT id FROM vehicle_weekly_checks ORDER BY id')
+        for (check_id,) in cursor.fetchall():
+            cursor.execute(f'SELECT {", ".join(image_columns)} FROM vehicle_weekly_checks WHERE id = ?', (check_id,))
+            values = cursor.fetchone()
+            updates = {}
+            for column, value in zip(image_columns, values):
+                migrated = migrate_images_to_media(cursor, value)
+                if migrated is not None:
+                    updates[column] = migrated
+            if updates:
+                assignments = ', '.join(f'{column} = ?' for column in updates)
+                cursor.execute(f'UPDATE vehicle_weekly_checks SET {assignments} WHERE id = ?', (*updates.values(), check_id))
+                moved += 1
+    
+    if 'vehicle_maintenance_requests' in tables:
+        cursor.execute("PRAGMA table_info(vehicle_maintenance_requests)")
+        columns = [col[1] for col in cursor.fetchall()]
+        for column in ('quote_media_hash', 'receipt_media_hash'):
+            if column not in columns:
+                cursor.execute(f'ALTER TABLE vehicle_maintenance_requests ADD COLUMN {column} TEXT')
+        cursor.execute('SELECT id FROM vehicle_maintenance_requests ORDER BY id')
+        for (request_id,) in cursor.fetchall():
+            cursor.execute('''
+                SELECT before_images, after_images, quote_attachment, quote_filename, receipt_attachment, receipt_filename
+                FROM vehicle_maintenance_requests WHERE id = ?
+            ''', (request_id,))
+            before_images, after_images, quote_data, quote_filename, receipt_data, receipt_filename = cursor.fetchone()
+            updates = {}
+            for column, value in (('before_images', before_images), ('after_images', after_images)):
+                migrated = migrate_images_to_media(cursor, value)
+                if migrated is not None:
+                    updates[column] = migrated
+            for prefix, data, filename in (('quote', quote_data, quote_filename), ('receipt', receipt_data, receipt_filename)):
+                if not data:
+                    continue
+                try:
+                    file_data = base64.b64decode(data, validate=True)
+                except (ValueError, TypeError):
+                    logger.warning('⚠️ คำขอซ่อม id=%s: ไฟล์แนบ %s ไม่ใช่ base64 ที่ถูกต้อง - คงไว้ตามเดิม', request_id, prefix)
+                    continue
+                try:
+                    updates[f'{prefix}_media_hash'] = store_media(cursor, file_data, filename)['hash']
+                except ValueError as e:
+                    logger.warning('⚠️ คำขอซ่อม id=%s: %s - คงไว้ตามเดิม', request_id, e)
+                    continue
+                updates[f'{prefix}_attachment'] = None
+            if updates:
+                assignments = ', '.join(f'{column} = ?' for column in updates)
+                cursor.execute(f'UPDATE vehicle_maintenance_requests SET {assignments} WHERE id = ?', (*updates.values(), request_id))
+                moved += 1
+    
+    logger.info('🗂️ ย้ายรูปภาพ/ไฟล์แนบเข้าคลังไฟล์แล้ว %s แถว', moved)
+    return True
+
+def migrate_negative_weight_ranges(cursor):
+    """คืนช่วงน้ำหนักของแถวที่น้ำหนักติดลบเป็นช่วงสุดท้าย (15+) ตามกฎของโค้ดเดิม
+    
+    migration 2 และ bin_weights รุ่นแรกจัดน้ำหนักติดลบไว้ช่วงแรก (0.0-0.5) ซึ่งเปลี่ยนเรทที่ใช้โดยไม่ตั้งใจ
+    """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = {row[0] for row in cursor.fetchall()}
+    last_range = len(WEIGHT_RANGE_BOUNDS)
+    if 'employee_salary_records' in tables:
+        cursor.execute('UPDATE employee_salary_records SET weight_range_index = ? WHERE weight < 0', (last_range,))
+    if 'unmatched_salary_records' in tables:
+        cursor.execute('''
+            UPDATE unmatched_salary_records SET weight_range_index = ?, range_name = ? WHERE weight < 0
+        ''', (last_range, WEIGHT_RANGE_NAMES[last_range]))
+    return True
+
+# migration ของโครงสร้างฐานข้อมูล: (version, ชื่อ, ฟังก์ชัน) - เพิ่มรายการใหม่ต่อท้ายเสมอ ห้ามแก้ version เดิม
+SCHEMA_MIGRATIONS = [
+    (1, 'hot_query_indexes', migrate_hot_query_indexes),
+    (2, 'salary_weight_range_index', migrate_salary_weight_range_index),
+    (3, 'payroll_snapshot', migrate_payroll_snapshot),
+    (4, 'allowance_tier_table', migrate_allowance_tier_table),
+    (5, 'media_store', migrate_media_store),
+    (6, 'negative_weight_ranges', migrate_negative_weight_ranges),
+]
+
+def run_schema_migrations(conn=None):
+    """รัน migration ที่ยังไม่เคยรัน ตามลำดับ version และบันทึกลงตาราง schema_migrations"""
+    own_conn = conn is None
+    if own_conn:
+        conn = connect_db()
+    applied_now = []
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.commit()
+
+        for version, name, migrate in SCHEMA_MIGRATIONS:
+            # BEGIN IMMEDIATE ให้ gunicorn worker อื่นที่เริ่มพร้อมกันรอ แล้วเห็นว่า migration นี้รันไปแล้ว
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                cursor.execute('SELECT 1 FROM schema_migrations WHERE version = ?', (version,))
+                if cursor.fetchone():
+                    conn.rollback()
+                    continue
+                if migrate(cursor):
+                    cursor.execute('INSERT INTO schema_migrations (version, name) VALUES (?, ?)', (version, name))
+                    applied_now.append(version)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    finally:
+        if own_conn:
+            conn.close()
+
+    if applied_now:
+        logger.info('🗄️ รัน schema migration สำเร็จ: %s', applied_now)
+    return applied_now
+
+# query ของ endpoint ที่ใช้บ่อย สำหรับตรวจ EXPLAIN QUERY PLAN: (ชื่อ, sql, params, alias ของตารางใหญ่ที่ห้าม SCAN)
+HOT_QUERY_PLANS = [
+    ('upload-results: records by batch',
+     'SELECT esr.employee_id, e.name, esr.weight_range_index, COUNT(*) FROM employee_salary_records esr LEFT JOIN employees e ON esr.employee_id = e.employee_id WHERE esr.upload_batch_id = ? GROUP BY esr.employee_id, esr.weight_range_index ORDER BY esr.employee_id',
+     ('batch',), {'esr'}),
+    ('upload-results: unmatched by batch',
+     'SELECT weight_range_index, COUNT(*) FROM unmatched_salary_records WHERE upload_batch_id = ? GROUP BY weight_range_index',
+     ('batch',), {'unmatched_salary_records'}),
+    ('upload-results: uploads by month/year',
+     'SELECT batch_id FROM salary_uploads WHERE month = ? AND year = ? ORDER BY created_at DESC LIMIT 1',
+     (1, 2025), {'salary_uploads'}),
+    ('salary: records by work month',
+     'SELECT esr.employee_id, COUNT(*) FROM employee_salary_records esr LEFT JOIN employees e ON esr.employee_id = e.employee_id WHERE esr.work_month = ? GROUP BY esr.employee_id',
+     ('2025-01',), {'esr'}),
+    ('salary: employee month details',
+     'SELECT COUNT(*) FROM employee_salary_records WHERE employee_id = ? AND work_month = ?',
+     ('E0001', '2025-01'), {'employee_salary_records'}),
+    ('salary: monthly data',
+     'SELECT msd.* FROM monthly_salary_data msd LEFT JOIN employees e ON msd.employee_id = e.employee_id WHERE msd.month = ? AND msd.year = ?',
+     (1, 2025), {'msd'}),
+    ('salary: payroll snapshot',
+     'SELECT * FROM payroll_snapshot WHERE month = ? AND year = ? AND branch_code = ? ORDER BY name, msd_id',
+     (1, 2025, '671180'), {'payroll_snapshot'}),
+    ('vehicle: check history',
+     'SELECT vwc.id FROM vehicle_weekly_checks vwc LEFT JOIN vehicles v ON vwc.vehicle_id = v.vehicle_id WHERE 1=1 AND vwc.vehicle_id = ? AND vwc.check_date >= ? ORDER BY vwc.check_date DESC LIMIT 100',
+     ('V001', '2025-01-01'), {'vwc'}),
+    ('vehicle: fuel this month',
+     'SELECT COALESCE(SUM(total_cost), 0) FROM vehicle_fuel_usage WHERE fuel_date >= ? AND fuel_date < ?',
+     ('2025-01', '2025-02'), {'vehicle_fuel_usage'}),
+    ('hr: pending leave',
+     "SELECT l.id FROM leave_requests l JOIN employees e ON l.employee_id = e.employee_id WHERE l.status = 'pending' ORDER BY l.created_at DESC",
+     (), {'l'}),
+    ('hr: my leave',
+     'SELECT id FROM leave_requests WHERE employee_id = ? ORDER BY created_at DESC',
+     ('E0001',), {'leave_requests'}),
+    ('hr: pending expenses',
+     "SELECT e.id FROM expenses e JOIN employees emp ON e.employee_id = emp.employee_id WHERE e.status = 'pending' ORDER BY e.created_at DESC",
+     (), {'e'}),
+]
+
+def full_table_scans(conn, sql, params=()):
+    """EXPLAIN QUERY PLAN ของ sql แล้วคืน [(ชื่อตาราง/alias ที่ถูก SCAN, detail)]
+    
+    SCAN ... USING INDEX ก็นับ - เป็นการอ่านดัชนีทั้งก้อน (เช่น GROUP BY ตามดัชนีที่ไม่ตรงกับ WHERE) ช้าตามขนาดตารางเหมือนกัน
+    """
+    scans = []
+    for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall():
+        detail = row[-1]
+        match = re.match(r'SCAN (?:TABLE )?(\w+)(?: AS (\w+))?', detail)
+        if match:
+            scans.append(({name for name in match.groups() if name}, detail))
+    return scans
+
+def explain_hot_queries(conn=None):
+    """ตรวจ EXPLAIN QUERY PLAN ของ HOT_QUERY_PLANS - คืนรายการ (ชื่อ, plan) ที่ยัง SCAN ตารางใหญ่ (ว่าง = ผ่าน)
+
+    ใช้ตรวจหลังเพิ่มดัชนีหรือแก้ query: python -c "import app; assert not app.explain_hot_queries()"
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = connect_db()
+    problems = []
+    try:
+        for label, sql, params, watched in HOT_QUERY_PLANS:
+            for names, detail in full_table_scans(conn, sql, params):
+                if names & watched:
+                    problems.append((label, detail))
+    finally:
+        if own_conn:
+            conn.close()
+
+    for label, detail in problems:
+        logger.warning('⚠️ %s: %s', label, detail)
+    return problems
+
+def like_prefix_bounds(prefix):
+    """ช่วง [start, end) ที่ให้ผลเหมือน column LIKE 'prefix%' แต่ใช้ดัชนีได้ (เช่น '2025-01' -> '2025-02')"""
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+# ==================== คลังไฟล์แนบ (รูปภาพ/เอกสาร) แบบ content-addressed ====================
+
+# ไฟล์แนบเก็บบนดิสก์ตาม SHA-256 ของเนื้อไฟล์ (ไฟล์เดียวกันเก็บครั้งเดียว) แถวในฐานข้อมูลเก็บเฉพาะ hash
+MEDIA_DIR = os.path.join('uploads', 'media')
+MEDIA_HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+# magic bytes ของชนิดไฟล์ที่พบบ่อย (ไม่เชื่อนามสกุลไฟล์จากมือถืออย่างเดียว)
+MEDIA_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'%PDF', 'application/pdf'),
+)
+# ชนิดไฟล์ที่ส่งแบบ inline ได้ (รูป raster และ PDF) - ชนิดอื่นส่งเป็น application/octet-stream แบบดาวน์โหลดเท่านั้น
+MEDIA_INLINE_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp', 'application/pdf'}
+# ไฟล์ที่มีสคริปต์ได้ (SVG/HTML/XML) ไม่รับเข้าคลังเลย - ตรวจทั้งนามสกุลและเนื้อไฟล์
+MEDIA_REJECTED_TYPES = {
+    'image/svg+xml', 'text/html', 'application/xhtml+xml', 'text/xml', 'application/xml',
+    'text/javascript', 'application/javascript',
+}
+MEDIA_MARKUP_TAGS = (b'<svg', b'<html', b'<script', b'<!doctype', b'<?xml', b'<body', b'<iframe')
+
+def ensure_media_blobs_table(cursor):
+    """สร้างตาราง media_blobs (ทะเบียนไฟล์ในคลัง: hash, ขนาด, ชนิดไฟล์) หากยังไม่มี"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS media_blobs (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mime_type TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def media_path(digest):
+    """ตำแหน่งไฟล์ในคลัง แบ่งโฟลเดอร์ตาม 2+2 ตัวอักษรแรกของ hash เพื่อไม่ให้โฟลเดอร์เดียวมีไฟล์มากเกินไป"""
+    return os.path.join(MEDIA_DIR, digest[:2], digest[2:4], digest)
+
+def media_url(digest, variant=None):
+    return f'/media/{digest}?variant={variant}' if variant else f'/media/{digest}'
+
+def guess_media_type(data, filename=None):
+    """ชนิดไฟล์จาก magic bytes หรือนามสกุลไฟล์"""
+    for signature, mime_type in MEDIA_SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data[4:8] == b'ftyp' and data[8:12] in (b'heic', b'heix', b'mif1'):
+        return 'image/heic'
+    return (mimetypes.guess_type(filename)[0] if filename else None) or 'application/octet-stream'
+
+def is_markup_media(data, filename=None):
+    """ไฟล์เป็น SVG/HTML/XML (เปิดใน browser แล้วรันสคริปต์ได้) หรือไม่ - ดูจากนามสกุลและตอนต้นของเนื้อไฟล์"""
+    if filename and mimetypes.guess_type(filename)[0] in MEDIA_REJECTED_TYPES:
+        return True
+    head = data[:1024].lstrip(b'\xef\xbb\xbf \t\r\n').lower()
+    return head.startswith(b'<') and any(tag in head for tag in MEDIA_MARKUP_TAGS)
+
+def store_media(cursor, data, filename=None):
+    """บันทึกไฟล์ลงคลัง (ถ้ามี hash นี้แล้วไม่เขียนซ้ำ) และลงทะเบียนใน media_blobs
+    
+    คืน dict อ้างอิงที่เก็บในแถวแทนข้อมูล base64: filename, hash, size, mime_type
+    ไฟล์ SVG/HTML/XML ถูกปฏิเสธด้วย ValueError
+    """
+    if is_markup_media(data, filename):
+        raise ValueError(f'ไม่รับไฟล์ชนิด SVG/HTML/XML ({filename or "ไม่มีชื่อไฟล์"})')
+    digest = hashlib.sha256(data).hexdigest()
+    path = media_path(digest)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # เขียนไฟล์ชั่วคราวแล้ว rename เพื่อไม่ให้ผู้อ่านเห็นไฟล์ที่เขียนไม่ครบ
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    
+    mime_type = guess_media_type(data, filename)
+    ensure_media_blobs_table(cursor)
+    cursor.execute('INSERT OR IGNORE INTO media_blobs (sha256, size, mime_type) VALUES (?, ?, ?)',
+                   (digest, len(data), mime_type))
+    return {'filename': filename, 'hash': digest, 'size': len(data), 'mime_type': mime_type}
+
+def read_media(digest):
+    """อ่านเนื้อไฟล์จากคลัง หรือ None ถ้าไม่พบ"""
+    if not digest or not MEDIA_HASH_PATTERN.match(digest):
+        return None
+    try:
+        with open(media_path(digest), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def store_uploaded_file(cursor, file_storage):
+    """บันทึกไฟล์จาก FormData ลงคลัง คืนค่า (ชื่อไฟล์, hash) - ไฟล์ว่างหรือชนิดที่ไม่รับคืน (None, None)"""
     if not file_storage or not getattr(file_storage, 'filename', None):
         return None, None
     file_data = file_storage.read()
     if not file_data:
         return None, None
-    encoded = base64.b64encode(file_data).decode('utf-8')
-    return file_storage.filename, encoded
+    try:
+        return file_storage.filename, store_media(cursor, file_data, file_storage.filename)['hash']
+    except ValueError as e:
+        logger.warning('⚠️ ข้ามไฟล์แนบ: %s', e)
+        return None, None
 
-def encode_multiple_images(file_list):
-    """แปลงรายการไฟล์ภาพเป็น list ของ dict ที่เก็บชื่อและข้อมูล base64"""
+def store_uploaded_images(cursor, file_list):
+    """บันทึกรายการไฟล์ภาพลงคลัง คืน list ของ dict อ้างอิง (filename, hash, size, mime_type)"""
     images = []
     for file_storage in file_list:
         if not file_storage or not getattr(file_storage, 'filename', None):
@@ -346,11 +1834,10 @@ def encode_multiple_images(file_list):
         file_data = file_storage.read()
         if not file_data:
             continue
-        encoded = base64.b64encode(file_data).decode('utf-8')
-        images.append({
-            'filename': file_storage.filename,
-            'data': encoded
-        })
+        try:
+            images.append(store_media(cursor, file_data, file_storage.filename))
+        except ValueError as e:
+            logger.warning('⚠️ ข้ามรูปภาพ: %s', e)
     return images
 
 def parse_images_json(images_text):
@@ -365,67 +1852,303 @@ def parse_images_json(images_text):
     except json.JSONDecodeError:
         return []
 
-def normalize_image_field(value):
-    """ปรับรูปแบบข้อมูลรูปภาพให้เป็น list ของ dict เสมอ"""
+def image_refs(value):
+    """รายการรูปภาพที่เก็บในแถว (JSON อ้างอิง hash, JSON base64 แบบเดิม หรือ base64 ตรง) เป็น list ของ dict
+    
+    รายการที่ย้ายเข้าคลังแล้วมี 'hash' ส่วนข้อมูลเดิมที่ยังไม่ย้ายมี 'data' (base64)
+    """
     if not value:
         return []
     if isinstance(value, list):
-        # ตรวจสอบว่า list มีโครงสร้าง dict ที่มี data หรือไม่
-        normalized = []
+        refs = []
         for item in value:
-            if isinstance(item, dict) and item.get('data'):
-                normalized.append({
+            if isinstance(item, dict) and item.get('hash'):
+                refs.append({
                     'filename': item.get('filename'),
-                    'data': item.get('data')
+                    'hash': item['hash'],
+                    'mime_type': item.get('mime_type')
                 })
-        return normalized
+            elif isinstance(item, dict) and item.get('data'):
+                refs.append({'filename': item.get('filename'), 'data': item['data']})
+        return refs
     if isinstance(value, str):
         parsed = parse_images_json(value)
         if parsed:
-            return normalize_image_field(parsed)
+            return image_refs(parsed)
+        if value.lstrip().startswith('['):
+            return []
         # กรณีเป็น base64 ตรง ให้แปลงเป็น list เดี่ยว
-        return [{
-            'filename': None,
-            'data': value
-        }]
+        return [{'filename': None, 'data': value}]
     # กรณีอื่นให้คืน list ว่าง
     return []
 
-# เรียกใช้ init_db() - skip for existing database
-# init_db()
-
-# ฟังก์ชันตรวจสอบการล็อกอิน
-def login_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        print(f"DEBUG: ตรวจสอบ session - user_id: {session.get('user_id')}, user_role: {session.get('user_role')}")
-        print(f"DEBUG: Session keys: {list(session.keys())}")
-        print(f"DEBUG: Request cookies: {dict(request.cookies)}")
-        if 'user_id' not in session:
-            print("DEBUG: ไม่พบ user_id ใน session - redirect ไป login")
-            return redirect(url_for('login'))
-        print("DEBUG: พบ user_id ใน session - ผ่านการตรวจสอบ")
-        return f(*args, **kwargs)
-    return decorated_function
+def image_ref_bytes(ref):
+    """เนื้อไฟล์ของรูปภาพ 1 รายการจาก image_refs หรือ None"""
+    if ref.get('hash'):
+        return read_media(ref['hash'])
+    try:
+        return base64.b64decode(ref.get('data') or '')
+    except (ValueError, TypeError):
+        return None
 
-# ฟังก์ชันตรวจสอบสิทธิ์
-def role_required(required_roles):
-    def decorator(f):
-        @wraps(f)
-        def decorated_function(*args, **kwargs):
-            if 'user_role' not in session:
-                return redirect(url_for('login'))
-            if session['user_role'] not in required_roles:
-                flash('คุณไม่มีสิทธิ์เข้าถึงหน้านี้', 'error')
-                return redirect(url_for('dashboard'))
-            return f(*args, **kwargs)
-        return decorated_function
-    return decorator
+def normalize_image_field(value):
+    """ปรับรูปแบบข้อมูลรูปภาพให้เป็น list ของ dict เสมอ: filename, data (base64) และ hash/url ถ้าอยู่ในคลังแล้ว"""
+    normalized = []
+    for ref in image_refs(value):
+        if ref.get('hash'):
+            file_data = read_media(ref['hash'])
+            normalized.append({
+                'filename': ref.get('filename'),
+                'hash': ref['hash'],
+                'url': media_url(ref['hash']),
+                'thumb_url': media_url(ref['hash'], 'thumb'),
+                'preview_url': media_url(ref['hash'], 'preview'),
+                'data': base64.b64encode(file_data).decode('utf-8') if file_data is not None else None
+            })
+        else:
+            normalized.append({'filename': ref.get('filename'), 'data': ref['data']})
+    return normalized
 
-@app.route('/')
-def index():
-    """หน้าแรก"""
-    return render_template('index.html')
+def image_count_sql(column):
+    """นิพจน์ SQL นับจำนวนรูปในคอลัมน์รูปภาพ - ได้ผลเท่ากับ len(image_refs(ค่า)) โดยไม่ต้องส่งค่าคอลัมน์ (อาจยังเป็น base64) ออกจาก SQLite
+    
+    column ต้องเป็นชื่อคอลัมน์ที่ผ่าน whitelist แล้ว
+    """
+    return f'''CASE
+        WHEN {column} IS NULL OR {column} = '' THEN 0
+        WHEN json_valid({column}) AND json_type({column}) = 'array' THEN (
+            SELECT COUNT(*) FROM json_each({column}) AS image
+            WHERE image.type = 'object'
+              AND (COALESCE(json_extract(image.value, '$.hash'), '') NOT IN ('', 0)
+                   OR COALESCE(json_extract(image.value, '$.data'), '') NOT IN ('', 0)))
+        WHEN ltrim({column}, ' ' || char(9, 10, 13)) LIKE '[%' THEN 0
+        ELSE 1
+    END'''
+
+def migrate_images_to_media(cursor, value):
+    """แปลงค่าคอลัมน์รูปภาพที่ยังเป็น base64 ให้เป็น JSON อ้างอิงคลัง - คืน None ถ้าไม่ต้องแก้ไข"""
+    refs = image_refs(value)
+    if not any('data' in ref for ref in refs):
+        return None
+    migrated = []
+    for ref in refs:
+        if 'data' in ref:
+            try:
+                file_data = base64.b64decode(ref['data'], validate=True)
+            except (ValueError, TypeError):
+                log_sampled('media-migrate-base64', LOG_SAMPLE_EVERY, logging.WARNING, '⚠️ ข้ามรูปภาพที่ไม่ใช่ base64 ที่ถูกต้อง (%s)', ref.get('filename'))
+                continue
+            try:
+                ref = store_media(cursor, file_data, ref.get('filename'))
+            except ValueError as e:
+                # ไม่ย้ายเข้าคลัง - คง base64 เดิมไว้ในแถว
+                log_sampled('media-migrate-markup', LOG_SAMPLE_EVERY, logging.WARNING, '⚠️ ข้ามรูปภาพ: %s', e)
+        migrated.append(ref)
+    return json.dumps(migrated)
+
+# ==================== รูปย่อของไฟล์ในคลัง (thumb/preview) สร้างเบื้องหลัง ====================
+
+try:
+    from PIL import Image as PILImage, ImageOps
+except ImportError:  # ไม่ได้ติดตั้ง Pillow - ทุกขนาดใช้ไฟล์ต้นฉบับแทน
+    PILImage = None
+    ImageOps = None
+
+# ขนาดด้านยาวสูงสุด (pixel) ของรูปย่อแต่ละแบบ - 'original' คือไฟล์ต้นฉบับในคลัง
+MEDIA_VARIANTS = {'thumb': 80, 'preview': 640}
+MEDIA_VARIANT_JPEG_QUALITY = 80
+# จำนวนรูปต้นฉบับที่ดึงมาสร้างรูปย่อต่อรอบ (แต่ละรูปบันทึกใน transaction สั้นๆ ของตัวเอง)
+MEDIA_VARIANT_BATCH = 20
+
+_media_variant_wakeup = threading.Event()
+_media_variant_worker_lock = threading.Lock()
+_media_variant_worker = None  # (pid, thread) ของ thread สร้างรูปย่อใน process นี้
+
+def ensure_media_variants_table(cursor):
+    """สร้างตาราง media_variants (รูปต้นฉบับ + ชื่อขนาด -> hash ของรูปย่อ) หากยังไม่มี
+    
+    sha256 เป็น NULL เมื่อสร้างรูปย่อไม่ได้ (เช่น HEIC/ไฟล์เสีย) เพื่อไม่ให้พยายามซ้ำ - ใช้ต้นฉบับแทน
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS media_variants (
+            source_sha256 TEXT NOT NULL,
+            variant TEXT NOT NULL,
+            sha256 TEXT,
+            width INTEGER,
+            height INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (source_sha256, variant)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_media_variants_sha256 ON media_variants(sha256)')
+
+def render_media_variants(data, sizes=None):
+    """ย่อรูป 1 รูปเป็นทุกขนาดใน sizes (ค่าเริ่มต้น MEDIA_VARIANTS) ถอดรหัสครั้งเดียว ย่อจากใหญ่ไปเล็ก
+    
+    คืน {variant: (bytes, width, height)} - bytes เป็น None เมื่อรูปเดิมเล็กกว่าขนาดนั้นอยู่แล้ว (ใช้ต้นฉบับได้เลย)
+    """
+    sizes = sizes or MEDIA_VARIANTS
+    variants = {}
+    with PILImage.open(BytesIO(data)) as source:
+        source_size = source.size
+        largest = max(sizes.values())
+        # JPEG ถอดรหัสที่ความละเอียดต่ำตั้งแต่แรก - เร็วกว่าถอดรูปมือถือเต็มขนาดแล้วย่อหลายเท่า
+        source.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(source)
+        has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+        
+        for variant, max_side in sorted(sizes.items(), key=lambda item: -item[1]):
+            if max(source_size) <= max_side:
+                variants[variant] = (None, source_size[0], source_size[1])
+                continue
+            image.thumbnail((max_side, max_side), PILImage.LANCZOS)
+            output = BytesIO()
+            if has_alpha:
+                image.save(output, 'PNG', optimize=True)
+            else:
+                image.save(output, 'JPEG', quality=MEDIA_VARIANT_JPEG_QUALITY, optimize=True, progressive=True)
+            variants[variant] = (output.getvalue(), image.size[0], image.size[1])
+    return variants
+
+def process_media_variant_batch(limit=MEDIA_VARIANT_BATCH):
+    """สร้างรูปย่อให้รูปในคลังที่ยังไม่มี (รวมรูปเดิมที่ย้ายเข้าคลัง) - คืนจำนวนรูปที่ประมวลผล"""
+    conn = connect_db()
+    try:
+        cursor = conn.cursor()
+        ensure_media_blobs_table(cursor)
+        ensure_media_variants_table(cursor)
+        conn.commit()
+        
+        # ไม่รวมไฟล์ที่เป็นรูปย่อของรูปอื่นอยู่แล้ว
+        cursor.execute('''
+            SELECT b.sha256 FROM media_blobs b
+            WHERE b.mime_type LIKE 'image/%'
+              AND NOT EXISTS (SELECT 1 FROM media_variants v WHERE v.source_sha256 = b.sha256)
+              AND NOT EXISTS (SELECT 1 FROM media_variants v
+                              WHERE v.sha256 = b.sha256 AND v.source_sha256 != b.sha256)
+            LIMIT ?
+        ''', (limit,))
+        digests = [row[0] for row in cursor.fetchall()]
+        
+        for digest in digests:
+            # ถอดรหัส/ย่อรูปนอก transaction เพื่อไม่ให้ถือ lock ฐานข้อมูลระหว่างใช้ CPU
+            data = read_media(digest)
+            try:
+                rendered = render_media_variants(data) if data is not None else {}
+            except Exception as e:
+                log_sampled('media-variant-render', LOG_SAMPLE_EVERY, logging.WARNING, '⚠️ สร้างรูปย่อของ %s ไม่ได้ ใช้ต้นฉบับแทน: %s', digest[:12], e)
+                rendered = {}
+            
+            cursor.execute('BEGIN IMMEDIATE')
+            for variant in MEDIA_VARIANTS:
+                variant_data, width, height = rendered.get(variant, (None, None, None))
+                if variant_data is not None:
+                    variant_digest = store_media(cursor, variant_data)['hash']
+                else:
+                    variant_digest = digest if width else None
+                cursor.execute('''
+                    INSERT OR IGNORE INTO media_variants (source_sha256, variant, sha256, width, height)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (digest, variant, variant_digest, width, height))
+            conn.commit()
+        
+        if digests:
+            logger.info('🖼️ สร้างรูปย่อ %s รูป', len(digests))
+        return len(digests)
+    finally:
+        conn.close()
+
+def run_media_variant_worker():
+    """thread เบื้องหลัง: รอสัญญาณแล้วสร้างรูปย่อจนไม่มีรูปค้าง"""
+    while True:
+        _media_variant_wakeup.wait()
+        _media_variant_wakeup.clear()
+        try:
+            while process_media_variant_batch():
+                pass
+        except Exception as e:
+            logger.error('❌ สร้างรูปย่อไม่สำเร็จ: %s', e)
+
+def schedule_media_variants():
+    """ปลุก thread สร้างรูปย่อ (เริ่ม thread ถ้ายังไม่มีใน process นี้) - ไม่บล็อก request"""
+    global _media_variant_worker
+    if PILImage is None:
+        return False
+    with _media_variant_worker_lock:
+        worker = _media_variant_worker
+        if worker is None or worker[0] != os.getpid() or not worker[1].is_alive():
+            thread = threading.Thread(target=run_media_variant_worker, name='media-variants', daemon=True)
+            _media_variant_worker = (os.getpid(), thread)
+            thread.start()
+    _media_variant_wakeup.set()
+    return True
+
+def media_thumbnail_bytes(ref, thumb_digest=None):
+    """รูปย่อขนาด thumb ของรูป 1 รายการจาก image_refs: ใช้ไฟล์ที่สร้างไว้แล้ว ถ้ายังไม่มีให้ย่อจากต้นฉบับ (ไม่บันทึก)"""
+    if thumb_digest:
+        data = read_media(thumb_digest)
+        if data is not None:
+            return data
+    data = image_ref_bytes(ref)
+    if data is None or PILImage is None:
+        return data
+    thumb_data = render_media_variants(data, {'thumb': MEDIA_VARIANTS['thumb']})['thumb'][0]
+    return thumb_data if thumb_data is not None else data
+
+def media_variant_digests(cursor, digests, variant):
+    """hash ของรูปย่อขนาด variant สำหรับหลายรูปในครั้งเดียว - คืน dict ต้นฉบับ -> hash (ไม่มีรายการถ้ายังไม่ได้สร้าง)"""
+    digests = list(dict.fromkeys(d for d in digests if d))
+    found = {}
+    for start in range(0, len(digests), 500):
+        chunk = digests[start:start + 500]
+        try:
+            cursor.execute(f'''
+                SELECT source_sha256, sha256 FROM media_variants
+                WHERE variant = ? AND sha256 IS NOT NULL AND source_sha256 IN ({', '.join('?' * len(chunk))})
+            ''', (variant, *chunk))
+        except sqlite3.OperationalError:
+            return found
+        found.update(cursor.fetchall())
+    return found
+
+# เรียกใช้ init_db() - skip for existing database
+# init_db()
+
+# ฟังก์ชันตรวจสอบการล็อกอิน
+def login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        # เรียกทุก request ที่ล็อกอิน - สร้างข้อความเฉพาะเมื่อเปิดระดับ DEBUG
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('ตรวจสอบ session - user_id: %s, user_role: %s', session.get('user_id'), session.get('user_role'))
+            logger.debug('Session keys: %s', list(session.keys()))
+            logger.debug('Request cookie names: %s', list(request.cookies))
+        if 'user_id' not in session:
+            logger.debug('ไม่พบ user_id ใน session - redirect ไป login')
+            return redirect(url_for('login'))
+        logger.debug('พบ user_id ใน session - ผ่านการตรวจสอบ')
+        return f(*args, **kwargs)
+    return decorated_function
+
+# ฟังก์ชันตรวจสอบสิทธิ์
+def role_required(required_roles):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if 'user_role' not in session:
+                return redirect(url_for('login'))
+            if session['user_role'] not in required_roles:
+                flash('คุณไม่มีสิทธิ์เข้าถึงหน้านี้', 'error')
+                return redirect(url_for('dashboard'))
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+@app.route('/')
+def index():
+    """หน้าแรก"""
+    return render_template('index.html')
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -434,8 +2157,7 @@ def login():
         username = request.form['username'].strip()
         password = request.form['password'].strip()
         
-        conn = sqlite3.connect('database/daex_system.db')
-        conn.row_factory = sqlite3.Row
+        conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute('SELECT id, username, password_hash, role, branch_code, email FROM users WHERE username = ?', (username,))
         user = cursor.fetchone()
@@ -447,8 +2169,8 @@ def login():
             session['user_role'] = user[3]
             session['branch_code'] = user[4]
             session['user_name'] = user[1]  # ใช้ username แทน name
-            print(f"DEBUG: เข้าสู่ระบบสำเร็จ - Role: {user[3]}")
-            print(f"DEBUG: Session data: {dict(session)}")
+            logger.debug('เข้าสู่ระบบสำเร็จ - Role: %s', user[3])
+            logger.debug('Session data: %s', dict(session))
             flash('เข้าสู่ระบบสำเร็จ', 'success')
             return redirect(url_for('dashboard'))
         else:
@@ -475,8 +2197,8 @@ def mobile_login():
             session['user_role'] = user[3]
             session['branch_code'] = user[4]
             session['user_name'] = user[1]  # ใช้ username แทน name
-            print(f"DEBUG: เข้าสู่ระบบ Mobile สำเร็จ - Role: {user[3]}")
-            print(f"DEBUG: Session data: {dict(session)}")
+            logger.debug('เข้าสู่ระบบ Mobile สำเร็จ - Role: %s', user[3])
+            logger.debug('Session data: %s', dict(session))
             flash('เข้าสู่ระบบสำเร็จ', 'success')
             return redirect(url_for('mobile_app'))
         else:
@@ -495,7 +2217,7 @@ def logout():
 @login_required
 def dashboard():
     """แดชบอร์ดหลัก"""
-    conn = sqlite3.connect('database/daex_system.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     # ข้อมูลสรุปตาม role
@@ -577,7 +2299,7 @@ def dashboard():
 @role_required(['GM', 'MD'])
 def gm_permissions():
     """หน้าจัดการสิทธิ์สำหรับ GM"""
-    conn = sqlite3.connect('database/daex_system.db')
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('SELECT id, username, role, name, email, branch_code FROM users ORDER BY role, username')
     users = cursor.fetchall()
@@ -590,7 +2312,7 @@ def gm_permissions():
 @role_required(['HR', 'GM', 'MD'])
 def hr_employee_requests():
     """หน้าอนุมัติการขอเปิดรหัสพนักงาน"""
-    conn = sqlite3.connect('database/daex_system.db')
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
         SELECT er.*, e.name as requester_name 
@@ -607,7 +2329,7 @@ def hr_employee_requests():
 @role_required(['HR', 'GM', 'MD'])
 def hr_employees():
     """หน้ารายชื่อพนักงานทั้งหมด"""
-    conn = sqlite3.connect('database/daex_system.db')
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
         SELECT e.*, m.name as manager_name 
@@ -640,7 +2362,7 @@ def hr_employees():
 @role_required(['HR', 'GM', 'MD'])
 def hr_leave_approvals():
     """หน้าอนุมัติการลา"""
-    conn = sqlite3.connect('database/daex_system.db')
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
         SELECT l.*, e.name as employee_name, e.branch_code 
@@ -666,7 +2388,7 @@ def hr_upload_salary():
 @role_required(['การเงิน', 'GM', 'MD'])
 def finance_expense_approvals():
     """หน้าอนุมัติการเบิกค่าใช้จ่าย"""
-    conn = sqlite3.connect('database/daex_system.db')
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
         SELECT e.*, emp.name as employee_name, emp.branch_code 
@@ -685,7 +2407,7 @@ def finance_expense_approvals():
 def finance_expense_reports():
     """หน้ารายการเบิกต่างๆ"""
     expense_type = request.args.get('type', 'all')
-    conn = sqlite3.connect('database/daex_system.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     if expense_type == 'all':
@@ -720,7 +2442,7 @@ def finance_upload_expenses():
 @role_required(['การเงิน', 'GM', 'MD'])
 def finance_expense_summary():
     """หน้าสรุปรายการค่าใช้จ่าย"""
-    conn = sqlite3.connect('database/daex_system.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     # สรุปตามประเภทค่าใช้จ่าย
@@ -799,11 +2521,11 @@ def api_content(content_type):
     user_role = session.get('user_role')
     branch_code = session.get('branch_code')
     
-    print(f"DEBUG: api_content called - content_type: {content_type}")
-    print(f"DEBUG: user_role: {user_role}")
-    print(f"DEBUG: branch_code: {branch_code}")
+    logger.debug('api_content called - content_type: %s', content_type)
+    logger.debug('user_role: %s', user_role)
+    logger.debug('branch_code: %s', branch_code)
     
-    conn = sqlite3.connect('database/daex_system.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     if content_type == 'employee-management' and user_role in ['HR', 'GM', 'MD']:
@@ -1146,8 +2868,8 @@ def api_content(content_type):
     
     else:
         conn.close()
-        print(f"DEBUG: ไม่พบ content_type: {content_type} หรือไม่มีสิทธิ์")
-        print(f"DEBUG: user_role: {user_role}")
+        logger.debug('ไม่พบ content_type: %s หรือไม่มีสิทธิ์', content_type)
+        logger.debug('user_role: %s', user_role)
         return '<div class="alert alert-warning">คุณไม่มีสิทธิ์เข้าถึงหน้านี้</div>'
 
 # API Routes for employee management
@@ -1165,47 +2887,27 @@ def api_salary_monthly_data():
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        # ดึงข้อมูลจาก monthly_salary_data (ข้อมูลที่มีช่วงน้ำหนักแยก)
-        query = '''
-            SELECT 
-                msd.employee_id,
-                msd.package_count as total_pieces,
-                msd.month,
-                msd.year,
-                e.name,
-                e.position,
-                e.branch_code,
-                e.zone,
-                e.rate_type,
-                e.base_salary,
-                e.status,
-                msd.range_1_pieces, msd.range_2_pieces, msd.range_3_pieces, msd.range_4_pieces, msd.range_5_pieces,
-                msd.range_6_pieces, msd.range_7_pieces, msd.range_8_pieces, msd.range_9_pieces, msd.range_10_pieces,
-                msd.range_1_amount, msd.range_2_amount, msd.range_3_amount, msd.range_4_amount, msd.range_5_amount,
-                msd.range_6_amount, msd.range_7_amount, msd.range_8_amount, msd.range_9_amount, msd.range_10_amount
-            FROM monthly_salary_data msd
-            LEFT JOIN employees e ON msd.employee_id = e.employee_id
-            WHERE msd.month = ? AND msd.year = ?
-        '''
-        params = [month, year]
-        
-        print(f"🔍 ค้นหาข้อมูลเดือน {month}/{year}")
-        
-        # เพิ่มเงื่อนไขการกรอง
-        if branch and branch != '':
-            query += ' AND e.branch_code = ?'
-            params.append(branch)
-        
-        if employee_id:
-            query += ' AND msd.employee_id LIKE ?'
-            params.append(f'%{employee_id}%')
+        logger.debug('🔍 ค้นหาข้อมูลเดือน %s/%s', month, year)
         
-        query += ' ORDER BY e.name'
-        
-        cursor.execute(query, params)
-        salary_data = cursor.fetchall()
+        # อ่านผลที่คำนวณไว้แล้วจาก payroll_snapshot - ถ้าเดือนนี้ยังไม่มีให้คำนวณสดด้วยสูตรเดียวกัน
+        if payroll_snapshot_ready(cursor, month, year):
+            payroll_rows = load_payroll_snapshot(cursor, month, year, branch, employee_id)
+        else:
+            conditions = ['msd.month = ? AND msd.year = ?']
+            params = [month, year]
+            
+            # เพิ่มเงื่อนไขการกรอง
+            if branch and branch != '':
+                conditions.append('e.branch_code = ?')
+                params.append(branch)
+            
+            if employee_id:
+                conditions.append('msd.employee_id LIKE ?')
+                params.append(f'%{employee_id}%')
+            
+            payroll_rows = compute_payroll_rows(cursor, conditions, params)
         
-        print(f"📊 พบข้อมูล {len(salary_data)} รายการ")
+        logger.debug('📊 พบข้อมูล %s รายการ', len(payroll_rows))
         
         # แปลงข้อมูลเป็น format ที่ template ต้องการ
         employee_data = []
@@ -1213,140 +2915,44 @@ def api_salary_monthly_data():
         total_amount = 0
         employees_with_rates = 0
         employees_without_rates = 0
-        unmatched_packages = 0
         
-        print(f"=== แสดงผลลัพธ์ในเมนูสรุปเงินได้พนักงาน ===")
-        print(f"📊 ข้อมูลเดือน {month}/{year} - พนักงานทั้งหมด: {len(salary_data)} คน")
+        # สร้างข้อมูลช่วงน้ำหนักจากข้อมูลที่มีอยู่
+        range_names = [
+            '0.00-0.50KG', '0.51-1.00KG', '1.01-2.00KG', '2.01-3.00KG', '3.01-5.00KG',
+            '5.01-7.00KG', '7.01-10.00KG', '10.01-12.00KG', '12.01-15.00KG', '15.01KG+'
+        ]
         
-        for data in salary_data:
-            (emp_id, pieces, month, year, name, position, branch_code, zone, 
-             emp_type, base_salary, status,
-             r1_pieces, r2_pieces, r3_pieces, r4_pieces, r5_pieces,
-             r6_pieces, r7_pieces, r8_pieces, r9_pieces, r10_pieces,
-             r1_amount, r2_amount, r3_amount, r4_amount, r5_amount,
-             r6_amount, r7_amount, r8_amount, r9_amount, r10_amount) = data
+        for row in payroll_rows:
+            month, year = row['month'], row['year']
             
-            print(f"  - {emp_id}: {name}, {pieces} ชิ้น")
-            
-            # สร้างข้อมูลช่วงน้ำหนักจากข้อมูลที่มีอยู่
-            range_names = [
-                '0.00-0.50KG', '0.51-1.00KG', '1.01-2.00KG', '2.01-3.00KG', '3.01-5.00KG',
-                '5.01-7.00KG', '7.01-10.00KG', '10.01-12.00KG', '12.01-15.00KG', '15.01KG+'
+            weight_ranges = [
+                {'range': range_name, 'pieces': pieces_count, 'amount': 0}
+                for range_name, pieces_count in zip(range_names, row['range_pieces'])
             ]
             
-            weight_ranges = []
-            for i, range_name in enumerate(range_names):
-                pieces_count = [r1_pieces, r2_pieces, r3_pieces, r4_pieces, r5_pieces,
-                              r6_pieces, r7_pieces, r8_pieces, r9_pieces, r10_pieces][i] or 0
-                weight_ranges.append({
-                    'range': range_name,
-                    'pieces': pieces_count,
-                    'amount': 0
-                })
-            
-            # ใช้ฟังก์ชันการคำนวณแบบรวมศูนย์
-            # ตรวจสอบข้อมูลที่จำเป็นสำหรับการคำนวณ
-            has_required_data = position and zone  # ต้องมีตำแหน่งและโซน
-            salary_type = emp_type if emp_type else 'DEFAULT'  # ถ้าไม่มี rate_type ให้ใช้ DEFAULT
-            
-            if has_required_data:
-                print(f"🔍 DEBUG: Searching rate for position={position}, rate_type={emp_type}, salary_type={salary_type}, zone={zone}, branch={branch_code}")
-                
-                # หาเรทที่ตรงกับพนักงาน - ใช้ 4 เงื่อนไข: เรทการจ้าง, สาขา, ตำแหน่ง, โซน
-                # ลำดับการค้นหา: 1. สาขาเฉพาะ 2. ทุกสาขา (ถ้าไม่เจอสาขาเฉพาะ)
-                
-                # ขั้นตอนที่ 1: หาเรทของสาขาเฉพาะ
-                cursor.execute('''
-                    SELECT base_salary, piece_rate_bonus, allowance,
-                           weight_range_1, weight_range_2, weight_range_3, weight_range_4, weight_range_5,
-                           weight_range_6, weight_range_7, weight_range_8, weight_range_9, weight_range_10,
-                           allowance_tiers
-                    FROM piece_rates 
-                    WHERE position = ? AND salary_type = ? AND zone = ? AND branch_code = ?
-                    LIMIT 1
-                ''', (position, salary_type, zone, branch_code))
-                
-                rate_data = cursor.fetchone()
-                
-                # ขั้นตอนที่ 2: ถ้าไม่เจอเรทของสาขาเฉพาะ ให้หาเรท "ทุกสาขา"
-                if not rate_data:
-                    print(f"🔍 ไม่เจอเรทของสาขา {branch_code} - หาเรท 'ทุกสาขา' แทน")
-                    cursor.execute('''
-                        SELECT base_salary, piece_rate_bonus, allowance,
-                               weight_range_1, weight_range_2, weight_range_3, weight_range_4, weight_range_5,
-                               weight_range_6, weight_range_7, weight_range_8, weight_range_9, weight_range_10,
-                               allowance_tiers
-                        FROM piece_rates 
-                        WHERE position = ? AND salary_type = ? AND zone = ? AND branch_code = 'ทุกสาขา'
-                        LIMIT 1
-                    ''', (position, salary_type, zone))
-                    
-                    rate_data = cursor.fetchone()
-                    
-                    if rate_data:
-                        print(f"✅ ใช้เรท 'ทุกสาขา' สำหรับ {emp_id}")
-                    else:
-                        print(f"❌ ไม่เจอเรท 'ทุกสาขา' สำหรับ {emp_id}")
-                else:
-                    print(f"✅ ใช้เรทของสาขา {branch_code} สำหรับ {emp_id}")
-                
-                if not rate_data:
-                    print(f"❌ ERROR: No rate found for employee {emp_id} after checking both specific branch and 'ทุกสาขา'")
-                    print(f"   - position={position}")
-                    print(f"   - salary_type={salary_type}")
-                    print(f"   - zone={zone}")
-                    print(f"   - branch_code={branch_code}")
-                    
-                    # ตรวจสอบว่ามีเรทอะไรบ้างในระบบ
-                    cursor.execute('''
-                        SELECT DISTINCT position, salary_type, zone, branch_code 
-                        FROM piece_rates 
-                        WHERE position = ? OR salary_type = ? OR zone = ? OR branch_code = ?
-                    ''', (position, salary_type, zone, branch_code))
-                    available_rates = cursor.fetchall()
-                    if available_rates:
-                        print(f"   📋 Available rates in system:")
-                        for rate in available_rates:
-                            print(f"      - position={rate[0]}, salary_type={rate[1]}, zone={rate[2]}, branch={rate[3]}")
-                    
-                    employees_without_rates += 1
-                else:
-                    employees_with_rates += 1
-                    print(f"✅ Found rate for {emp_id} - ฐาน={rate_data[0]}, ชิ้น={rate_data[1]}, สมทบ={rate_data[2]}")
+            if row['has_rate']:
+                employees_with_rates += 1
             else:
-                rate_data = None
                 employees_without_rates += 1
-                print(f"⚠️ WARNING: Missing required data for employee {emp_id} - position={position}, zone={zone}")
-            
-            # ใช้ฟังก์ชันการคำนวณแบบรวมศูนย์
-            salary_calculation = calculate_salary_unified(employee_data, rate_data, pieces or 0)
-            base_salary_amount = salary_calculation['base_salary']
-            piece_rate_bonus = salary_calculation['piece_rate_bonus']
-            allowance = salary_calculation['allowance']
-            total_emp_amount = salary_calculation['total_amount']
-            
-            print(f"    💰 เงินเดือน: ฐาน={base_salary_amount:,.2f}, ชิ้น={piece_rate_bonus:,.2f}, สมทบ={allowance:,.2f}, รวม={total_emp_amount:,.2f}")
             
             employee_info = {
-                'employee_id': emp_id,
-                'name': name or 'ไม่ระบุชื่อ',
-                'position': position or 'ไม่ระบุตำแหน่ง',
-                'branch_code': branch_code or 'ไม่ระบุสาขา',
-                'zone': zone or 'ไม่ระบุโซน',
-                'piece_rate': salary_type or 'ไม่ระบุ',  # ส่งค่า salary_type แทน employment_type
-                'base_salary': base_salary_amount,
-                'piece_rate_bonus': piece_rate_bonus,
-                'allowance': allowance,
-                'total_pieces': pieces or 0,
-                'total_amount': total_emp_amount,
+                'employee_id': row['employee_id'],
+                'name': row['name'] or 'ไม่ระบุชื่อ',
+                'position': row['position'] or 'ไม่ระบุตำแหน่ง',
+                'branch_code': row['branch_code'] or 'ไม่ระบุสาขา',
+                'zone': row['zone'] or 'ไม่ระบุโซน',
+                'piece_rate': row['salary_type'] or 'ไม่ระบุ',  # ส่งค่า salary_type แทน employment_type
+                'base_salary': row['base_salary'],
+                'piece_rate_bonus': row['piece_rate_bonus'],
+                'allowance': row['allowance'],
+                'total_pieces': row['total_pieces'],
+                'total_amount': row['total_amount'],
                 'weight_ranges': weight_ranges
             }
             
-
-            
             employee_data.append(employee_info)
-            total_packages += pieces or 0
-            total_amount += total_emp_amount
+            total_packages += row['total_pieces']
+            total_amount += row['total_amount']
         
         # คำนวณ summary จากข้อมูลจริง
         summary = {
@@ -1360,7 +2966,7 @@ def api_salary_monthly_data():
             'employees_without_rates': employees_without_rates
         }
         
-        print(f"📈 สรุป: พนักงาน {len(employee_data)} คน, พัสดุ {total_packages:,} ชิ้น, ยอดรวม ฿{total_amount:,.2f}")
+        logger.debug('📈 สรุป: พนักงาน %s คน, พัสดุ %s ชิ้น, ยอดรวม ฿%.2f', len(employee_data), total_packages, total_amount)
         
         conn.close()
         
@@ -1370,7 +2976,7 @@ def api_salary_monthly_data():
         })
         
     except Exception as e:
-        print(f"❌ เกิดข้อผิดพลาดใน api_salary_monthly_data: {str(e)}")
+        logger.error('❌ เกิดข้อผิดพลาดใน api_salary_monthly_data: %s', e)
         return jsonify({'error': f'เกิดข้อผิดพลาด: {str(e)}'})
 
 @app.route('/api/salary/employee-details/<employee_id>')
@@ -1448,29 +3054,18 @@ def api_employee_salary_details(employee_id):
         # ดึงข้อมูลเรทที่ตรงกับพนักงาน
         piece_rate_bonus = 0
         allowance = 0
+        rate_data = None
         
         if emp_data['position'] and emp_data['piece_rate'] and emp_data['zone']:
             # ใช้ rate_type โดยตรง (ไม่ต้องแปลง)
             salary_type = emp_data['piece_rate']  # rate_type ตรงกับ salary_type ใน piece_rates
-            print(f"🔍 DEBUG: Searching rate for position={emp_data['position']}, rate_type={emp_data['piece_rate']}, salary_type={salary_type}, zone={emp_data['zone']}, branch={emp_data['branch_code']}")
-            # ลองหาเรทที่ตรงกับโซนก่อน
-            cursor.execute('''
-                SELECT base_salary, piece_rate_bonus, allowance,
-                       weight_range_1, weight_range_2, weight_range_3, weight_range_4, weight_range_5,
-                       weight_range_6, weight_range_7, weight_range_8, weight_range_9, weight_range_10,
-                       allowance_tiers
-                FROM piece_rates 
-                WHERE position = ? AND salary_type = ? AND zone = ? AND (branch_code = ? OR branch_code = 'ทุกสาขา')
-                ORDER BY branch_code DESC
-                LIMIT 1
-            ''', (emp_data['position'], salary_type, emp_data['zone'], emp_data['branch_code']))
-            
-            rate_data = cursor.fetchone()
+            logger.debug('Searching rate for position=%s, rate_type=%s, salary_type=%s, zone=%s, branch=%s', emp_data['position'], emp_data['piece_rate'], salary_type, emp_data['zone'], emp_data['branch_code'])
+            rate = get_rate_book(conn).resolve(emp_data['position'], salary_type, emp_data['zone'], emp_data['branch_code'])
+            rate_data = rate.row if rate else None
             
             # ถ้าไม่พบเรทสำหรับโซนนั้น แสดงว่าข้อมูลพนักงานตั้งผิด
             if not rate_data:
-                print(f"❌ ERROR: No rate found for employee {employee_id} - position={emp_data['position']}, salary_type={salary_type}, zone={emp_data['zone']}, branch={emp_data['branch_code']}")
-                print(f"   Please check employee data or add corresponding rate in SPT Piece Rates menu")
+                logger.error('❌ No rate found for employee %s - position=%s, salary_type=%s, zone=%s, branch=%s - please check employee data or add corresponding rate in SPT Piece Rates menu', employee_id, emp_data['position'], salary_type, emp_data['zone'], emp_data['branch_code'])
             
             if rate_data:
                 # คำนวณเงินชิ้นตามเรทแต่ละช่วงน้ำหนัก
@@ -1487,23 +3082,8 @@ def api_employee_salary_details(employee_id):
                         weight_ranges[i]['rate'] = 0
                         weight_ranges[i]['amount'] = 0
                 
-                # คำนวณเงินสมทบตาม allowance_tiers
-                allowance = 0
-                if rate_data[13]:  # allowance_tiers (index เปลี่ยนเพราะเพิ่ม weight_range_4)
-                    try:
-                        import json
-                        allowance_tiers = json.loads(rate_data[13]) if isinstance(rate_data[13], str) else rate_data[13]
-                        if allowance_tiers and isinstance(allowance_tiers, list):
-                            # หาเงินสมทบสูงสุดที่ตรงกับจำนวนชิ้น
-                            for tier in allowance_tiers:
-                                if 'pieces' in tier and 'amount' in tier:
-                                    if total_pieces >= tier['pieces']:
-                                        allowance = tier['amount']
-                    except Exception as e:
-                        print(f"❌ Error parsing allowance_tiers: {e}")
-                        allowance = rate_data[2] or 0  # fallback to base allowance
-                else:
-                    allowance = rate_data[2] or 0
+                # คำนวณเงินสมทบตาม allowance_tiers (ขั้นสูงสุดที่ตรงกับจำนวนชิ้น)
+                allowance = rate.allowance_for(total_pieces)
             else:
                 for i in range(10):
                     weight_ranges[i]['rate'] = 0
@@ -1518,9 +3098,9 @@ def api_employee_salary_details(employee_id):
         base_salary_from_rate = rate_data[0] if rate_data else emp_data['base_salary']
         total_salary = base_salary_from_rate + piece_rate_bonus + allowance
         
-        print(f"🔍 DEBUG: weight_ranges for {employee_id}:", weight_ranges)
-        print(f"🔍 DEBUG: weight_ranges type: {type(weight_ranges)}")
-        print(f"🔍 DEBUG: weight_ranges length: {len(weight_ranges) if weight_ranges else 0}")
+        logger.debug('weight_ranges for %s: %s', employee_id, weight_ranges)
+        logger.debug('weight_ranges type: %s', type(weight_ranges))
+        logger.debug('weight_ranges length: %s', len(weight_ranges) if weight_ranges else 0)
         
         result = {
             'employee': emp_data,
@@ -1533,14 +3113,14 @@ def api_employee_salary_details(employee_id):
             'has_rate': True  # เนื่องจากใช้ข้อมูลจาก employee_salary_records โดยตรง
         }
         
-        print(f"🔍 DEBUG: Final result weight_ranges length: {len(result['weight_ranges'])}")
-        print(f"🔍 DEBUG: Final result keys: {list(result.keys())}")
+        logger.debug('Final result weight_ranges length: %s', len(result['weight_ranges']))
+        logger.debug('Final result keys: %s', list(result.keys()))
         
         conn.close()
         return jsonify(result)
         
     except Exception as e:
-        print(f"❌ เกิดข้อผิดพลาดใน api_employee_salary_details: {str(e)}")
+        logger.error('❌ เกิดข้อผิดพลาดใน api_employee_salary_details: %s', e)
         return jsonify({'error': f'เกิดข้อผิดพลาด: {str(e)}'})
 
 @app.route('/api/import-employees', methods=['POST'])
@@ -1552,8 +3132,7 @@ def api_import_employees():
         data = request.get_json()
         employees = data.get('employees', [])
         
-        conn = sqlite3.connect('database/daex_system.db')
-        conn.row_factory = sqlite3.Row
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         success_count = 0
@@ -1607,8 +3186,10 @@ def api_import_employees():
                 success_count += 1
             except Exception as e:
                 error_count += 1
-                print(f"Error processing employee {emp.get('employee_id', 'unknown')}: {str(e)}")
+                log_sampled('employee-import', LOG_SAMPLE_EVERY, logging.ERROR, 'Error processing employee %s: %s', emp.get('employee_id', 'unknown'), e)
         
+        bump_data_version(cursor, 'employees')
+        refresh_payroll_snapshot(cursor, employee_ids=[emp.get('employee_id') for emp in employees])
         conn.commit()
         conn.close()
         
@@ -1628,8 +3209,7 @@ def api_update_employee():
     try:
         data = request.get_json()
         
-        conn = sqlite3.connect('database/daex_system.db')
-        conn.row_factory = sqlite3.Row
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         old_employee_id = data['employee_id']
@@ -1683,6 +3263,8 @@ def api_update_employee():
                 VALUES (?, ?)
             ''', (new_employee_id, data['password']))
         
+        bump_data_version(cursor, 'employees')
+        refresh_payroll_snapshot(cursor, employee_ids=[old_employee_id, new_employee_id])
         conn.commit()
         conn.close()
         
@@ -1697,8 +3279,7 @@ def api_update_employee():
 def api_activate_employee(employee_id):
     """API สำหรับเปิดรหัสพนักงาน"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
-        conn.row_factory = sqlite3.Row
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -1711,6 +3292,7 @@ def api_activate_employee(employee_id):
             conn.close()
             return jsonify({'success': False, 'message': 'ไม่พบพนักงาน'})
         
+        bump_data_version(cursor, 'employees')
         conn.commit()
         conn.close()
         
@@ -1738,6 +3320,7 @@ def api_deactivate_employee(employee_id):
             conn.close()
             return jsonify({'success': False, 'message': 'ไม่พบพนักงาน'})
         
+        bump_data_version(cursor, 'employees')
         conn.commit()
         conn.close()
         
@@ -1750,9 +3333,9 @@ def api_deactivate_employee(employee_id):
 @login_required
 @role_required(['HR', 'GM', 'MD'])
 def api_export_employees():
-    """API สำหรับ Export ข้อมูลพนักงานเป็น Excel"""
+    """API สำหรับ Export ข้อมูลพนักงาน (JSON สำหรับสร้าง Excel ฝั่งหน้าเว็บ หรือ ?format=csv เป็นไฟล์ CSV แบบ streaming)"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # Get all employees with branch names
@@ -1761,25 +3344,27 @@ def api_export_employees():
                         FROM employees e 
             ORDER BY e.name
         ''')
-        employees_data = cursor.fetchall()
         
-        # Convert to list of dictionaries with branch names
-        employees = []
-        for emp in employees_data:
-            branch_name = BRANCHES.get(emp[3], emp[3])  # Get branch name from BRANCHES dict
-            employees.append({
+        def employee_row(emp):
+            return {
                 'employee_id': emp[0],
                 'name': emp[1],
                 'position': emp[2],
                 'branch_code': emp[3],
-                'branch_name': branch_name,
+                'branch_name': BRANCHES.get(emp[3], emp[3]),  # Get branch name from BRANCHES dict
                 'hire_date': emp[4],
                 'phone': emp[5] or '',
                 'email': emp[6] or '',
                 'status': 'เปิดใช้งาน' if emp[7] == 'active' else 'ปิดใช้งาน'
-            })
+            }
         
-            conn.close()
+        if request.args.get('format') == 'csv':
+            return csv_stream_response('employees.csv', [
+                'รหัสพนักงาน', 'ชื่อ', 'ตำแหน่ง', 'รหัสสาขา', 'สาขา', 'วันที่เริ่มงาน', 'เบอร์โทร', 'อีเมล', 'สถานะ'
+            ], iter_cursor_batches(cursor), transform=lambda emp: list(employee_row(emp).values()))
+        
+        # Convert to list of dictionaries with branch names
+        employees = [employee_row(emp) for rows in iter_cursor_batches(cursor) for emp in rows]
         
         return jsonify({
             'success': True, 
@@ -1795,7 +3380,7 @@ def api_export_employees():
 def api_get_employee_password(employee_id):
     """API สำหรับดึงข้อมูลรหัสผ่านของพนักงาน"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # First try to get password from users table with employee_id as username
@@ -1846,7 +3431,7 @@ def api_get_employee_password(employee_id):
             # ถ้าเป็น hash ให้แสดงรหัสผ่านเริ่มต้น
             if password_hash.startswith('scrypt:') or password_hash.startswith('pbkdf2:'):
                 # ตรวจสอบว่ามีรหัสผ่านที่แก้ไขแล้วหรือไม่
-                conn = sqlite3.connect('database/daex_system.db')
+                conn = get_db()
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT plain_password FROM user_passwords WHERE username = ?
@@ -1889,7 +3474,7 @@ def spv_request_employee():
         position = request.form['position']
         reason = request.form['reason']
         
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         try:
             cursor.execute('''
@@ -1923,13 +3508,14 @@ def spv_leave_request():
         end = datetime.strptime(end_date, '%Y-%m-%d')
         days_requested = (end - start).days + 1
         
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         try:
             cursor.execute('''
                 INSERT INTO leave_requests (employee_id, leave_type, start_date, end_date, days_requested, reason)
                 VALUES (?, ?, ?, ?, ?, ?)
             ''', (session.get('username'), leave_type, start_date, end_date, days_requested, reason))
+            bump_data_version(cursor, 'leave_requests')
             conn.commit()
             flash('ส่งคำขอการลาสำเร็จ', 'success')
         except Exception as e:
@@ -1952,7 +3538,7 @@ def spv_expense_request():
         description = request.form['description']
         amount = float(request.form['amount'])
         
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         try:
             cursor.execute('''
@@ -1976,7 +3562,7 @@ def spv_expense_request():
 def spv_branch_employees():
     """หน้ารายชื่อและประวัติพนักงานในสาขา"""
     branch_code = session.get('branch_code')
-    conn = sqlite3.connect('database/daex_system.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -1998,7 +3584,7 @@ def spv_branch_employees():
 def employee_salary():
     """หน้าข้อมูลเงินเดือน"""
     username = session.get('username')
-    conn = sqlite3.connect('database/daex_system.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('SELECT employee_id FROM employees WHERE email = ?', (username,))
@@ -2026,7 +3612,7 @@ def employee_salary():
 def employee_penalties():
     """หน้าค่าปรับ"""
     username = session.get('username')
-    conn = sqlite3.connect('database/daex_system.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('SELECT employee_id FROM employees WHERE email = ?', (username,))
@@ -2054,13 +3640,13 @@ def extract_month_year_from_data(df, found_columns):
         # หาคอลัมน์วันที่
         date_column = found_columns.get('time')
         if not date_column:
-            print("❌ ไม่พบคอลัมน์วันที่ในไฟล์")
+            logger.warning('❌ ไม่พบคอลัมน์วันที่ในไฟล์')
             return None, None
         
         # ตรวจสอบข้อมูลในคอลัมน์วันที่
         date_values = df[date_column].dropna()
         if len(date_values) == 0:
-            print("❌ ไม่พบข้อมูลวันที่ในไฟล์")
+            logger.warning('❌ ไม่พบข้อมูลวันที่ในไฟล์')
             return None, None
         
         # แปลงวันที่เป็น datetime
@@ -2099,29 +3685,129 @@ def extract_month_year_from_data(df, found_columns):
                 if parsed_date:
                     month = parsed_date.month
                     year = parsed_date.year
-                    print(f"✅ อ่านเดือนและปีจากไฟล์: {month}/{year}")
+                    logger.info('✅ อ่านเดือนและปีจากไฟล์: %s/%s', month, year)
                     return month, year
                     
             except Exception as e:
-                print(f"⚠️ ไม่สามารถแปลงวันที่ {date_value}: {e}")
+                log_sampled('upload-date-parse', LOG_SAMPLE_EVERY, logging.WARNING, '⚠️ ไม่สามารถแปลงวันที่ %s: %s', date_value, e)
                 continue
         
-        print("❌ ไม่สามารถอ่านเดือนและปีจากข้อมูลในไฟล์")
+        logger.warning('❌ ไม่สามารถอ่านเดือนและปีจากข้อมูลในไฟล์')
         return None, None
         
     except Exception as e:
-        print(f"❌ เกิดข้อผิดพลาดในการอ่านเดือนและปี: {e}")
+        logger.error('❌ เกิดข้อผิดพลาดในการอ่านเดือนและปี: %s', e)
         return None, None
 
+# ชื่อคอลัมน์ที่รองรับในไฟล์เงินเดือน (ยืดหยุ่นตามรูปแบบไฟล์)
+SALARY_COLUMN_ALIASES = {
+    'awb': ['หมายเลข AWB', 'AWB', 'awb', 'หมายเลขพัสดุ', 'เลขที่ AWB', 'เลข AWB', 'AWB Number'],
+    'branch': ['หมายเลขสาขา การชำระบัญชี', 'สาขา', 'branch', 'หมายเลขสาขา', 'รหัสสาขา', 'Branch Code', 'สาขาการชำระบัญชี'],
+    'weight': ['นํ้าหนักที่ใช้คิดเงิน', 'น้ำหนัก', 'weight', 'น้ำหนักที่ใช้คิดเงิน', 'น้ำหนักรวม', 'Weight', 'น้ำหนักพัสดุ'],
+    'time': ['เวลาที่เซ็นรับพัสดุ', 'เวลา', 'time', 'วันที่', 'Date', 'เวลารับพัสดุ', 'วันที่รับพัสดุ'],
+    'employee_name': ['พนักงานนำจ่าย', 'พนักงาน', 'employee', 'ชื่อพนักงาน', 'Employee Name', 'ชื่อ-นามสกุล'],
+    'employee_id': ['รหัสพนักงาน', 'รหัส', 'employee_id', 'id', 'Employee ID', 'รหัสพนักงานนำจ่าย']
+}
+SALARY_INGEST_CHUNK_ROWS = 50000
+
+def resolve_salary_columns(columns):
+    """จับคู่หัวคอลัมน์ในไฟล์กับ SALARY_COLUMN_ALIASES คืนค่า (found_columns, missing_columns)"""
+    found_columns = {}
+    missing_columns = []
+    
+    for field, possible_names in SALARY_COLUMN_ALIASES.items():
+        for col_name in columns:
+            if col_name in possible_names:
+                found_columns[field] = col_name
+                break
+        else:
+            missing_columns.append(field)
+    
+    return found_columns, missing_columns
+
+def count_csv_rows(file_path):
+    """นับจำนวนแถวข้อมูลใน CSV (ไม่รวมหัวตาราง) โดยอ่านเป็น block ไม่โหลดทั้งไฟล์"""
+    rows = 0
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            rows += block.count(b'\n')
+    return max(rows - 1, 0)
+
+def read_salary_file_chunks(file_path, chunk_rows=None):
+    """อ่านไฟล์เงินเดือนแบบ streaming เฉพาะ 6 คอลัมน์ที่ใช้ ทีละ chunk_rows แถว
+    
+    คืนค่า (found_columns, missing_columns, total_rows, chunks) - total_rows เป็นค่าประมาณ
+    (อาจเป็น None ถ้าไฟล์ไม่ระบุขนาด), chunks เป็น generator ของ DataFrame ที่มีเฉพาะคอลัมน์ใน found_columns
+    """
+    chunk_rows = chunk_rows or SALARY_INGEST_CHUNK_ROWS
+    extension = os.path.splitext(file_path)[1].lower()
+    
+    if extension == '.csv':
+        # CSV: อ่านหัวตารางก่อน แล้วให้ pandas อ่านเฉพาะคอลัมน์ที่ใช้ทีละ chunk
+        header = pd.read_csv(file_path, nrows=0, encoding='utf-8-sig').columns
+        found_columns, missing_columns = resolve_salary_columns(header)
+        if missing_columns:
+            return found_columns, missing_columns, 0, iter(())
+        chunks = pd.read_csv(
+            file_path, usecols=list(found_columns.values()), dtype=str,
+            encoding='utf-8-sig', chunksize=chunk_rows
+        )
+        return found_columns, missing_columns, count_csv_rows(file_path), chunks
+    
+    if extension == '.xls':
+        # .xls (รูปแบบเก่า) ไม่รองรับ read-only - อ่านเฉพาะคอลัมน์ที่ใช้แล้วแบ่งเป็นชุด
+        header = pd.read_excel(file_path, nrows=0).columns
+        found_columns, missing_columns = resolve_salary_columns(header)
+        if missing_columns:
+            return found_columns, missing_columns, 0, iter(())
+        df = pd.read_excel(file_path, usecols=list(found_columns.values()))
+        return found_columns, missing_columns, len(df), iter_dataframe_chunks(df, chunk_rows)
+    
+    # .xlsx: openpyxl read-only อ่านทีละแถวโดยไม่สร้างทั้ง workbook ในหน่วยความจำ
+    from openpyxl import load_workbook
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    sheet = workbook.worksheets[0]
+    rows = sheet.iter_rows(values_only=True)
+    header = next(rows, None) or ()
+    found_columns, missing_columns = resolve_salary_columns(header)
+    if missing_columns:
+        workbook.close()
+        return found_columns, missing_columns, 0, iter(())
+    
+    names = list(found_columns.values())
+    indexes = [header.index(name) for name in names]
+    total_rows = sheet.max_row - 1 if sheet.max_row else None
+    
+    def generate_chunks():
+        try:
+            buffer = []
+            for row in rows:
+                values = [row[i] if i < len(row) else None for i in indexes]
+                if all(value is None for value in row):
+                    continue  # ข้ามแถวว่างทั้งแถว
+                buffer.append(values)
+                if len(buffer) >= chunk_rows:
+                    yield build_salary_chunk(buffer, names)
+                    buffer = []
+            if buffer:
+                yield build_salary_chunk(buffer, names)
+        finally:
+            workbook.close()
+    
+    return found_columns, missing_columns, total_rows, generate_chunks()
+
+def build_salary_chunk(rows, names):
+    """สร้าง DataFrame ของชุดข้อมูล โดยให้ค่าว่างเป็น NaN เหมือน pd.read_excel"""
+    chunk = pd.DataFrame.from_records(rows, columns=names).astype(object)
+    return chunk.where(chunk.notna(), np.nan)
+
+
 @app.route('/api/upload-salary', methods=['POST'])
 @login_required
 @role_required(['GM', 'MD', 'HR', 'การเงิน'])
 def upload_salary():
-    """อัพโหลดข้อมูลเงินเดือน - ใช้ระบบเก่าที่ทำงานได้แล้ว"""
+    """รับไฟล์เงินเดือนเข้าคิว แล้วให้ worker ประมวลผลเบื้องหลัง (ติดตามผลที่ /api/upload-jobs/<id>)"""
     try:
-        print(f"DEBUG: Request files keys: {list(request.files.keys())}")
-        print(f"DEBUG: Request form keys: {list(request.form.keys())}")
-        
         # ตรวจสอบไฟล์จาก key ที่ถูกต้อง
         if 'salary_file' not in request.files:
             return jsonify({'success': False, 'message': 'ไม่พบไฟล์ที่อัพโหลด'})
@@ -2130,70 +3816,40 @@ def upload_salary():
         if file.filename == '':
             return jsonify({'success': False, 'message': 'กรุณาเลือกไฟล์'})
         
-        if not file.filename.endswith(('.xlsx', '.xls')):
-            return jsonify({'success': False, 'message': 'รองรับเฉพาะไฟล์ Excel (.xlsx, .xls)'})
+        if not file.filename.lower().endswith(('.xlsx', '.xls', '.csv')):
+            return jsonify({'success': False, 'message': 'รองรับเฉพาะไฟล์ Excel (.xlsx, .xls) หรือ CSV'})
         
-        # อ่านไฟล์ Excel
+        # เดือนและปีจากฟอร์ม ใช้เมื่ออ่านจากข้อมูลในไฟล์ไม่ได้
         try:
-            df = pd.read_excel(file)
-            print(f"✅ อ่านไฟล์สำเร็จ: {len(df)} แถว, {len(df.columns)} คอลัมน์")
-        except Exception as e:
-            print(f"❌ ไม่สามารถอ่านไฟล์ได้: {str(e)}")
-            return jsonify({'success': False, 'message': f'ไม่สามารถอ่านไฟล์ได้: {str(e)}'})
-        
-        print(f"คอลัมน์ที่พบในไฟล์: {list(df.columns)}")
-        print(f"จำนวนคอลัมน์: {len(df.columns)}")
-        
-        # ตรวจสอบคอลัมน์ที่จำเป็นแบบยืดหยุ่น
-        required_columns = {
-            'awb': ['หมายเลข AWB', 'AWB', 'awb', 'หมายเลขพัสดุ', 'เลขที่ AWB', 'เลข AWB', 'AWB Number'],
-            'branch': ['หมายเลขสาขา การชำระบัญชี', 'สาขา', 'branch', 'หมายเลขสาขา', 'รหัสสาขา', 'Branch Code', 'สาขาการชำระบัญชี'],
-            'weight': ['นํ้าหนักที่ใช้คิดเงิน', 'น้ำหนัก', 'weight', 'น้ำหนักที่ใช้คิดเงิน', 'น้ำหนักรวม', 'Weight', 'น้ำหนักพัสดุ'],
-            'time': ['เวลาที่เซ็นรับพัสดุ', 'เวลา', 'time', 'วันที่', 'Date', 'เวลารับพัสดุ', 'วันที่รับพัสดุ'],
-            'employee_name': ['พนักงานนำจ่าย', 'พนักงาน', 'employee', 'ชื่อพนักงาน', 'Employee Name', 'ชื่อ-นามสกุล'],
-            'employee_id': ['รหัสพนักงาน', 'รหัส', 'employee_id', 'id', 'Employee ID', 'รหัสพนักงานนำจ่าย']
-        }
-        
-        # หาคอลัมน์ที่ตรงกัน
-        found_columns = {}
-        missing_columns = []
-        
-        for field, possible_names in required_columns.items():
-            found = False
-            for col_name in df.columns:
-                if col_name in possible_names:
-                    found_columns[field] = col_name
-                    found = True
-                    break
-            if not found:
-                missing_columns.append(field)
-        
-        if missing_columns:
-            print(f"คอลัมน์ที่ขาดหายไป: {missing_columns}")
-            print(f"คอลัมน์ที่พบ: {found_columns}")
-            return jsonify({
-                'success': False, 
-                'message': f'ไฟล์ไม่ตรงกับรูปแบบที่ต้องการ\nคอลัมน์ที่ขาดหายไป: {missing_columns}\nคอลัมน์ที่พบ: {found_columns}'
-            })
-        
-        # อ่านเดือนและปีจากข้อมูลในไฟล์
-        month, year = extract_month_year_from_data(df, found_columns)
-        
-        # ถ้าไม่สามารถอ่านจากไฟล์ได้ ให้ใช้จากฟอร์ม
-        if month is None or year is None:
-            month = request.form.get('month', 7)
-            year = request.form.get('year', 2025)
-            
-            try:
-                month = int(month)
-                year = int(year)
-            except ValueError:
-                return jsonify({'success': False, 'message': 'เดือนและปีไม่ถูกต้อง'})
+            month = int(request.form.get('month', 7))
+            year = int(request.form.get('year', 2025))
+        except ValueError:
+            return jsonify({'success': False, 'message': 'เดือนและปีไม่ถูกต้อง'})
+        
+        # เก็บไฟล์ไว้ให้ worker อ่าน
+        import uuid
+        os.makedirs(SALARY_JOBS_UPLOAD_DIR, exist_ok=True)
+        extension = os.path.splitext(file.filename)[1].lower()
+        file_path = os.path.join(SALARY_JOBS_UPLOAD_DIR, f'{uuid.uuid4().hex}{extension}')
+        file.save(file_path)
+        
+        conn = get_salary_jobs_connection()
+        cursor = conn.execute('''
+            INSERT INTO salary_upload_jobs (filename, file_path, form_month, form_year, uploaded_by)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (file.filename, file_path, month, year, session.get('username')))
+        job_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
         
-        print(f"📅 อัพโหลดข้อมูลเดือน {month} ปี {year}")
+        start_salary_upload_worker()
+        logger.info('📥 รับไฟล์ %s เข้าคิว (งาน %s)', file.filename, job_id)
         
-        # ใช้ระบบเก่าที่ทำงานได้แล้ว
-        return process_salary_upload_old_system(df, file.filename, found_columns, month, year)
+        return jsonify({
+            'success': True,
+            'message': 'รับไฟล์เรียบร้อยแล้ว กำลังประมวลผล',
+            'job_id': job_id
+        }), 202
         
     except Exception as e:
         return jsonify({'success': False, 'message': f'เกิดข้อผิดพลาด: {str(e)}'})
@@ -2201,7 +3857,7 @@ def upload_salary():
 def sync_monthly_salary_data(batch_id):
     """ซิงค์ข้อมูลจาก employee_salary_records ไปยัง monthly_salary_data"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = connect_db()
         cursor = conn.cursor()
         
         # คำนวณข้อมูลสรุปจาก employee_salary_records
@@ -2246,282 +3902,1035 @@ def sync_monthly_salary_data(batch_id):
         conn.commit()
         conn.close()
         
-        print(f"✅ ซิงค์ข้อมูลสำเร็จ: {len(employee_summary)} พนักงาน")
+        logger.info('✅ ซิงค์ข้อมูลสำเร็จ: %s พนักงาน', len(employee_summary))
         return True
         
     except Exception as e:
-        print(f"❌ เกิดข้อผิดพลาดในการซิงค์ข้อมูล: {str(e)}")
+        logger.error('❌ เกิดข้อผิดพลาดในการซิงค์ข้อมูล: %s', e)
         return False
 
-def process_salary_upload_old_system(df, filename, found_columns, month, year):
-    """ประมวลผลข้อมูลเงินเดือนตามขั้นตอนใหม่ - เชื่อมโยง 4 เมนู"""
+# ==================== สมุดเรท (RateBook) ====================
+
+ALL_BRANCHES = 'ทุกสาขา'
+
+def ensure_data_versions_table(cursor):
+    """สร้างตารางเก็บเลขเวอร์ชันของข้อมูล (ใช้ตรวจว่า cache ในแต่ละ worker ยังใช้ได้หรือไม่)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+def get_data_version(cursor, name):
+    """อ่านเลขเวอร์ชันปัจจุบันของข้อมูล name (0 ถ้ายังไม่เคยแก้ไข)
+    
+    ไม่สร้างตารางในเส้นทางอ่าน เพื่อไม่ให้ request อ่านต้องรอ lock ของการเขียน - ตารางถูกสร้างตอน bump ครั้งแรก
+    """
     try:
-        conn = sqlite3.connect('database/daex_system.db')
-        cursor = conn.cursor()
-        
-        # สร้าง batch_id สำหรับการอัพโหลด
-        import datetime
-        batch_id = f"batch_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        
-        # บันทึกข้อมูลการอัพโหลด
-        cursor.execute('''
-            INSERT INTO salary_uploads 
-            (filename, original_name, month, year, batch_id, uploaded_by, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            filename, filename, 
-            month, year, batch_id, session.get('username'), 
-            datetime.datetime.now()
-        ))
-        
-        upload_id = cursor.lastrowid
-        
-        # เตรียม dict สำหรับสรุปยอด
-        employee_summary = {}
-        
-        # ประมวลผลข้อมูล
-        success_count = 0
-        error_count = 0
-        
-        print("=== เริ่มประมวลผลข้อมูลเงินเดือน ===")
-        print("ขั้นตอนที่ 1: แยกข้อมูลไฟล์ที่อัพโหลด - ว่าพัสดุแต่ละชิ้นอยู่ในช่วงน้ำหนักไหน")
-        
-        # เพิ่มตัวแปรสำหรับเก็บข้อมูลที่ไม่ตรงกับฐานข้อมูลพนักงาน
-        unmatched_records = []
-        unmatched_summary = {
-            'total_pieces': 0,
-            'pieces_by_range': {f'range_{i+1}': 0 for i in range(10)},
-            'amounts_by_range': {f'amount_{i+1}': 0 for i in range(10)}
-        }
-        
-        for index, row in df.iterrows():
+        cursor.execute('SELECT version FROM data_versions WHERE name = ?', (name,))
+    except sqlite3.OperationalError:
+        return 0
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def bump_data_version(cursor, name):
+    """เพิ่มเลขเวอร์ชันของข้อมูล name - เรียกใน transaction เดียวกับการแก้ไขข้อมูล"""
+    ensure_data_versions_table(cursor)
+    cursor.execute('''
+        INSERT INTO data_versions (name, version) VALUES (?, 1)
+        ON CONFLICT(name) DO UPDATE SET version = version + 1
+    ''', (name,))
+
+def get_data_versions(cursor, names):
+    """อ่านเลขเวอร์ชันของข้อมูลหลายชื่อใน query เดียว คืน tuple ตามลำดับ names"""
+    if not names:
+        return ()
+    try:
+        cursor.execute(f'SELECT name, version FROM data_versions WHERE name IN ({", ".join("?" * len(names))})', list(names))
+    except sqlite3.OperationalError:
+        return (0,) * len(names)
+    versions = dict(cursor.fetchall())
+    return tuple(versions.get(name, 0) for name in names)
+
+# ==================== cache ของ response API (GET) ====================
+
+# จำนวน response สูงสุดที่เก็บ และอายุเริ่มต้น (วินาที)
+RESPONSE_CACHE_SIZE = 512
+RESPONSE_CACHE_TTL = 30
+# 'sqlite' = cache ร่วมกันทุก gunicorn worker ผ่านไฟล์ RESPONSE_CACHE_DB, 'memory' = แยกต่อ process
+RESPONSE_CACHE_BACKEND = 'sqlite'
+RESPONSE_CACHE_DB = os.path.join('database', 'response_cache.db')
+# อัปเดตเวลาใช้งานล่าสุด (สำหรับ LRU) ไม่ถี่กว่านี้ต่อรายการ เพื่อไม่ให้ทุก hit ต้องเขียนไฟล์ cache
+RESPONSE_CACHE_TOUCH_SECONDS = 5
+
+class ResponseCache:
+    """cache ของ response ใน process แบบ TTL + LRU
+    
+    แต่ละรายการเก็บเลขเวอร์ชัน (data_versions) ของตารางที่ response นั้นอ่าน
+    ถ้าเวอร์ชันปัจจุบันไม่ตรง (มีการเขียนตารางนั้นแล้ว) ถือว่าหมดอายุทันที
+    """
+    
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+    
+    def get(self, key, versions):
+        """คืน (body, status, mimetype) ที่ยังใช้ได้ หรือ None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            entry_versions, expires_at, response = entry
+            if entry_versions != versions or expires_at <= time.monotonic():
+                del self.entries[key]
+                self.stale += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return response
+    
+    def put(self, key, versions, ttl, response):
+        with self.lock:
+            self.entries[key] = (versions, time.monotonic() + ttl, response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': 'memory',
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0
+            }
+
+class SharedResponseCache:
+    """cache ของ response ที่ใช้ร่วมกันทุก worker บนเครื่องเดียวกัน เก็บในไฟล์ SQLite (WAL) แยกจากฐานข้อมูลหลัก
+    
+    ใช้งานเหมือน ResponseCache - เลขเวอร์ชันยังมาจาก data_versions ในฐานข้อมูลหลัก ซึ่งถูก bump ใน transaction
+    เดียวกับการเขียน การแก้ไขใน worker หนึ่งจึงทำให้รายการของทุก worker หมดอายุพร้อมกันทันทีที่ commit
+    ถ้าไฟล์ cache ใช้งานไม่ได้ชั่วคราว ถือเป็น miss (endpoint คำนวณเองตามปกติ)
+    """
+    
+    def __init__(self, db_path, maxsize):
+        self.db_path = db_path
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.conn = None
+        self.pid = None
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.errors = 0
+    
+    def connection(self):
+        """การเชื่อมต่อไฟล์ cache ของ process นี้ (SQLite ใช้การเชื่อมต่อข้าม fork ไม่ได้ - เปิดใหม่ในแต่ละ worker)"""
+        if self.conn is None or self.pid != os.getpid():
+            conn = connect_db(self.db_path, timeout=2.0, check_same_thread=False, isolation_level=None)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    versions TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    status INTEGER NOT NULL,
+                    mimetype TEXT,
+                    body BLOB
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache (last_used)')
+            self.conn, self.pid = conn, os.getpid()
+        return self.conn
+    
+    @staticmethod
+    def encode(value):
+        return json.dumps(value, ensure_ascii=False, default=str)
+    
+    def get(self, key, versions):
+        """คืน (body, status, mimetype) ที่ยังใช้ได้ หรือ None"""
+        cache_key = self.encode(key)
+        now = time.time()
+        with self.lock:
             try:
-                awb = str(row[found_columns.get('awb', 'หมายเลข AWB')])
-                branch_code = str(row[found_columns.get('branch', 'หมายเลขสาขา การชำระบัญชี')])
-                weight = float(row[found_columns.get('weight', 'นํ้าหนักที่ใช้คิดเงิน')]) if pd.notna(row[found_columns.get('weight', 'นํ้าหนักที่ใช้คิดเงิน')]) else 0
-                receive_time = str(row[found_columns.get('time', 'เวลาที่เซ็นรับพัสดุ')])
-                employee_name = str(row[found_columns.get('employee_name', 'พนักงานนำจ่าย')])
-                employee_id = str(row[found_columns.get('employee_id', 'รหัสพนักงาน')]).strip()
-                
-                # ตรวจสอบว่ารหัสพนักงานถูกต้องหรือไม่
-                if not employee_id or employee_id == 'nan':
-                    print(f"❌ รหัสพนักงานไม่ถูกต้อง: {employee_id}")
-                    error_count += 1
-                    continue
-                
-                # ถ้า employee_id เป็น '0' ให้บันทึกเป็น unmatched record
-                if employee_id == '0':
-                    print(f"⚠️ รหัสพนักงานเป็น 0: {employee_id} - บันทึกเป็น unmatched record")
-                    
-                    # หาช่วงน้ำหนักที่พัสดุนี้อยู่
-                    weight_range_index = None
-                    for i, (min_weight, max_weight) in enumerate(weight_ranges):
-                        if min_weight <= weight <= max_weight:
-                            weight_range_index = i
-                            break
-                    
-                    if weight_range_index is None:
-                        weight_range_index = 9
-                    
-                    range_name = f"{weight_ranges[weight_range_index][0]}-{weight_ranges[weight_range_index][1] if weight_ranges[weight_range_index][1] != float('inf') else '15+'}"
-                    
-                    # บันทึกข้อมูลที่ไม่ตรงกับฐานข้อมูล
-                    unmatched_record = {
-                        'employee_id': employee_id,
-                        'employee_name': employee_name,
-                        'awb': awb,
-                        'branch_code': branch_code,
-                        'weight': weight,
-                        'receive_time': receive_time,
-                        'weight_range_index': weight_range_index,
-                        'range_name': range_name
-                    }
-                    unmatched_records.append(unmatched_record)
-                    
-                    # อัปเดตสรุปข้อมูลที่ไม่ตรง
-                    unmatched_summary['total_pieces'] += 1
-                    unmatched_summary['pieces_by_range'][f'range_{weight_range_index + 1}'] += 1
-                    
-                    error_count += 1
-                    continue
-                
-                # ตรวจสอบว่ารหัสพนักงานมีรูปแบบถูกต้อง
-                if not employee_id or len(employee_id) < 5:
-                    print(f"❌ รหัสพนักงานสั้นเกินไป: {employee_id}")
-                    error_count += 1
-                    continue
-                
-                # ขั้นตอนที่ 1: แยกข้อมูลพัสดุแต่ละชิ้นตามช่วงน้ำหนัก
-                # ปรับช่วงน้ำหนักให้รองรับทุกน้ำหนัก
-                weight_ranges = [
-                    (0.00, 0.50), (0.51, 1.00), (1.01, 1.50), (1.51, 2.00), (2.01, 2.50),
-                    (2.51, 3.00), (3.01, 5.00), (5.01, 10.00), (10.01, 15.00), (15.00, float('inf'))
-                ]
-                
-                # หาช่วงน้ำหนักที่พัสดุนี้อยู่
-                weight_range_index = None
-                for i, (min_weight, max_weight) in enumerate(weight_ranges):
-                    if min_weight <= weight <= max_weight:  # เปลี่ยนจาก < เป็น <=
-                        weight_range_index = i
-                        break
-                
-                # ถ้าไม่พบช่วงน้ำหนัก ให้ใช้ช่วงสุดท้าย (15+ KG)
-                if weight_range_index is None:
-                    weight_range_index = 9  # ช่วงสุดท้าย
-                    print(f"⚠️ น้ำหนัก {weight} ไม่อยู่ในช่วงที่กำหนด ใช้ช่วงสุดท้าย (15+ KG)")
-                
-                range_name = f"{weight_ranges[weight_range_index][0]}-{weight_ranges[weight_range_index][1] if weight_ranges[weight_range_index][1] != float('inf') else '15+'}"
-                print(f"📦 AWB {awb}: น้ำหนัก {weight}กก. → ช่วง {range_name} (ช่วงที่ {weight_range_index + 1})")
-                
-                # ขั้นตอนที่ 2: มองหารหัสพนักงานที่ตรงกันในฐานข้อมูลพนักงาน
-                print(f"🔍 ขั้นตอนที่ 2: ค้นหาพนักงาน {employee_id} ในฐานข้อมูล")
-                cursor.execute("""
-                    SELECT position, branch_code, zone, employment_type, rate_type, base_salary 
-                    FROM employees 
-                    WHERE employee_id = ?
-                """, (employee_id,))
-                
-                emp = cursor.fetchone()
-                if not emp:
-                    print(f"❌ ไม่พบข้อมูลพนักงาน {employee_id} ในฐานข้อมูล")
-                    
-                    # เก็บข้อมูลที่ไม่ตรงกับฐานข้อมูล
-                    unmatched_record = {
-                        'employee_id': employee_id,
-                        'employee_name': employee_name,
-                        'awb': awb,
-                        'branch_code': branch_code,
-                        'weight': weight,
-                        'receive_time': receive_time,
-                        'weight_range_index': weight_range_index,
-                        'range_name': range_name
-                    }
-                    unmatched_records.append(unmatched_record)
-                    
-                    # อัปเดตสรุปข้อมูลที่ไม่ตรง
-                    unmatched_summary['total_pieces'] += 1
-                    unmatched_summary['pieces_by_range'][f'range_{weight_range_index + 1}'] += 1
-                    
-                    error_count += 1
-                    continue
-                
-                position, emp_branch_code, zone, emp_type, rate_type, base_salary = emp
-                print(f"✅ พบพนักงาน: {employee_id} - ตำแหน่ง: {position}, สาขา: {emp_branch_code}, โซน: {zone}")
-                
-                # ขั้นตอนที่ 3: จับคู่เรทระหว่างฐานข้อมูลพนักงานและเมนูการจัดการเรทพนักงาน
-                print(f"💰 ขั้นตอนที่ 3: จับคู่เรท - ตำแหน่ง: {position}, โซน: {zone}, สาขา: {emp_branch_code}")
-                
-                # ค้นหาเรทจาก piece_rates ตามตำแหน่ง โซน สาขา
-                cursor.execute("""
-                    SELECT base_salary, piece_rate_bonus, allowance,
-                           weight_range_1, weight_range_2, weight_range_3, weight_range_4, weight_range_5,
-                           weight_range_6, weight_range_7, weight_range_8, weight_range_9, weight_range_10
-                    FROM piece_rates 
-                    WHERE position = ? AND zone = ? AND (branch_code = ? OR branch_code = 'ทุกสาขา')
-                    ORDER BY branch_code DESC
-                    LIMIT 1
-                """, (position, zone, emp_branch_code))
-                
-                piece_rate_data = cursor.fetchone()
-                if not piece_rate_data:
-                    print(f"❌ ไม่พบเรทสำหรับ {position} - โซน {zone} - สาขา {emp_branch_code}")
-                    error_count += 1
-                    continue
-                
-                base_salary_rate, piece_rate_bonus, allowance = piece_rate_data[0:3]
-                weight_ranges_rates = piece_rate_data[3:13]  # เรทตามช่วงน้ำหนัก
-                
-                # หาเรทที่เหมาะสมตามน้ำหนักของพัสดุนี้
-                piece_rate_per_package = weight_ranges_rates[weight_range_index]
-                print(f"✅ เรทที่ใช้: {piece_rate_per_package} บาท/ชิ้น (ช่วงที่ {weight_range_index + 1})")
-                
-                # คำนวณค่าจ้างตามประเภทการจ้าง
-                if emp_type == 'piece_rate':
-                    amount = piece_rate_per_package  # ค่าชิ้นต่อชิ้น
-                    # สำหรับ employee_salary_records: บันทึกเฉพาะเรทต่อชิ้น
-                    record_amount = piece_rate_per_package
-                else:
-                    amount = base_salary_rate
-                    record_amount = base_salary_rate
-                
-                print(f"💰 คำนวณ: เรทต่อชิ้น {piece_rate_per_package} บาท")
-                
-                # สร้าง work_month จากเดือนและปีที่ถูกต้อง
-                work_month = f"{year:04d}-{month:02d}"
-                
-                # บันทึกข้อมูลรายละเอียด (เฉพาะเรทต่อชิ้น)
-                cursor.execute('''
-                    INSERT INTO employee_salary_records 
-                    (employee_id, awb_number, branch_code, weight, receive_time, close_date, work_month, total_pieces, total_amount, upload_batch_id)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    employee_id, awb, branch_code, weight, receive_time,
-                    f'{year:04d}-{month:02d}-31', work_month, 1, record_amount, batch_id
-                ))
-                
-                # รวมยอดสำหรับสรุป
-                if employee_id not in employee_summary:
-                    employee_summary[employee_id] = {
-                        'total_piece_amount': 0,  # รวมเรทต่อชิ้น
-                        'total_pieces': 0,
-                        'base_salary': base_salary_rate,
-                        'allowance': allowance,
-                        'position': position,
-                        'branch_code': emp_branch_code,
-                        'zone': zone,
-                        'employment_type': emp_type,
-                        'pieces_by_range': {f'range_{i+1}': 0 for i in range(10)},
-                        'amounts_by_range': {f'amount_{i+1}': 0 for i in range(10)},
-                        'rates_by_range': {f'rate_{i+1}': weight_ranges_rates[i] for i in range(10)}
-                    }
-                
-                employee_summary[employee_id]['total_piece_amount'] += piece_rate_per_package
-                employee_summary[employee_id]['total_pieces'] += 1
-                
-                # รวมจำนวนชิ้นและเงินในแต่ละช่วง
-                for i in range(10):
-                    range_key = f'range_{i+1}'
-                    amount_key = f'amount_{i+1}'
-                    if i == weight_range_index:
-                        employee_summary[employee_id]['pieces_by_range'][range_key] += 1
-                        employee_summary[employee_id]['amounts_by_range'][amount_key] += piece_rate_per_package
-                    else:
-                        employee_summary[employee_id]['pieces_by_range'][range_key] += 0
-                        employee_summary[employee_id]['amounts_by_range'][amount_key] += 0
-                
-                success_count += 1
-                
-            except Exception as e:
-                error_count += 1
-                print(f"❌ Error processing row {index}: {str(e)}")
-                continue
+                conn = self.connection()
+                row = conn.execute('''
+                    SELECT versions, expires_at, last_used, status, mimetype, body
+                    FROM response_cache WHERE cache_key = ?
+                ''', (cache_key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                entry_versions, expires_at, last_used, status, mimetype, body = row
+                if entry_versions != self.encode(versions) or expires_at <= now:
+                    conn.execute('DELETE FROM response_cache WHERE cache_key = ? AND versions = ?', (cache_key, entry_versions))
+                    self.stale += 1
+                    self.misses += 1
+                    return None
+                if now - last_used >= RESPONSE_CACHE_TOUCH_SECONDS:
+                    conn.execute('UPDATE response_cache SET last_used = ? WHERE cache_key = ?', (now, cache_key))
+                self.hits += 1
+                return body, status, mimetype
+            except sqlite3.Error as e:
+                self.errors += 1
+                self.misses += 1
+                logger.warning('⚠️ อ่าน response cache ไม่สำเร็จ: %s', e)
+                return None
+    
+    def put(self, key, versions, ttl, response):
+        body, status, mimetype = response
+        now = time.time()
+        with self.lock:
+            try:
+                conn = self.connection()
+                conn.execute('''
+                    INSERT OR REPLACE INTO response_cache (cache_key, versions, expires_at, last_used, status, mimetype, body)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (self.encode(key), self.encode(versions), now + ttl, now, status, mimetype, body))
+                if conn.execute('SELECT COUNT(*) FROM response_cache').fetchone()[0] > self.maxsize:
+                    # ทิ้งรายการที่หมดอายุก่อน แล้วจึงทิ้งรายการที่ไม่ได้ใช้นานที่สุดจนเหลือ maxsize
+                    conn.execute('DELETE FROM response_cache WHERE expires_at <= ?', (now,))
+                    evicted = conn.execute('''
+                        DELETE FROM response_cache WHERE cache_key IN (
+                            SELECT cache_key FROM response_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                        )
+                    ''', (self.maxsize,)).rowcount
+                    self.evictions += max(evicted, 0)
+            except sqlite3.Error as e:
+                self.errors += 1
+                logger.warning('⚠️ บันทึก response cache ไม่สำเร็จ: %s', e)
+    
+    def clear(self):
+        with self.lock:
+            self.connection().execute('DELETE FROM response_cache')
+    
+    def stats(self):
+        with self.lock:
+            try:
+                size = self.connection().execute('SELECT COUNT(*) FROM response_cache').fetchone()[0]
+            except sqlite3.Error:
+                size = None
+            lookups = self.hits + self.misses
+            return {
+                'backend': 'sqlite',
+                'size': size,
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'evictions': self.evictions,
+                'errors': self.errors,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0
+            }
+
+def create_response_cache():
+    """สร้าง response cache ตาม RESPONSE_CACHE_BACKEND - ถ้าเปิดไฟล์ cache ไม่ได้ใช้ cache ใน process แทน"""
+    if RESPONSE_CACHE_BACKEND == 'sqlite':
+        cache = SharedResponseCache(RESPONSE_CACHE_DB, RESPONSE_CACHE_SIZE)
+        try:
+            cache.connection()
+            return cache
+        except sqlite3.Error as e:
+            logger.warning('⚠️ ใช้ response cache ร่วมระหว่าง worker ไม่ได้ (%s) - ใช้ cache แยกต่อ process แทน', e)
+    return ResponseCache(RESPONSE_CACHE_SIZE)
+
+_response_cache = create_response_cache()
+
+def cached_response(tables=(), ttl=RESPONSE_CACHE_TTL):
+    """decorator สำหรับ GET API ที่อ่านอย่างเดียว - เก็บ response ไว้ตาม route, arguments, role และสาขาของผู้ใช้
+    
+    tables: ชื่อใน data_versions ที่ response อ่าน - endpoint ที่เขียนตารางเหล่านี้ต้องเรียก bump_data_version
+    ใช้ต่อจาก login_required/role_required เสมอ เพื่อให้ตรวจสิทธิ์ก่อนอ่าน cache
+    """
+    tables = tuple(tables)
+    
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method != 'GET':
+                return f(*args, **kwargs)
+            
+            key = (
+                request.endpoint,
+                tuple(sorted(kwargs.items())),
+                tuple(sorted(request.args.items(multi=True))),
+                session.get('user_role'),
+                session.get('branch_code')
+            )
+            versions = get_data_versions(get_db().cursor(), tables) if tables else ()
+            cached = _response_cache.get(key, versions)
+            metrics.inc('daex_response_cache_requests_total', endpoint=request.endpoint, result='miss' if cached is None else 'hit')
+            if cached is not None:
+                body, status, mimetype = cached
+                response = app.response_class(body, status=status, mimetype=mimetype)
+                response.headers['X-Cache'] = 'HIT'
+                return response
+            
+            response = make_response(f(*args, **kwargs))
+            # เก็บเฉพาะผลที่สำเร็จ (บาง endpoint ตอบ error ด้วย status 200 และ success: false)
+            payload = response.get_json(silent=True) if response.is_json else None
+            if response.status_code == 200 and not (isinstance(payload, dict) and payload.get('success') is False):
+                _response_cache.put(key, versions, ttl, (response.get_data(), response.status_code, response.mimetype))
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return decorated_function
+    return decorator
+
+@app.route('/api/cache/stats')
+@login_required
+@role_required(['GM', 'MD'])
+def api_cache_stats():
+    """สถิติของ response cache ใน worker นี้ (ใช้ปรับ TTL/ขนาด cache)"""
+    return jsonify({'success': True, 'pid': os.getpid(), 'response_cache': _response_cache.stats()})
+
+def salary_upload_job_counts():
+    """จำนวนงานอัพโหลดเงินเดือนที่รอ (queued) และกำลังประมวลผล (running)"""
+    counts = {'queued': 0, 'running': 0}
+    conn = get_salary_jobs_connection()
+    try:
+        for row in conn.execute("""
+            SELECT status, COUNT(*) FROM salary_upload_jobs WHERE status IN ('queued', 'running') GROUP BY status
+        """):
+            counts[row[0]] = row[1]
+    finally:
+        conn.close()
+    return counts
+
+def is_loopback_address(address):
+    """address (จาก request.remote_addr) เป็น 127.0.0.0/8 หรือ ::1 หรือไม่ - รวมรูปแบบ ::ffff:127.0.0.1"""
+    try:
+        ip = ipaddress.ip_address(address or '')
+    except ValueError:
+        return False
+    return (getattr(ip, 'ipv4_mapped', None) or ip).is_loopback
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """metrics รวมของทุก worker ในรูปแบบข้อความของ Prometheus
+    
+    ไม่ต้องล็อกอิน แต่ต้องส่ง METRICS_TOKEN ถ้าตั้งไว้ ไม่เช่นนั้นรับเฉพาะ loopback (เว้นแต่ตั้ง METRICS_PUBLIC=1)
+    """
+    if METRICS_TOKEN:
+        if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {METRICS_TOKEN}'.encode()):
+            return Response('unauthorized\n', status=401, mimetype='text/plain')
+    elif not METRICS_PUBLIC and not is_loopback_address(request.remote_addr):
+        return Response('forbidden: set METRICS_TOKEN or METRICS_PUBLIC=1\n', status=403, mimetype='text/plain')
+    try:
+        samples = metrics.collect()
+        for status, count in salary_upload_job_counts().items():
+            samples.append(('gauge', 'daex_salary_upload_jobs', {'status': status}, count))
+    except sqlite3.Error as e:
+        logger.error('❌ อ่าน metrics ไม่สำเร็จ: %s', e)
+        return Response(f'# error: {e}\n', status=500, mimetype='text/plain')
+    return Response(render_prometheus_metrics(samples), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/profiler', methods=['GET', 'POST'])
+@login_required
+@role_required(['GM'])
+def api_profiler():
+    """เปิด sampling profiler ใน worker นี้ (POST) หรือดูสถานะและรายการ profile ที่บันทึกไว้ (GET)
+    
+    POST รับ JSON อย่างใดอย่างหนึ่ง:
+      {"seconds": N}                         เก็บทุก request ของ worker นี้เป็นเวลา N วินาที
+      {"route": "/api/...", "requests": K}   เก็บ K request ถัดไปของ route (path, rule หรือชื่อ endpoint)
+      {"target": "salary_upload"}            เก็บงานอัพโหลดเงินเดือนงานถัดไปทั้งงาน
+    และ interval_ms (ค่าเริ่มต้น 5) - ผลเป็นไฟล์ collapsed stacks ดาวน์โหลดที่ /api/profiler/profiles/<name>
+    """
+    try:
+        if request.method == 'GET':
+            profiles = []
+            if os.path.isdir(PROFILES_DIR):
+                for name in sorted(os.listdir(PROFILES_DIR), reverse=True):
+                    if PROFILE_NAME_PATTERN.match(name):
+                        stat = os.stat(os.path.join(PROFILES_DIR, name))
+                        profiles.append({
+                            'name': name,
+                            'size': stat.st_size,
+                            'modified': datetime.fromtimestamp(stat.st_mtime).isoformat(timespec='seconds')
+                        })
+            active = _profiler_session
+            return jsonify({
+                'success': True,
+                'pid': os.getpid(),
+                'active': active.describe() if active else None,
+                'salary_upload_armed': os.path.exists(PROFILER_SALARY_UPLOAD_FLAG),
+                'profiles': profiles
+            })
+        
+        data = request.get_json(silent=True) or {}
+        interval_ms = min(max(float(data.get('interval_ms', PROFILER_INTERVAL_MS)), 1), 1000)
+        
+        if data.get('target') == 'salary_upload':
+            os.makedirs(PROFILES_DIR, exist_ok=True)
+            with open(PROFILER_SALARY_UPLOAD_FLAG, 'w', encoding='utf-8') as f:
+                json.dump({'interval_ms': interval_ms, 'seconds': PROFILER_MAX_SECONDS}, f)
+            return jsonify({'success': True, 'pid': os.getpid(), 'message': 'จะเก็บ profile ของงานอัพโหลดเงินเดือนงานถัดไป'})
+        
+        if data.get('route'):
+            requests_count = int(data.get('requests', 1))
+            if not 1 <= requests_count <= PROFILER_MAX_REQUESTS:
+                return jsonify({'success': False, 'message': f'requests ต้องอยู่ระหว่าง 1-{PROFILER_MAX_REQUESTS}'}), 400
+            session_ = ProfilerSession('requests', f'{data["route"]}-x{requests_count}', route=data['route'],
+                                       requests=requests_count, interval_ms=interval_ms)
+        elif data.get('seconds'):
+            seconds = float(data['seconds'])
+            if not 0 < seconds <= PROFILER_MAX_SECONDS:
+                return jsonify({'success': False, 'message': f'seconds ต้องอยู่ระหว่าง 1-{PROFILER_MAX_SECONDS}'}), 400
+            session_ = ProfilerSession('seconds', f'{seconds:g}s', seconds=seconds, interval_ms=interval_ms)
+        else:
+            return jsonify({'success': False, 'message': 'ต้องระบุ seconds, route หรือ target'}), 400
+        
+        if not start_profiler_session(session_):
+            return jsonify({'success': False, 'message': 'worker นี้กำลังเก็บ profile อยู่แล้ว'}), 409
+        return jsonify({'success': True, 'pid': os.getpid(), 'profile': session_.describe()})
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'message': f'ค่าที่ส่งมาไม่ถูกต้อง: {str(e)}'}), 400
+    except Exception as e:
+        logger.exception('Error in api_profiler: %s', e)
+        return jsonify({'success': False, 'message': f'เกิดข้อผิดพลาด: {str(e)}'}), 500
+
+@app.route('/api/profiler/stop', methods=['POST'])
+@login_required
+@role_required(['GM'])
+def api_profiler_stop():
+    """หยุด profile ที่กำลังเก็บใน worker นี้และบันทึกผลทันที"""
+    session_ = _profiler_session
+    if session_ is None:
+        return jsonify({'success': False, 'message': 'worker นี้ไม่ได้เก็บ profile อยู่'}), 404
+    session_.stop()
+    return jsonify({'success': True, 'pid': os.getpid(), 'profile': session_.describe()})
+
+@app.route('/api/profiler/profiles/<name>')
+@login_required
+@role_required(['GM'])
+def api_profiler_profile(name):
+    """ดาวน์โหลดไฟล์ profile (collapsed stacks: 'frame;frame;frame count' ต่อบรรทัด)"""
+    path = os.path.join(PROFILES_DIR, name)
+    if not PROFILE_NAME_PATTERN.match(name) or not os.path.exists(path):
+        return jsonify({'success': False, 'message': 'ไม่พบไฟล์ profile'}), 404
+    return send_file(os.path.abspath(path), mimetype='text/plain', as_attachment=request.args.get('download') == '1', download_name=name)
+
+@app.route('/api/metrics/slow-queries')
+@login_required
+@role_required(['GM', 'MD'])
+def api_slow_query_metrics():
+    """slow query ที่พบใน worker นี้พร้อม EXPLAIN QUERY PLAN (?reset=1 เพื่อล้างตาราง)"""
+    queries = _slow_query_log.summary()
+    if request.args.get('reset') == '1':
+        _slow_query_log.clear()
+    return jsonify({
+        'success': True,
+        'pid': os.getpid(),
+        'threshold_ms': SLOW_QUERY_MS,
+        'log_file': SLOW_QUERY_LOG,
+        'queries': queries
+    })
+
+@app.route('/api/metrics/routes')
+@login_required
+@role_required(['GM', 'MD'])
+def api_route_metrics():
+    """เวลาตอบสนอง p50/p95/p99 และสถิติ SQL ต่อ route ใน worker นี้ (?reset=1 เพื่อเริ่มนับใหม่)"""
+    routes = _route_timings.summary()
+    started_at = _route_timings.started_at
+    if request.args.get('reset') == '1':
+        _route_timings.clear()
+    return jsonify({
+        'success': True,
+        'pid': os.getpid(),
+        'since': started_at,
+        'window': _route_timings.window,
+        'n_plus_one_threshold': N_PLUS_ONE_THRESHOLD,
+        'routes': routes
+    })
+
+# รูปแบบ key ของขั้นเงินสมทบที่รองรับ: (key จำนวนชิ้นขั้นต่ำ, key เงินสมทบ)
+ALLOWANCE_TIER_KEYS = (('pieces', 'amount'), ('min_pieces', 'allowance'), ('min_packages', 'bonus'))
+
+class AllowanceTierTable:
+    """ขั้นเงินสมทบที่แปลงไว้แล้ว: เกณฑ์จำนวนชิ้นเรียงจากน้อยไปมาก (ไม่ซ้ำ) พร้อมเงินสมทบของแต่ละขั้น
+    
+    เก็บในคอลัมน์ piece_rates.allowance_tier_table เป็น JSON [[เกณฑ์, เงินสมทบ], ...] - หาขั้นด้วย binary search
+    """
+    __slots__ = ('thresholds', 'amounts')
+    
+    def __init__(self, steps=()):
+        self.thresholds = [float(threshold) for threshold, _ in steps]
+        self.amounts = [float(amount) for _, amount in steps]
+    
+    def __bool__(self):
+        return bool(self.thresholds)
+    
+    def __len__(self):
+        return len(self.thresholds)
+    
+    @classmethod
+    def unpack(cls, packed):
+        """สร้างจากค่าในคอลัมน์ allowance_tier_table"""
+        return cls(json.loads(packed) if packed else ())
+    
+    def pack(self):
+        """ค่าที่บันทึกลงคอลัมน์ allowance_tier_table"""
+        return json.dumps([[threshold, amount] for threshold, amount in zip(self.thresholds, self.amounts)])
+    
+    def lookup(self, pieces):
+        """เงินสมทบของขั้นสูงสุดที่จำนวนชิ้นถึงเกณฑ์ หรือ None ถ้าไม่ถึงขั้นใดเลย"""
+        step = bisect.bisect_right(self.thresholds, pieces)
+        return self.amounts[step - 1] if step else None
+
+def compile_allowance_tiers(raw_tiers):
+    """ตรวจสอบและแปลง allowance_tiers (JSON) เป็น AllowanceTierTable คืนค่า (table, ข้อความผิดพลาด)
+    
+    รองรับ key ตาม ALLOWANCE_TIER_KEYS (pieces/amount, min_pieces/allowance และ min_packages/bonus)
+    ขั้นที่อยู่ท้ายรายการชนะขั้นก่อนหน้าเมื่อถึงเกณฑ์ (เหมือนการวนทุกขั้นแบบเดิม) จึงเก็บเฉพาะขั้นที่เกณฑ์ต่ำกว่าทุกขั้นที่อยู่หลังมัน
+    ขั้นที่ไม่มี key ที่รู้จักหรือค่าไม่ถูกต้องถูกข้ามไป (log ไว้) และยังใช้ขั้นอื่นที่ถูกต้อง
+    ถ้าทั้งค่าไม่ใช่รายการ JSON คืนค่า (None, ข้อความผิดพลาด)
+    """
+    if not raw_tiers:
+        return AllowanceTierTable(), None
+    try:
+        tier_list = json.loads(raw_tiers) if isinstance(raw_tiers, str) else raw_tiers
+    except ValueError:
+        return None, 'allowance_tiers ไม่ใช่ JSON ที่ถูกต้อง'
+    if not isinstance(tier_list, list):
+        return None, 'allowance_tiers ต้องเป็นรายการ (list) ของขั้นเงินสมทบ'
+    
+    parsed = []
+    for number, tier in enumerate(tier_list, 1):
+        keys = next((pair for pair in ALLOWANCE_TIER_KEYS
+                     if isinstance(tier, dict) and pair[0] in tier and pair[1] in tier), None)
+        if keys is None:
+            log_sampled('allowance-tier-skipped', LOG_SAMPLE_EVERY, logging.WARNING,
+                        '⚠️ ข้ามขั้นเงินสมทบที่ %s: ต้องมี pieces และ amount (%s)', number, tier)
+            continue
+        try:
+            threshold, amount = float(tier[keys[0]]), float(tier[keys[1]])
+        except (ValueError, TypeError):
+            log_sampled('allowance-tier-skipped', LOG_SAMPLE_EVERY, logging.WARNING,
+                        '⚠️ ข้ามขั้นเงินสมทบที่ %s: มีค่าที่ไม่ใช่ตัวเลข (%s)', number, tier)
+            continue
+        if not (np.isfinite(threshold) and np.isfinite(amount)) or threshold < 0 or amount < 0:
+            log_sampled('allowance-tier-skipped', LOG_SAMPLE_EVERY, logging.WARNING,
+                        '⚠️ ข้ามขั้นเงินสมทบที่ %s: ต้องเป็นตัวเลขที่ไม่ติดลบ (%s)', number, tier)
+            continue
+        parsed.append((threshold, amount))
+    
+    steps = []
+    lowest_later = float('inf')
+    for threshold, amount in reversed(parsed):
+        if threshold < lowest_later:
+            steps.append((threshold, amount))
+            lowest_later = threshold
+    steps.reverse()
+    return AllowanceTierTable(steps), None
+
+def allowance_tier_table(allowance_tiers):
+    """AllowanceTierTable จาก allowance_tiers ทุกรูปแบบที่ผู้คำนวณเงินเดือนได้รับ (table ที่แปลงแล้ว, JSON หรือ list)
+    
+    ค่าที่แปลงไม่ได้ทั้งรายการคืน table ว่าง (ใช้ allowance ของเรท)
+    """
+    if isinstance(allowance_tiers, AllowanceTierTable):
+        return allowance_tiers
+    table, error = compile_allowance_tiers(allowance_tiers)
+    if error:
+        log_sampled('allowance-tiers-parse', LOG_SAMPLE_EVERY, logging.WARNING, '⚠️ ไม่ใช้ขั้นเงินสมทบ: %s', error)
+    return table or AllowanceTierTable()
+
+class RateEntry:
+    """เรท 1 แถวจาก piece_rates พร้อมขั้นเงินสมทบที่แปลงไว้แล้ว (allowance_tier_table)"""
+    
+    def __init__(self, row):
+        self.id = row['id']
+        self.position = row['position']
+        self.zone = row['zone']
+        self.branch_code = row['branch_code']
+        self.salary_type = row['salary_type']
+        self.base_salary = float(row['base_salary'] or 0)
+        self.piece_rate_bonus = float(row['piece_rate_bonus'] or 0)
+        self.allowance = float(row['allowance'] or 0)
+        self.weight_ranges = [float(row[f'weight_range_{i+1}'] or 0) for i in range(10)]
+        self.allowance_tiers_raw = row['allowance_tiers']
+        if row['allowance_tier_table'] is not None:
+            self.tiers = AllowanceTierTable.unpack(row['allowance_tier_table'])
+        else:
+            # แถวที่ allowance_tiers ไม่ถูกต้อง (บันทึกก่อนมีการตรวจสอบ) ไม่มีขั้นเงินสมทบ
+            self.tiers = compile_allowance_tiers(self.allowance_tiers_raw)[0] or AllowanceTierTable()
+        
+        # รูปแบบ tuple เดียวกับที่ calculate_salary_unified ใช้ (allowance_tiers เป็น AllowanceTierTable)
+        self.row = (
+            self.base_salary, self.piece_rate_bonus, self.allowance,
+            *self.weight_ranges,
+            self.tiers
+        )
+    
+    @property
+    def key(self):
+        return (self.position, self.salary_type, self.zone, self.branch_code)
+    
+    def tier_allowance(self, pieces):
+        """เงินสมทบตามขั้นจำนวนชิ้น (ขั้นสูงสุดที่ถึงเกณฑ์) หรือ None ถ้าไม่ถึงขั้นใดเลย"""
+        return self.tiers.lookup(pieces)
+    
+    def allowance_for(self, pieces):
+        """เงินสมทบที่ใช้จริง: ตามขั้นจำนวนชิ้นถ้ามี ไม่เช่นนั้นใช้ allowance ของเรท"""
+        amount = self.tier_allowance(pieces)
+        return self.allowance if amount is None else amount
+
+class RateBook:
+    """เรททั้งตาราง piece_rates ในหน่วยความจำ คีย์ (position, salary_type, zone, branch_code)
+    
+    ลำดับการค้นหา: สาขาเฉพาะ -> 'ทุกสาขา' -> เรทโซน 'ทุกสาขา' ของสาขานั้น -> เรทโซน/สาขา 'ทุกสาขา'
+    """
+    
+    def __init__(self, rows, version):
+        self.version = version
+        self.by_id = {}
+        self.by_key = {}
+        for row in rows:
+            entry = RateEntry(row)
+            self.by_id[entry.id] = entry
+            self.by_key.setdefault(entry.key, entry)
+    
+    def resolve(self, position, salary_type, zone, branch_code):
+        """หาเรทของพนักงาน คืนค่า RateEntry หรือ None"""
+        by_key = self.by_key
+        return (
+            by_key.get((position, salary_type, zone, branch_code)) or
+            by_key.get((position, salary_type, zone, ALL_BRANCHES)) or
+            by_key.get((position, salary_type, ALL_BRANCHES, branch_code)) or
+            by_key.get((position, salary_type, ALL_BRANCHES, ALL_BRANCHES))
+        )
+
+_rate_book = None
+
+def get_rate_book(conn):
+    """คืน RateBook ของ process นี้ - โหลดใหม่เฉพาะเมื่อเวอร์ชัน piece_rates เปลี่ยน"""
+    global _rate_book
+    cursor = conn.cursor()
+    version = get_data_version(cursor, 'piece_rates')
+    if _rate_book is None or _rate_book.version != version:
+        # allowance_tier_table มาจาก migration 4 - migration ก่อนหน้าที่คำนวณเงินเดือนยังไม่มีคอลัมน์นี้
+        cursor.execute("PRAGMA table_info(piece_rates)")
+        has_tier_table = 'allowance_tier_table' in [col[1] for col in cursor.fetchall()]
+        cursor.execute(f'''
+            SELECT id, position, zone, branch_code, salary_type, base_salary, piece_rate_bonus, allowance,
+                   {', '.join(f'weight_range_{i+1}' for i in range(10))}, allowance_tiers,
+                   {'allowance_tier_table' if has_tier_table else 'NULL AS allowance_tier_table'}
+            FROM piece_rates
+            ORDER BY id
+        ''')
+        columns = [col[0] for col in cursor.description]
+        rate_book = RateBook([dict(zip(columns, row)) for row in cursor.fetchall()], version)
+        # ไม่เก็บ RateBook ที่อ่านระหว่าง transaction เขียน - อาจเห็นเรทที่ยังไม่ commit ซึ่งอาจถูก rollback
+        if conn.in_transaction:
+            return rate_book
+        _rate_book = rate_book
+    return _rate_book
+
+# ==================== สรุปเงินเดือนรายเดือนที่คำนวณไว้แล้ว (payroll snapshot) ====================
+
+def ensure_payroll_snapshot_tables(cursor):
+    """สร้างตาราง payroll_snapshot (ผลคำนวณเงินเดือนต่อพนักงานต่อเดือน) และ payroll_snapshot_months หากยังไม่มี"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS payroll_snapshot (
+            month INTEGER NOT NULL,
+            year INTEGER NOT NULL,
+            employee_id TEXT NOT NULL,
+            msd_id INTEGER,
+            name TEXT,
+            position TEXT,
+            branch_code TEXT,
+            zone TEXT,
+            salary_type TEXT,
+            base_salary REAL DEFAULT 0,
+            piece_rate_bonus REAL DEFAULT 0,
+            allowance REAL DEFAULT 0,
+            total_pieces INTEGER DEFAULT 0,
+            total_amount REAL DEFAULT 0,
+            range_pieces TEXT,
+            has_rate INTEGER DEFAULT 0,
+            refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (month, year, employee_id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_payroll_snapshot_month_name ON payroll_snapshot (month, year, name)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_payroll_snapshot_employee ON payroll_snapshot (employee_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_payroll_snapshot_position ON payroll_snapshot (position)')
+    # เดือนที่คำนวณครบทุกพนักงานแล้ว - เดือนที่ไม่อยู่ในตารางนี้ endpoint จะคำนวณสดแทน
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS payroll_snapshot_months (
+            month INTEGER NOT NULL,
+            year INTEGER NOT NULL,
+            built_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (month, year)
+        )
+    ''')
+
+def compute_payroll_rows(cursor, conditions=(), params=()):
+    """คำนวณเงินเดือนจาก monthly_salary_data + employees + RateBook ตามเงื่อนไข (SQL บน msd / e)
+    
+    คืน list ของ dict ในรูปแบบเดียวกับแถวของ payroll_snapshot เรียงตามชื่อพนักงาน
+    """
+    query = '''
+        SELECT 
+            msd.id, msd.employee_id, msd.package_count, msd.month, msd.year,
+            e.name, e.position, e.branch_code, e.zone, e.rate_type,
+            msd.range_1_pieces, msd.range_2_pieces, msd.range_3_pieces, msd.range_4_pieces, msd.range_5_pieces,
+            msd.range_6_pieces, msd.range_7_pieces, msd.range_8_pieces, msd.range_9_pieces, msd.range_10_pieces
+        FROM monthly_salary_data msd
+        LEFT JOIN employees e ON msd.employee_id = e.employee_id
+    '''
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY e.name, msd.id'
+    cursor.execute(query, list(params))
+    source_rows = cursor.fetchall()
+    
+    rate_book = get_rate_book(cursor.connection)
+    rows = []
+    rate_rows = []
+    for (msd_id, emp_id, pieces, month, year, name, position, branch_code, zone, emp_type,
+         *range_pieces) in source_rows:
+        # ต้องมีตำแหน่งและโซนจึงหาเรทได้, ถ้าไม่มี rate_type ให้ใช้ DEFAULT
+        salary_type = emp_type if emp_type else 'DEFAULT'
+        rate = rate_book.resolve(position, salary_type, zone, branch_code) if position and zone else None
+        rate_rows.append(rate.row if rate else None)
+        rows.append({
+            'month': month,
+            'year': year,
+            'employee_id': emp_id,
+            'msd_id': msd_id,
+            'name': name,
+            'position': position,
+            'branch_code': branch_code,
+            'zone': zone,
+            'salary_type': salary_type,
+            'total_pieces': pieces or 0,
+            'range_pieces': [count or 0 for count in range_pieces],
+            'has_rate': rate is not None
+        })
+    
+    # คำนวณเงินเดือนทั้งชุดในครั้งเดียว (ผลเท่ากับ calculate_salary_unified ทีละคน)
+    if rows:
+        salary = calculate_salary_batch([row['total_pieces'] for row in rows], rate_rows)
+        for field in ('base_salary', 'piece_rate_bonus', 'allowance', 'total_amount'):
+            for row, value in zip(rows, salary[field].tolist()):
+                row[field] = value
+    return rows
+
+def refresh_payroll_snapshot(cursor, employee_ids=None, positions=None, month=None, year=None):
+    """คำนวณ payroll_snapshot ใหม่เฉพาะส่วนที่ได้รับผลกระทบ - เรียกใน transaction เดียวกับการแก้ไขข้อมูล
+    
+    - employee_ids: พนักงานที่ข้อมูลเปลี่ยน (ทุกเดือน)
+    - positions: ตำแหน่งที่เรทเปลี่ยน (พนักงานทุกคนในตำแหน่งนั้น ทุกเดือน)
+    - month/year: ทั้งเดือน (หลังอัพโหลด) และบันทึกว่าเดือนนั้นคำนวณครบแล้ว
+    """
+    ensure_payroll_snapshot_tables(cursor)
+    
+    source_conditions, snapshot_conditions, params = [], [], []
+    for column, values in (('employee_id', employee_ids), ('position', positions)):
+        if values is not None:
+            values = list(dict.fromkeys(v for v in values if v is not None))
+            if not values:
+                return 0
+            placeholders = ','.join('?' for _ in values)
+            source_conditions.append(f"{'e' if column == 'position' else 'msd'}.{column} IN ({placeholders})")
+            snapshot_conditions.append(f'{column} IN ({placeholders})')
+            params.extend(values)
+    if month is not None and year is not None:
+        source_conditions.append('msd.month = ? AND msd.year = ?')
+        snapshot_conditions.append('month = ? AND year = ?')
+        params.extend([month, year])
+    
+    rows = compute_payroll_rows(cursor, source_conditions, params)
+    
+    delete_query = 'DELETE FROM payroll_snapshot'
+    if snapshot_conditions:
+        delete_query += ' WHERE ' + ' AND '.join(snapshot_conditions)
+    cursor.execute(delete_query, params)
+    cursor.executemany('''
+        INSERT OR REPLACE INTO payroll_snapshot 
+        (month, year, employee_id, msd_id, name, position, branch_code, zone, salary_type,
+         base_salary, piece_rate_bonus, allowance, total_pieces, total_amount, range_pieces, has_rate)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [(
+        row['month'], row['year'], row['employee_id'], row['msd_id'], row['name'], row['position'],
+        row['branch_code'], row['zone'], row['salary_type'], row['base_salary'], row['piece_rate_bonus'],
+        row['allowance'], row['total_pieces'], row['total_amount'], json.dumps(row['range_pieces']),
+        int(row['has_rate'])
+    ) for row in rows])
+    
+    if month is not None and year is not None:
+        cursor.execute('INSERT OR REPLACE INTO payroll_snapshot_months (month, year) VALUES (?, ?)', (month, year))
+    return len(rows)
+
+def rebuild_payroll_snapshot(cursor):
+    """คำนวณ payroll_snapshot ใหม่ทุกเดือน (ใช้หลังแก้ฐานข้อมูลด้วยสคริปต์นอกระบบ)"""
+    ensure_payroll_snapshot_tables(cursor)
+    cursor.execute('DELETE FROM payroll_snapshot_months')
+    cursor.execute('SELECT DISTINCT month, year FROM monthly_salary_data')
+    total = 0
+    for month, year in cursor.fetchall():
+        total += refresh_payroll_snapshot(cursor, month=month, year=year)
+    return total
+
+def payroll_snapshot_ready(cursor, month, year):
+    """เดือนนี้มี payroll_snapshot ที่คำนวณครบแล้วหรือไม่ (ไม่สร้างตารางในเส้นทางอ่าน)"""
+    try:
+        cursor.execute('SELECT 1 FROM payroll_snapshot_months WHERE month = ? AND year = ?', (month, year))
+    except sqlite3.OperationalError:
+        return False
+    return cursor.fetchone() is not None
+
+def load_payroll_snapshot(cursor, month, year, branch='', employee_id=''):
+    """อ่านผลคำนวณเงินเดือนของเดือนจาก payroll_snapshot พร้อมตัวกรองสาขา/รหัสพนักงาน"""
+    query = '''
+        SELECT month, year, employee_id, msd_id, name, position, branch_code, zone, salary_type,
+               base_salary, piece_rate_bonus, allowance, total_pieces, total_amount, range_pieces, has_rate
+        FROM payroll_snapshot
+        WHERE month = ? AND year = ?
+    '''
+    params = [month, year]
+    if branch:
+        query += ' AND branch_code = ?'
+        params.append(branch)
+    if employee_id:
+        query += ' AND employee_id LIKE ?'
+        params.append(f'%{employee_id}%')
+    query += ' ORDER BY name, msd_id'
+    cursor.execute(query, params)
+    
+    columns = [col[0] for col in cursor.description]
+    rows = []
+    for values in cursor.fetchall():
+        row = dict(zip(columns, values))
+        row['range_pieces'] = json.loads(row['range_pieces'] or '[]')
+        row['has_rate'] = bool(row['has_rate'])
+        rows.append(row)
+    return rows
+
+def rate_positions(cursor, rate_id):
+    """ตำแหน่งของเรท rate_id (ใช้หาพนักงานที่ต้องคำนวณใหม่เมื่อเรทเปลี่ยน)"""
+    cursor.execute('SELECT position FROM piece_rates WHERE id = ?', (rate_id,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+# ตารางช่วงน้ำหนักมาตรฐาน 10 ช่วง (ตรงกับ weight_range_1..10 ใน piece_rates) - ขอบช่วงกำหนดที่นี่ที่เดียว
+# ขอบบนของช่วงที่ 0-8: ช่วง i คือ WEIGHT_RANGE_BOUNDS[i-1] < weight <= WEIGHT_RANGE_BOUNDS[i], ช่วง 9 คือมากกว่า 15 กก.
+# น้ำหนักติดลบ (ข้อมูลผิด) ตกช่วง 9 เหมือนโค้ดเดิมที่ใช้ช่วงสุดท้ายเมื่อหาช่วงไม่พบ
+WEIGHT_RANGE_BOUNDS = np.array([0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 5.0, 10.0, 15.0])
+# ชื่อช่วงที่บันทึกใน unmatched_salary_records.range_name
+WEIGHT_RANGE_NAMES = [
+    '0.0-0.5', '0.51-1.0', '1.01-1.5', '1.51-2.0', '2.01-2.5',
+    '2.51-3.0', '3.01-5.0', '5.01-10.0', '10.01-15.0', '15.0-15+'
+]
+RATE_RANGE_COLUMNS = [f'weight_range_{i+1}' for i in range(10)]
+
+def bin_weights(weights):
+    """หาช่วงน้ำหนัก (0-9) ของพัสดุทั้งชุดในครั้งเดียว"""
+    weights = np.asarray(weights, dtype=float)
+    ranges = np.searchsorted(WEIGHT_RANGE_BOUNDS, weights, side='left')
+    ranges[weights < 0] = len(WEIGHT_RANGE_BOUNDS)
+    return ranges
+
+def weight_range_case_sql(column='weight'):
+    """นิพจน์ CASE ของ SQL ที่ให้ช่วงน้ำหนัก (0-9) ตรงกับ bin_weights (ใช้ backfill คอลัมน์ weight_range_index)"""
+    whens = ' '.join(f'WHEN {column} <= {float(bound)} THEN {i}' for i, bound in enumerate(WEIGHT_RANGE_BOUNDS))
+    return f'CASE WHEN {column} < 0 THEN {len(WEIGHT_RANGE_BOUNDS)} {whens} ELSE {len(WEIGHT_RANGE_BOUNDS)} END'
+
+def load_salary_rate_lookup(conn):
+    """โหลดพนักงานพร้อมเรทที่จับคู่จาก RateBook แล้ว (1 แถวต่อพนักงาน) สำหรับ join กับไฟล์อัพโหลด
+    
+    จับคู่เรทแบบเดียวกับ compute_payroll_rows: ต้องมีตำแหน่งและโซน และพนักงานที่ไม่มี rate_type ใช้เรท DEFAULT
+    """
+    lookup = pd.read_sql_query('''
+        SELECT employee_id, position, branch_code AS emp_branch_code, zone,
+               employment_type, COALESCE(NULLIF(rate_type, ''), 'DEFAULT') AS rate_type
+        FROM employees
+    ''', conn)
+    
+    rate_book = get_rate_book(conn)
+    rates = [
+        rate_book.resolve(position, rate_type, zone, branch_code) if position and zone else None
+        for position, rate_type, zone, branch_code in zip(
+            lookup['position'], lookup['rate_type'], lookup['zone'], lookup['emp_branch_code']
+        )
+    ]
+    
+    lookup['rate_id'] = pd.array([rate.id if rate else None for rate in rates], dtype='Int64')
+    lookup['rate_base_salary'] = [rate.base_salary if rate else 0.0 for rate in rates]
+    lookup['piece_rate_bonus'] = [rate.piece_rate_bonus if rate else 0.0 for rate in rates]
+    lookup['allowance'] = [rate.allowance if rate else 0.0 for rate in rates]
+    for i, column in enumerate(RATE_RANGE_COLUMNS):
+        lookup[column] = [rate.weight_ranges[i] if rate else 0.0 for rate in rates]
+    return lookup
+
+def prepare_salary_frame(df, found_columns):
+    """แปลงข้อมูลจากไฟล์เป็น 6 คอลัมน์มาตรฐาน พร้อมช่วงน้ำหนักของแต่ละชิ้น"""
+    raw_weight = df[found_columns['weight']]
+    weight = pd.to_numeric(raw_weight, errors='coerce')
+    
+    frame = pd.DataFrame({
+        'awb': df[found_columns['awb']].map(str),
+        'branch_code': df[found_columns['branch']].map(str),
+        'receive_time': df[found_columns['time']].map(str),
+        'employee_name': df[found_columns['employee_name']].map(str),
+        'employee_id': df[found_columns['employee_id']].map(str).str.strip(),
+        # น้ำหนักว่างถือเป็น 0, น้ำหนักที่แปลงเป็นตัวเลขไม่ได้ถือเป็นแถวผิดพลาด
+        'weight_valid': weight.notna() | raw_weight.isna(),
+        'weight': weight.fillna(0.0).astype(float)
+    })
+    frame['weight_range_index'] = bin_weights(frame['weight'].to_numpy())
+    return frame.reset_index(drop=True)
+
+def ingest_salary_chunks(chunks, filename, found_columns, month, year, uploaded_by, progress=None):
+    """ประมวลผลไฟล์เงินเดือนทีละชุดแบบ columnar และบันทึกทั้งหมดใน transaction เดียว
+    
+    chunks คือ iterable ของ DataFrame ดิบจากไฟล์, progress(rows, matched, unmatched) ถูกเรียกหลังจบแต่ละชุด
+    คืนค่า dict สรุปผล (batch_id, จำนวนแถวที่สำเร็จ/ผิดพลาด/ไม่ตรงฐานข้อมูล)
+    """
+    import datetime
+    month, year = int(month), int(year)
+    conn = connect_db()
+    cursor = conn.cursor()
+    
+    try:
+        ensure_salary_upload_columns(cursor)
         
-        print(f"\n=== ขั้นตอนที่ 4: แสดงผลลัพธ์ในเมนูสรุปเงินได้พนักงาน ===")
-        print(f"✅ ประมวลผลสำเร็จ: {success_count} รายการ")
-        print(f"❌ ล้มเหลว: {error_count} รายการ")
+        # สร้าง batch_id สำหรับการอัพโหลด
+        batch_id = f"batch_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
         
-        # บันทึกข้อมูลสรุปใน monthly_salary_data พร้อมข้อมูลแต่ละช่วงน้ำหนัก
-        for emp_id, summary in employee_summary.items():
-            # คำนวณเงินรวมที่ถูกต้อง: ฐาน + (รวมเรทต่อชิ้น) + สมทบ
-            total_salary = summary['base_salary'] + summary['total_piece_amount'] + summary['allowance']
+        cursor.execute('''
+            INSERT INTO salary_uploads 
+            (filename, original_name, month, year, batch_id, uploaded_by, created_at, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 'processing')
+        ''', (filename, filename, month, year, batch_id, uploaded_by, datetime.datetime.now()))
+        upload_id = cursor.lastrowid
+        
+        lookup = load_salary_rate_lookup(conn)
+        work_month = f"{year:04d}-{month:02d}"
+        close_date = f'{year:04d}-{month:02d}-31'
+        
+        total_rows = 0
+        success_count = 0
+        unmatched_count = 0
+        range_totals = []
+        
+        for df in chunks:
+            # ขั้นตอนที่ 1: แยกช่วงน้ำหนักของพัสดุทุกชิ้นในชุดนี้ในครั้งเดียว
+            frame = prepare_salary_frame(df, found_columns)
+            chunk_rows = len(frame)
+            if not chunk_rows:
+                continue
             
-            print(f"\n📊 สรุปพนักงาน {emp_id}:")
-            print(f"   - จำนวนชิ้น: {summary['total_pieces']}")
-            print(f"   - ฐาน: {summary['base_salary']:.2f} บาท")
-            print(f"   - รวมเรทต่อชิ้น: {summary['total_piece_amount']:.2f} บาท")
-            print(f"   - สมทบ: {summary['allowance']:.2f} บาท")
-            print(f"   - เงินรวม: {total_salary:.2f} บาท")
+            employee_id = frame['employee_id']
+            invalid_row = ~frame['weight_valid'] | (employee_id == '') | (employee_id == 'nan')
+            zero_id = ~invalid_row & (employee_id == '0')
+            invalid_row |= ~zero_id & (employee_id.str.len() < 5)
             
-            # แสดงจำนวนชิ้นในแต่ละช่วงน้ำหนัก
-            for i in range(10):
-                pieces = summary['pieces_by_range'][f'range_{i+1}']
-                if pieces > 0:
-                    rate = summary['rates_by_range'][f'rate_{i+1}']
-                    amount = summary['amounts_by_range'][f'amount_{i+1}']
-                    print(f"   - ช่วงที่ {i+1}: {pieces} ชิ้น × {rate} บาท = {amount:.2f} บาท")
+            # ขั้นตอนที่ 2-3: join กับพนักงานและเรทที่จับคู่ไว้แล้วในหน่วยความจำ
+            merged = frame.merge(lookup, on='employee_id', how='left', indicator=True, validate='many_to_one')
+            found = (merged['_merge'] == 'both').to_numpy()
+            has_rate = merged['rate_id'].notna().to_numpy()
+            invalid_row = invalid_row.to_numpy()
+            zero_id = zero_id.to_numpy()
             
-            # บันทึกข้อมูลใน monthly_salary_data
-            cursor.execute('''
+            # พนักงานที่ไม่มีในระบบ หรือมีแต่หาเรทไม่ได้ ถือเป็นรายการไม่ตรงฐานข้อมูล (ไม่ใช่แถวผิดพลาด)
+            unmatched = zero_id | (~invalid_row & ~zero_id & ~(found & has_rate))
+            matched = ~invalid_row & ~zero_id & found & has_rate
+            
+            rate_matrix = merged[RATE_RANGE_COLUMNS].to_numpy(dtype=float)
+            merged['piece_rate'] = rate_matrix[np.arange(chunk_rows), merged['weight_range_index'].to_numpy()]
+            merged['record_amount'] = np.where(
+                merged['employment_type'] == 'piece_rate', merged['piece_rate'], merged['rate_base_salary']
+            )
+            
+            records = merged[matched]
+            cursor.executemany('''
+                INSERT INTO employee_salary_records 
+                (employee_id, awb_number, branch_code, weight, receive_time, close_date, work_month, total_pieces, total_amount, upload_batch_id, weight_range_index)
+                VALUES (?, ?, ?, ?, ?, ?, ?, 1, ?, ?, ?)
+            ''', zip(
+                records['employee_id'].tolist(), records['awb'].tolist(), records['branch_code'].tolist(),
+                records['weight'].tolist(), records['receive_time'].tolist(),
+                [close_date] * len(records), [work_month] * len(records),
+                records['record_amount'].tolist(), [batch_id] * len(records),
+                records['weight_range_index'].tolist()
+            ))
+            
+            # บันทึกข้อมูลที่ไม่ตรงกับฐานข้อมูลพนักงาน
+            unmatched_rows = merged[unmatched]
+            cursor.executemany('''
+                INSERT INTO unmatched_salary_records 
+                (upload_batch_id, employee_id, employee_name, awb_number, branch_code, weight, receive_time, weight_range_index, range_name)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', zip(
+                [batch_id] * len(unmatched_rows), unmatched_rows['employee_id'].tolist(),
+                unmatched_rows['employee_name'].tolist(), unmatched_rows['awb'].tolist(),
+                unmatched_rows['branch_code'].tolist(), unmatched_rows['weight'].tolist(),
+                unmatched_rows['receive_time'].tolist(), unmatched_rows['weight_range_index'].tolist(),
+                [WEIGHT_RANGE_NAMES[i] for i in unmatched_rows['weight_range_index'].tolist()]
+            ))
+            
+            # เก็บยอดรายพนักงาน/ช่วงน้ำหนักของชุดนี้ไว้รวมตอนท้าย
+            if len(records):
+                range_totals.append(
+                    records.groupby(['employee_id', 'weight_range_index'])['piece_rate'].agg(['size', 'sum'])
+                )
+            
+            chunk_matched = int(matched.sum())
+            chunk_unmatched = int(unmatched.sum())
+            total_rows += chunk_rows
+            success_count += chunk_matched
+            unmatched_count += chunk_unmatched
+            metrics.inc('daex_salary_rows_ingested_total', chunk_matched, result='matched')
+            metrics.inc('daex_salary_rows_ingested_total', chunk_unmatched, result='unmatched')
+            metrics.inc('daex_salary_rows_ingested_total', chunk_rows - chunk_matched - chunk_unmatched, result='error')
+            metrics.flush()
+            if progress:
+                progress(total_rows, success_count, unmatched_count)
+        
+        # ขั้นตอนที่ 4: สรุปยอดรายพนักงานลง monthly_salary_data
+        employee_count = 0
+        if range_totals:
+            by_range = pd.concat(range_totals).groupby(level=[0, 1]).sum()
+            pieces_by_range = by_range['size'].unstack(fill_value=0).reindex(columns=range(10), fill_value=0)
+            amounts_by_range = by_range['sum'].unstack(fill_value=0.0).reindex(columns=range(10), fill_value=0.0)
+            summary = lookup.set_index('employee_id').loc[pieces_by_range.index]
+            
+            monthly_rows = []
+            for emp_id, pieces, amounts in zip(pieces_by_range.index, pieces_by_range.to_numpy(), amounts_by_range.to_numpy()):
+                emp = summary.loc[emp_id]
+                total_piece_amount = float(amounts.sum())
+                # เงินรวม: ฐาน + (รวมเรทต่อชิ้น) + สมทบ
+                total_salary = emp['rate_base_salary'] + total_piece_amount + emp['allowance']
+                monthly_rows.append((
+                    emp_id, month, year, int(pieces.sum()), 0.0, emp['rate_base_salary'],
+                    total_piece_amount, emp['allowance'], total_salary,
+                    *[int(p) for p in pieces], *[float(a) for a in amounts],
+                    emp['position'], emp['emp_branch_code'], emp['zone'], emp['employment_type']
+                ))
+            
+            cursor.executemany('''
                 INSERT OR REPLACE INTO monthly_salary_data 
                 (employee_id, month, year, package_count, total_weight, base_salary, piece_rate_bonus, allowance, total_salary,
                  range_1_pieces, range_2_pieces, range_3_pieces, range_4_pieces, range_5_pieces,
@@ -2530,42 +4939,13 @@ def process_salary_upload_old_system(df, filename, found_columns, month, year):
                  range_6_amount, range_7_amount, range_8_amount, range_9_amount, range_10_amount,
                  position, branch_code, zone, employment_type)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                emp_id, month, year, summary['total_pieces'], 0.0, summary['base_salary'], 
-                summary['total_piece_amount'], summary['allowance'], total_salary,
-                summary['pieces_by_range']['range_1'], summary['pieces_by_range']['range_2'],
-                summary['pieces_by_range']['range_3'], summary['pieces_by_range']['range_4'],
-                summary['pieces_by_range']['range_5'], summary['pieces_by_range']['range_6'],
-                summary['pieces_by_range']['range_7'], summary['pieces_by_range']['range_8'],
-                summary['pieces_by_range']['range_9'], summary['pieces_by_range']['range_10'],
-                summary['amounts_by_range']['amount_1'], summary['amounts_by_range']['amount_2'],
-                summary['amounts_by_range']['amount_3'], summary['amounts_by_range']['amount_4'],
-                summary['amounts_by_range']['amount_5'], summary['amounts_by_range']['amount_6'],
-                summary['amounts_by_range']['amount_7'], summary['amounts_by_range']['amount_8'],
-                summary['amounts_by_range']['amount_9'], summary['amounts_by_range']['amount_10'],
-                summary['position'], summary['branch_code'], summary['zone'], summary['employment_type']
-            ))
+            ''', monthly_rows)
+            employee_count = len(monthly_rows)
         
-        # บันทึกข้อมูลที่ไม่ตรงกับฐานข้อมูลพนักงาน
-        if unmatched_records:
-            print(f"\n📋 บันทึกข้อมูลที่ไม่ตรงกับฐานข้อมูลพนักงาน: {len(unmatched_records)} รายการ")
-            for record in unmatched_records:
-                cursor.execute('''
-                    INSERT INTO unmatched_salary_records 
-                    (upload_batch_id, employee_id, employee_name, awb_number, branch_code, weight, receive_time, weight_range_index, range_name)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    batch_id, record['employee_id'], record['employee_name'], record['awb'], 
-                    record['branch_code'], record['weight'], record['receive_time'], 
-                    record['weight_range_index'], record['range_name']
-                ))
-            
-            print(f"📊 สรุปข้อมูลที่ไม่ตรง:")
-            print(f"   - จำนวนชิ้นทั้งหมด: {unmatched_summary['total_pieces']}")
-            for i in range(10):
-                pieces = unmatched_summary['pieces_by_range'][f'range_{i+1}']
-                if pieces > 0:
-                    print(f"   - ช่วงที่ {i+1}: {pieces} ชิ้น")
+        # คำนวณสรุปเงินเดือนของเดือนนี้ใหม่ให้หน้าสรุปอ่านได้ทันที
+        bump_data_version(cursor, 'salary_uploads')
+        bump_data_version(cursor, 'employee_salary_records')
+        refresh_payroll_snapshot(cursor, month=month, year=year)
         
         # อัปเดต status และ linkage_status
         cursor.execute('''
@@ -2575,187 +4955,427 @@ def process_salary_upload_old_system(df, filename, found_columns, month, year):
         ''', (upload_id,))
         
         conn.commit()
-        conn.close()
         
-        return jsonify({
-            'success': True,
-            'message': 'อัพโหลดข้อมูลเงินเดือนสำเร็จ'
-        })
+        logger.info('✅ ประมวลผลสำเร็จ: %s รายการ, พนักงาน %s คน', success_count, employee_count)
+        logger.info('❌ ล้มเหลว: %s รายการ (ไม่ตรงฐานข้อมูล %s รายการ)', total_rows - success_count, unmatched_count)
         
+        return {
+            'upload_id': upload_id,
+            'batch_id': batch_id,
+            'total_rows': total_rows,
+            'success_count': success_count,
+            'error_count': total_rows - success_count,
+            'unmatched_count': unmatched_count,
+            'employee_count': employee_count
+        }
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def iter_dataframe_chunks(df, chunk_rows=None):
+    """แบ่ง DataFrame เป็นชุดละ chunk_rows แถวเพื่อรายงานความคืบหน้าระหว่างประมวลผล"""
+    chunk_rows = chunk_rows or SALARY_INGEST_CHUNK_ROWS
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
+
+# ==================== คิวงานอัพโหลดเงินเดือน (ประมวลผลเบื้องหลัง) ====================
+
+# ตารางคิวงานแยกไฟล์จากฐานข้อมูลหลัก เพื่อให้อัปเดตความคืบหน้าได้ระหว่างที่ transaction อัพโหลดยังเปิดอยู่
+SALARY_JOBS_DB = os.path.join('database', 'salary_jobs.db')
+SALARY_JOBS_UPLOAD_DIR = os.path.join('uploads', 'salary_jobs')
+# process ที่ประมวลผลงานเขียน heartbeat_at ทุกกี่วินาที
+SALARY_JOB_HEARTBEAT_SECONDS = 10
+# งานที่สถานะ running แต่ไม่มี heartbeat นานเกินนี้ (วินาที) หรือ process ของงานไม่อยู่แล้ว ถือว่า worker หยุดไปแล้ว
+SALARY_JOB_STALE_SECONDS = 6 * SALARY_JOB_HEARTBEAT_SECONDS
+_salary_jobs_schema_ready = False
+
+def get_salary_jobs_connection():
+    """เชื่อมต่อฐานข้อมูลคิวงานอัพโหลด และสร้างตารางหากยังไม่มี"""
+    conn = connect_db(SALARY_JOBS_DB)
+    conn.row_factory = sqlite3.Row
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS salary_upload_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            form_month INTEGER,
+            form_year INTEGER,
+            uploaded_by TEXT,
+            status TEXT DEFAULT 'queued',
+            message TEXT,
+            total_rows INTEGER DEFAULT 0,
+            rows_processed INTEGER DEFAULT 0,
+            matched_rows INTEGER DEFAULT 0,
+            unmatched_rows INTEGER DEFAULT 0,
+            error_rows INTEGER DEFAULT 0,
+            batch_id TEXT,
+            month INTEGER,
+            year INTEGER,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            started_at TEXT,
+            finished_at TEXT,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            heartbeat_at TEXT,
+            worker_pid INTEGER
+        )
+    ''')
+    # process ประมวลผลคิวที่กำลังทำงาน (มีได้ครั้งละ 1 process ต่อไฟล์คิว)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS salary_upload_worker (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            pid INTEGER,
+            heartbeat_at TEXT
+        )
+    ''')
+    global _salary_jobs_schema_ready
+    if not _salary_jobs_schema_ready:
+        # ไฟล์คิวที่สร้างก่อนมี heartbeat - เพิ่มคอลัมน์ให้ครบ
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(salary_upload_jobs)')]
+        for column, column_type in (('heartbeat_at', 'TEXT'), ('worker_pid', 'INTEGER')):
+            if column not in columns:
+                conn.execute(f'ALTER TABLE salary_upload_jobs ADD COLUMN {column} {column_type}')
+        conn.commit()
+        _salary_jobs_schema_ready = True
+    return conn
+
+def update_salary_upload_job(job_id, **fields):
+    """อัปเดตสถานะ/ความคืบหน้าของงานอัพโหลด"""
+    fields['updated_at'] = datetime.now().isoformat(sep=' ', timespec='seconds')
+    assignments = ', '.join(f'{name} = ?' for name in fields)
+    conn = get_salary_jobs_connection()
+    try:
+        conn.execute(f'UPDATE salary_upload_jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+def claim_next_salary_upload_job():
+    """จองงานถัดไปในคิวแบบ atomic - ทำทีละงานเพื่อไม่ให้แย่งกันเขียนฐานข้อมูลหลัก"""
+    conn = get_salary_jobs_connection()
+    try:
+        now = datetime.now()
+        timestamp = now.isoformat(sep=' ', timespec='seconds')
+        stale_before = (now - timedelta(seconds=SALARY_JOB_STALE_SECONDS)).isoformat(sep=' ', timespec='seconds')
+        # งานที่ process ตายไปแล้ว (crash/ถูก kill) หรือขาด heartbeat ไม่ให้ค้างสถานะ running จนบล็อกคิว
+        dead_jobs = [
+            row['id'] for row in conn.execute(
+                "SELECT id, worker_pid FROM salary_upload_jobs WHERE status = 'running'"
+            ).fetchall()
+            if row['worker_pid'] and not process_alive(row['worker_pid'])
+        ]
+        conn.execute(f'''
+            UPDATE salary_upload_jobs
+            SET status = 'failed', message = 'การประมวลผลหยุดกลางคัน กรุณาอัพโหลดใหม่', finished_at = ?
+            WHERE status = 'running'
+              AND (COALESCE(heartbeat_at, updated_at) < ? OR id IN ({", ".join("?" * len(dead_jobs)) or "NULL"}))
+        ''', (timestamp, stale_before, *dead_jobs))
+
+        candidate = conn.execute('''
+            SELECT id FROM salary_upload_jobs WHERE status = 'queued' ORDER BY id LIMIT 1
+        ''').fetchone()
+        if candidate is None:
+            conn.commit()
+            return None
+
+        # UPDATE ที่มีเงื่อนไข status = 'queued' ทำให้มีเพียง worker เดียวที่จองงานนี้ได้
+        cursor = conn.execute('''
+            UPDATE salary_upload_jobs
+            SET status = 'running', started_at = ?, updated_at = ?, heartbeat_at = ?, worker_pid = ?
+            WHERE id = ? AND status = 'queued'
+              AND NOT EXISTS (SELECT 1 FROM salary_upload_jobs WHERE status = 'running')
+        ''', (timestamp, timestamp, timestamp, os.getpid(), candidate['id']))
+        conn.commit()
+        if cursor.rowcount != 1:
+            return None
+
+        return conn.execute('SELECT * FROM salary_upload_jobs WHERE id = ?', (candidate['id'],)).fetchone()
+    finally:
+        conn.close()
+
+def process_salary_upload_job(job):
+    """ประมวลผลไฟล์ของงานที่จองไว้: อ่านไฟล์ ตรวจคอลัมน์ แล้วส่งเข้า ingest_salary_chunks"""
+    job_id = job['id']
+    try:
+        found_columns, missing_columns, total_rows, chunks = read_salary_file_chunks(job['file_path'])
+        if missing_columns:
+            update_salary_upload_job(
+                job_id, status='failed', finished_at=datetime.now().isoformat(sep=' ', timespec='seconds'),
+                message=f'ไฟล์ไม่ตรงกับรูปแบบที่ต้องการ\nคอลัมน์ที่ขาดหายไป: {missing_columns}\nคอลัมน์ที่พบ: {found_columns}'
+            )
+            return
+        
+        # อ่านเดือนและปีจากชุดข้อมูลแรกในไฟล์ ถ้าไม่ได้ให้ใช้จากฟอร์ม
+        first_chunk = next(chunks, None)
+        month, year = (None, None) if first_chunk is None else extract_month_year_from_data(first_chunk, found_columns)
+        if month is None or year is None:
+            month, year = job['form_month'], job['form_year']
+        if first_chunk is not None:
+            chunks = itertools.chain([first_chunk], chunks)
+        
+        logger.info('✅ งาน %s: เริ่มประมวลผลไฟล์ประมาณ %s แถว', job_id, total_rows)
+        update_salary_upload_job(job_id, total_rows=total_rows or 0, month=month, year=year)
+        
+        def report(rows_processed, matched_rows, unmatched_rows):
+            update_salary_upload_job(
+                job_id, rows_processed=rows_processed, matched_rows=matched_rows,
+                unmatched_rows=unmatched_rows, error_rows=rows_processed - matched_rows
+            )
+        
+        result = ingest_salary_chunks(
+            chunks, job['filename'], found_columns,
+            month, year, job['uploaded_by'], progress=report
+        )
+        update_salary_upload_job(
+            job_id, status='completed', message='อัพโหลดข้อมูลเงินเดือนสำเร็จ',
+            batch_id=result['batch_id'], total_rows=result['total_rows'], rows_processed=result['total_rows'],
+            matched_rows=result['success_count'], unmatched_rows=result['unmatched_count'],
+            error_rows=result['error_count'], finished_at=datetime.now().isoformat(sep=' ', timespec='seconds')
+        )
     except Exception as e:
-        return jsonify({
-            'success': False,
-            'message': f'เกิดข้อผิดพลาด: {str(e)}'
-        })
+        logger.error('❌ งานอัพโหลด %s ล้มเหลว: %s', job_id, e)
+        update_salary_upload_job(
+            job_id, status='failed', message=f'เกิดข้อผิดพลาด: {str(e)}',
+            finished_at=datetime.now().isoformat(sep=' ', timespec='seconds')
+        )
+    finally:
+        try:
+            os.remove(job['file_path'])
+        except OSError:
+            pass
 
-@app.route('/api/upload-results/latest')
+def beat_salary_upload_job(job_id, stopped):
+    """เขียน heartbeat_at ของงานและของ worker ทุก SALARY_JOB_HEARTBEAT_SECONDS จนกว่า stopped จะถูก set"""
+    while not stopped.wait(SALARY_JOB_HEARTBEAT_SECONDS):
+        try:
+            conn = get_salary_jobs_connection()
+            try:
+                timestamp = datetime.now().isoformat(sep=' ', timespec='seconds')
+                conn.execute('UPDATE salary_upload_jobs SET heartbeat_at = ? WHERE id = ?', (timestamp, job_id))
+                conn.execute('UPDATE salary_upload_worker SET heartbeat_at = ? WHERE pid = ?', (timestamp, os.getpid()))
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning('⚠️ เขียน heartbeat ของงาน %s ไม่สำเร็จ: %s', job_id, e)
+
+def salary_upload_worker_alive(row):
+    """แถวใน salary_upload_worker เป็นของ process ที่ยังอยู่และยังเขียน heartbeat อยู่หรือไม่"""
+    if row is None or not row['pid'] or not row['heartbeat_at']:
+        return False
+    stale_before = datetime.now() - timedelta(seconds=SALARY_JOB_STALE_SECONDS)
+    return process_alive(row['pid']) and datetime.fromisoformat(row['heartbeat_at']) >= stale_before
+
+def release_salary_upload_worker():
+    """ลบทะเบียน worker นี้ถ้าไม่มีงานที่จองได้เหลือในคิว - คืน False ถ้ายังมีงาน (ให้วนจองต่อ)
+    
+    ตรวจคิวและลบทะเบียนใน transaction เดียว (BEGIN IMMEDIATE) งานที่เข้าคิวหลังจากนี้
+    จะเห็นว่าไม่มี worker แล้วจึงเริ่ม process ใหม่ - ไม่มีงานค้างในคิวโดยไม่มีใครประมวลผล
+    """
+    conn = get_salary_jobs_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        pending = conn.execute('''
+            SELECT 1 FROM salary_upload_jobs WHERE status = 'queued'
+              AND NOT EXISTS (SELECT 1 FROM salary_upload_jobs WHERE status = 'running')
+            LIMIT 1
+        ''').fetchone()
+        if pending is None:
+            conn.execute('DELETE FROM salary_upload_worker WHERE pid = ?', (os.getpid(),))
+        conn.commit()
+        return pending is None
+    finally:
+        conn.close()
+
+def run_salary_upload_worker():
+    """วนประมวลผลงานในคิวจนหมด (รันใน process แยกจาก web worker)"""
+    while True:
+        job = claim_next_salary_upload_job()
+        if job is None:
+            if release_salary_upload_worker():
+                break
+            continue
+        stopped = threading.Event()
+        heartbeat = threading.Thread(target=beat_salary_upload_job, args=(job['id'], stopped), daemon=True)
+        heartbeat.start()
+        try:
+            profile_salary_upload_job(process_salary_upload_job, job)
+        finally:
+            stopped.set()
+            heartbeat.join()
+    # เขียน metrics และ log ที่ค้างใน queue ให้หมดก่อน process จบ
+    metrics.flush(force=True)
+    for handler in logger.handlers:
+        handler.flush()
+
+def start_salary_upload_worker():
+    """เริ่ม process ประมวลผลคิวงานอัพโหลดโดยไม่บล็อก request - คืน Popen หรือ None ถ้ามี worker ที่ยังทำงานอยู่แล้ว
+    
+    เริ่ม Python ใหม่ที่ import โมดูลนี้เอง แทนการ fork - web worker มี thread เบื้องหลัง (log, รูปย่อ, profiler)
+    ถ้า fork ตอนที่ thread เหล่านั้นถือ lock อยู่ process ลูกจะค้างที่ lock นั้นตลอดไป
+    (ไม่ใช้ multiprocessing spawn เพราะจะรันสคริปต์ __main__ ของ process แม่ซ้ำใน process ลูก)
+    process ลูกตั้ง DAEX_SALARY_WORKER=1 จึงไม่รัน migration ตอน import และมี thread รอ wait() ไม่ให้ค้างเป็น zombie
+    """
+    import subprocess
+    conn = get_salary_jobs_connection()
+    try:
+        # ตรวจและลงทะเบียนใน transaction เดียว - request ที่อัพโหลดพร้อมกันจะเริ่ม worker ได้เพียงตัวเดียว
+        conn.execute('BEGIN IMMEDIATE')
+        if salary_upload_worker_alive(conn.execute('SELECT pid, heartbeat_at FROM salary_upload_worker WHERE id = 1').fetchone()):
+            conn.rollback()
+            return None
+        
+        module = __name__ if __name__ != '__main__' else os.path.splitext(os.path.basename(__file__))[0]
+        env = dict(os.environ, DAEX_SALARY_WORKER='1')
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), env.get('PYTHONPATH')]))
+        process = subprocess.Popen([sys.executable, '-c', f'import {module}; {module}.run_salary_upload_worker()'], env=env)
+        conn.execute('INSERT OR REPLACE INTO salary_upload_worker (id, pid, heartbeat_at) VALUES (1, ?, ?)',
+                     (process.pid, datetime.now().isoformat(sep=' ', timespec='seconds')))
+        conn.commit()
+    finally:
+        conn.close()
+    
+    threading.Thread(target=process.wait, name='salary-upload-worker-reaper', daemon=True).start()
+    return process
+
+def serialize_salary_upload_job(job):
+    """แปลงข้อมูลงานเป็น dict พร้อมเปอร์เซ็นต์และเวลาที่คาดว่าจะเสร็จ (ETA)"""
+    data = {key: job[key] for key in job.keys() if key != 'file_path'}
+    total_rows = job['total_rows'] or 0
+    rows_processed = job['rows_processed'] or 0
+    data['percent'] = round(rows_processed * 100.0 / total_rows, 1) if total_rows else 0
+    data['eta_seconds'] = None
+    
+    if job['status'] == 'running' and job['started_at'] and total_rows and rows_processed:
+        elapsed = (datetime.now() - datetime.fromisoformat(job['started_at'])).total_seconds()
+        if elapsed > 0:
+            data['eta_seconds'] = round((total_rows - rows_processed) / (rows_processed / elapsed), 1)
+    return data
+
+@app.route('/api/upload-jobs/<int:job_id>')
 @login_required
 @role_required(['GM', 'MD', 'HR', 'การเงิน'])
-def api_upload_results_latest():
-    """API สำหรับดึงผลลัพธ์การอัพโหลดล่าสุด"""
+def api_upload_job_status(job_id):
+    """สถานะงานอัพโหลดเงินเดือน: จำนวนแถวที่ประมวลผล/จับคู่ได้/ไม่ตรง และ ETA"""
     try:
-        print("DEBUG: API upload-results/latest called")
-        conn = sqlite3.connect('database/daex_system.db')
-        cursor = conn.cursor()
-        
-        # ดึงข้อมูลการอัพโหลดล่าสุด
-        cursor.execute('''
-            SELECT id, filename, original_name, month, year, batch_id, created_at, status, employee_linked, rate_linked
-            FROM salary_uploads 
-            ORDER BY created_at DESC
-            LIMIT 1
-        ''')
-        
-        upload_info = cursor.fetchone()
-        print(f"DEBUG: Upload info: {upload_info}")
-        if not upload_info:
-            print("DEBUG: No upload info found")
-            return jsonify({
-                'success': True,
-                'upload_info': None,
-                'results': {
-                    'total_items': 0,
-                    'total_employees': 0,
-                    'employees': [],
-                    'weight_ranges': []
-                }
-            })
+        conn = get_salary_jobs_connection()
+        job = conn.execute('SELECT * FROM salary_upload_jobs WHERE id = ?', (job_id,)).fetchone()
+        conn.close()
         
-        upload_id, filename, original_name, month, year, batch_id, created_at, status, employee_linked, rate_linked = upload_info
-        print(f"DEBUG: Batch ID: {batch_id}")
+        if not job:
+            return jsonify({'success': False, 'message': 'ไม่พบงานอัพโหลด'}), 404
         
-        # นับจำนวนรายการทั้งหมด
-        cursor.execute('''
-            SELECT COUNT(*) FROM employee_salary_records 
-            WHERE upload_batch_id = ?
-        ''', (batch_id,))
-        total_items = cursor.fetchone()[0] or 0
-        print(f"DEBUG: Total items: {total_items}")
-        
-        # นับจำนวนพนักงานที่ไม่ซ้ำกัน
-        cursor.execute('''
-            SELECT COUNT(DISTINCT employee_id) FROM employee_salary_records 
-            WHERE upload_batch_id = ?
-        ''', (batch_id,))
-        total_employees = cursor.fetchone()[0] or 0
-        print(f"DEBUG: Total employees: {total_employees}")
+        return jsonify({'success': True, 'job': serialize_salary_upload_job(job)})
         
-        # ดึงข้อมูลสรุปตามพนักงานพร้อมรายละเอียดแต่ละช่วงน้ำหนัก
-        cursor.execute('''
-            SELECT 
-                esr.employee_id, 
-                e.name,
-                COUNT(*) as total_packages,
-                SUM(CASE WHEN weight <= 0.5 THEN 1 ELSE 0 END) as range_1,
-                SUM(CASE WHEN weight > 0.5 AND weight <= 1.0 THEN 1 ELSE 0 END) as range_2,
-                SUM(CASE WHEN weight > 1.0 AND weight <= 1.5 THEN 1 ELSE 0 END) as range_3,
-                SUM(CASE WHEN weight > 1.5 AND weight <= 2.0 THEN 1 ELSE 0 END) as range_4,
-                SUM(CASE WHEN weight > 2.0 AND weight <= 2.5 THEN 1 ELSE 0 END) as range_5,
-                SUM(CASE WHEN weight > 2.5 AND weight <= 3.0 THEN 1 ELSE 0 END) as range_6,
-                SUM(CASE WHEN weight > 3.0 AND weight <= 5.0 THEN 1 ELSE 0 END) as range_7,
-                SUM(CASE WHEN weight > 5.0 AND weight <= 10.0 THEN 1 ELSE 0 END) as range_8,
-                SUM(CASE WHEN weight > 10.0 AND weight <= 15.0 THEN 1 ELSE 0 END) as range_9,
-                SUM(CASE WHEN weight > 15.0 THEN 1 ELSE 0 END) as range_10
-            FROM employee_salary_records esr
-            LEFT JOIN employees e ON esr.employee_id = e.employee_id
-            WHERE esr.upload_batch_id = ?
-            GROUP BY esr.employee_id
-            ORDER BY esr.employee_id
-        ''', (batch_id,))
-        
-        employees = []
-        for row in cursor.fetchall():
-            emp_id, name, total_packages, r1, r2, r3, r4, r5, r6, r7, r8, r9, r10 = row
-            print(f"DEBUG: Employee {emp_id}: total={total_packages}, r1={r1}, r2={r2}, r3={r3}")
-            employees.append({
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'เกิดข้อผิดพลาด: {str(e)}'})
+
+# ชื่อช่วงน้ำหนักที่หน้าสรุปผลการอัพโหลดใช้ (ลำดับเดียวกับ bin_weights)
+UPLOAD_RESULT_RANGE_LABELS = [
+    '0.00-0.50KG', '0.51-1.00KG', '1.01-1.50KG', '1.51-2.00KG', '2.01-2.50KG',
+    '2.51-3.00KG', '3.01-5.00KG', '5.01-10.00KG', '10.01-15.00KG', '15.01KG+'
+]
+
+def summarize_upload_batch(cursor, batch_id):
+    """สรุปผลการอัพโหลด 1 ชุดจากการอ่าน employee_salary_records และ unmatched_salary_records ตารางละครั้ง
+    
+    คืน (total_items, total_employees, employees, weight_ranges, unmatched_summary)
+    """
+    cursor.execute('''
+        SELECT esr.employee_id, e.name, esr.weight_range_index, COUNT(*)
+        FROM employee_salary_records esr
+        LEFT JOIN employees e ON esr.employee_id = e.employee_id
+        WHERE esr.upload_batch_id = ?
+        GROUP BY esr.employee_id, esr.weight_range_index
+        ORDER BY esr.employee_id
+    ''', (batch_id,))
+    
+    employees_by_id = {}
+    range_totals = [0] * len(UPLOAD_RESULT_RANGE_LABELS)
+    for emp_id, name, range_index, piece_count in cursor.fetchall():
+        employee = employees_by_id.get(emp_id)
+        if employee is None:
+            employee = employees_by_id[emp_id] = {
                 'employee_id': emp_id,
                 'name': name or emp_id,
-                'total_packages': total_packages or 0,
-                'weight_ranges': {
-                    '0.00-0.50KG': r1 or 0,
-                    '0.51-1.00KG': r2 or 0,
-                    '1.01-1.50KG': r3 or 0,
-                    '1.51-2.00KG': r4 or 0,
-                    '2.01-2.50KG': r5 or 0,
-                    '2.51-3.00KG': r6 or 0,
-                    '3.01-5.00KG': r7 or 0,
-                    '5.01-10.00KG': r8 or 0,
-                    '10.01-15.00KG': r9 or 0,
-                    '15.01KG+': r10 or 0
-                }
-            })
+                'total_packages': 0,
+                'weight_ranges': dict.fromkeys(UPLOAD_RESULT_RANGE_LABELS, 0)
+            }
+        employee['total_packages'] += piece_count
+        employee['weight_ranges'][UPLOAD_RESULT_RANGE_LABELS[range_index]] += piece_count
+        range_totals[range_index] += piece_count
+    
+    employees = list(employees_by_id.values())
+    weight_ranges = [
+        {'range': label, 'count': count}
+        for label, count in zip(UPLOAD_RESULT_RANGE_LABELS, range_totals) if count
+    ]
+    
+    # ข้อมูลที่ไม่ตรงกับฐานข้อมูลพนักงาน
+    cursor.execute('''
+        SELECT weight_range_index, COUNT(*)
+        FROM unmatched_salary_records
+        WHERE upload_batch_id = ?
+        GROUP BY weight_range_index
+    ''', (batch_id,))
+    
+    unmatched_ranges = dict.fromkeys(UPLOAD_RESULT_RANGE_LABELS, 0)
+    for range_index, piece_count in cursor.fetchall():
+        unmatched_ranges[UPLOAD_RESULT_RANGE_LABELS[range_index]] += piece_count
+    total_unmatched = sum(unmatched_ranges.values())
+    unmatched_summary = None
+    if total_unmatched > 0:
+        unmatched_summary = {
+            'total_packages': total_unmatched,
+            'weight_ranges': unmatched_ranges
+        }
+    
+    return sum(range_totals), len(employees), employees, weight_ranges, unmatched_summary
+
+@app.route('/api/upload-results/latest')
+@login_required
+@role_required(['GM', 'MD', 'HR', 'การเงิน'])
+def api_upload_results_latest():
+    """API สำหรับดึงผลลัพธ์การอัพโหลดล่าสุด"""
+    try:
+        logger.debug('API upload-results/latest called')
+        conn = get_db()
+        cursor = conn.cursor()
         
-        # ดึงข้อมูลจำนวนชิ้นแยกตามช่วงน้ำหนักทั้งหมด (รวมข้อมูลที่ไม่ตรง)
+        # ดึงข้อมูลการอัพโหลดล่าสุด
         cursor.execute('''
-            SELECT 
-                CASE 
-                    WHEN weight <= 0.5 THEN '0.00-0.50KG'
-                    WHEN weight <= 1.0 THEN '0.51-1.00KG'
-                    WHEN weight <= 1.5 THEN '1.01-1.50KG'
-                    WHEN weight <= 2.0 THEN '1.51-2.00KG'
-                    WHEN weight <= 2.5 THEN '2.01-2.50KG'
-                    WHEN weight <= 3.0 THEN '2.51-3.00KG'
-                    WHEN weight <= 5.0 THEN '3.01-5.00KG'
-                    WHEN weight <= 10.0 THEN '5.01-10.00KG'
-                    WHEN weight <= 15.0 THEN '10.01-15.00KG'
-                    ELSE '15.01KG+'
-                END as weight_range,
-                COUNT(*) as piece_count
-            FROM employee_salary_records 
-            WHERE upload_batch_id = ?
-            GROUP BY weight_range
-            ORDER BY MIN(weight)
-        ''', (batch_id,))
+            SELECT id, filename, original_name, month, year, batch_id, created_at, status, employee_linked, rate_linked
+            FROM salary_uploads 
+            ORDER BY created_at DESC
+            LIMIT 1
+        ''')
         
-        weight_ranges = []
-        for row in cursor.fetchall():
-            weight_range, piece_count = row
-            weight_ranges.append({
-                'range': weight_range,
-                'count': piece_count
+        upload_info = cursor.fetchone()
+        logger.debug('Upload info: %s', upload_info)
+        if not upload_info:
+            logger.debug('No upload info found')
+            return jsonify({
+                'success': True,
+                'upload_info': None,
+                'results': {
+                    'total_items': 0,
+                    'total_employees': 0,
+                    'employees': [],
+                    'weight_ranges': []
+                }
             })
         
-        # นับจำนวนที่ไม่ตรงกับฐานข้อมูลพนักงาน
-        cursor.execute('''
-            SELECT 
-                COUNT(*) as total_unmatched,
-                SUM(CASE WHEN weight <= 0.5 THEN 1 ELSE 0 END) as range_1,
-                SUM(CASE WHEN weight > 0.5 AND weight <= 1.0 THEN 1 ELSE 0 END) as range_2,
-                SUM(CASE WHEN weight > 1.0 AND weight <= 1.5 THEN 1 ELSE 0 END) as range_3,
-                SUM(CASE WHEN weight > 1.5 AND weight <= 2.0 THEN 1 ELSE 0 END) as range_4,
-                SUM(CASE WHEN weight > 2.0 AND weight <= 2.5 THEN 1 ELSE 0 END) as range_5,
-                SUM(CASE WHEN weight > 2.5 AND weight <= 3.0 THEN 1 ELSE 0 END) as range_6,
-                SUM(CASE WHEN weight > 3.0 AND weight <= 5.0 THEN 1 ELSE 0 END) as range_7,
-                SUM(CASE WHEN weight > 5.0 AND weight <= 10.0 THEN 1 ELSE 0 END) as range_8,
-                SUM(CASE WHEN weight > 10.0 AND weight <= 15.0 THEN 1 ELSE 0 END) as range_9,
-                SUM(CASE WHEN weight > 15.0 THEN 1 ELSE 0 END) as range_10
-            FROM unmatched_salary_records usr
-            WHERE usr.upload_batch_id = ?
-        ''', (batch_id,))
+        upload_id, filename, original_name, month, year, batch_id, created_at, status, employee_linked, rate_linked = upload_info
+        logger.debug('Batch ID: %s', batch_id)
         
-        unmatched_data = cursor.fetchone()
-        unmatched_summary = None
-        if unmatched_data and unmatched_data[0] > 0:
-            total_unmatched, r1, r2, r3, r4, r5, r6, r7, r8, r9, r10 = unmatched_data
-            unmatched_summary = {
-                'total_packages': total_unmatched,
-                'weight_ranges': {
-                    '0.00-0.50KG': r1 or 0,
-                    '0.51-1.00KG': r2 or 0,
-                    '1.01-1.50KG': r3 or 0,
-                    '1.51-2.00KG': r4 or 0,
-                    '2.01-2.50KG': r5 or 0,
-                    '2.51-3.00KG': r6 or 0,
-                    '3.01-5.00KG': r7 or 0,
-                    '5.01-10.00KG': r8 or 0,
-                    '10.01-15.00KG': r9 or 0,
-                    '15.01KG+': r10 or 0
-                }
-            }
+        # สรุปผลทั้งชุดด้วยการอ่านตารางละครั้งเดียว
+        total_items, total_employees, employees, weight_ranges, unmatched_summary = summarize_upload_batch(cursor, batch_id)
+        logger.debug('Total items: %s, employees: %s', total_items, total_employees)
         
         conn.close()
         
-        print(f"DEBUG: Returning response with {len(employees)} employees")
+        logger.debug('Returning response with %s employees', len(employees))
         response_data = {
             'success': True,
             'upload_info': {
@@ -2778,7 +5398,7 @@ def api_upload_results_latest():
                 'unmatched_records': unmatched_summary
             }
         }
-        print(f"DEBUG: Response data: {response_data}")
+        logger.debug('Response data: %s', response_data)
         return jsonify(response_data)
         
     except Exception as e:
@@ -2793,8 +5413,8 @@ def api_upload_results_latest():
 def api_upload_results_by_month_year(month, year):
     """API สำหรับดึงผลลัพธ์การอัพโหลดตามเดือนและปี"""
     try:
-        print(f"DEBUG: API upload-results/{month}/{year} called")
-        conn = sqlite3.connect('database/daex_system.db')
+        logger.debug('API upload-results/%s/%s called', month, year)
+        conn = get_db()
         cursor = conn.cursor()
         
         # ดึงข้อมูลการอัพโหลดตามเดือนและปี
@@ -2807,9 +5427,9 @@ def api_upload_results_by_month_year(month, year):
         ''', (month, year))
         
         upload_info = cursor.fetchone()
-        print(f"DEBUG: Upload info for {month}/{year}: {upload_info}")
+        logger.debug('Upload info for %s/%s: %s', month, year, upload_info)
         if not upload_info:
-            print(f"DEBUG: No upload info found for {month}/{year}")
+            logger.debug('No upload info found for %s/%s', month, year)
             return jsonify({
                 'success': True,
                 'upload_info': None,
@@ -2822,106 +5442,11 @@ def api_upload_results_by_month_year(month, year):
             })
         
         upload_id, filename, original_name, month, year, batch_id, created_at, status, employee_linked, rate_linked = upload_info
-        print(f"DEBUG: Batch ID: {batch_id}")
-        
-        # นับจำนวนรายการทั้งหมด
-        cursor.execute('''
-            SELECT COUNT(*) FROM employee_salary_records 
-            WHERE upload_batch_id = ?
-        ''', (batch_id,))
-        total_items = cursor.fetchone()[0] or 0
-        print(f"DEBUG: Total items: {total_items}")
-        
-        # นับจำนวนพนักงานที่ไม่ซ้ำกัน
-        cursor.execute('''
-            SELECT COUNT(DISTINCT employee_id) FROM employee_salary_records 
-            WHERE upload_batch_id = ?
-        ''', (batch_id,))
-        total_employees = cursor.fetchone()[0] or 0
-        print(f"DEBUG: Total employees: {total_employees}")
-        
-        # ดึงข้อมูลสรุปตามพนักงานพร้อมรายละเอียดแต่ละช่วงน้ำหนัก
-        cursor.execute('''
-            SELECT 
-                esr.employee_id, 
-                e.name,
-                COUNT(*) as total_packages,
-                SUM(CASE WHEN weight <= 0.5 THEN 1 ELSE 0 END) as range_1,
-                SUM(CASE WHEN weight > 0.5 AND weight <= 1.0 THEN 1 ELSE 0 END) as range_2,
-                SUM(CASE WHEN weight > 1.0 AND weight <= 1.5 THEN 1 ELSE 0 END) as range_3,
-                SUM(CASE WHEN weight > 1.5 AND weight <= 2.0 THEN 1 ELSE 0 END) as range_4,
-                SUM(CASE WHEN weight > 2.0 AND weight <= 2.5 THEN 1 ELSE 0 END) as range_5,
-                SUM(CASE WHEN weight > 2.5 AND weight <= 3.0 THEN 1 ELSE 0 END) as range_6,
-                SUM(CASE WHEN weight > 3.0 AND weight <= 5.0 THEN 1 ELSE 0 END) as range_7,
-                SUM(CASE WHEN weight > 5.0 AND weight <= 10.0 THEN 1 ELSE 0 END) as range_8,
-                SUM(CASE WHEN weight > 10.0 AND weight <= 15.0 THEN 1 ELSE 0 END) as range_9,
-                SUM(CASE WHEN weight > 15.0 THEN 1 ELSE 0 END) as range_10
-            FROM employee_salary_records esr
-            LEFT JOIN employees e ON esr.employee_id = e.employee_id
-            WHERE esr.upload_batch_id = ?
-            GROUP BY esr.employee_id
-            ORDER BY esr.employee_id
-        ''', (batch_id,))
-        
-        employees = []
-        for row in cursor.fetchall():
-            emp_id, name, total_packages, r1, r2, r3, r4, r5, r6, r7, r8, r9, r10 = row
-            print(f"DEBUG: Employee {emp_id}: total={total_packages}, r1={r1}, r2={r2}, r3={r3}")
-            employees.append({
-                'employee_id': emp_id,
-                'name': name or emp_id,
-                'total_packages': total_packages or 0,
-                'weight_ranges': {
-                    '0.00-0.50KG': r1 or 0,
-                    '0.51-1.00KG': r2 or 0,
-                    '1.01-1.50KG': r3 or 0,
-                    '1.51-2.00KG': r4 or 0,
-                    '2.01-2.50KG': r5 or 0,
-                    '2.51-3.00KG': r6 or 0,
-                    '3.01-5.00KG': r7 or 0,
-                    '5.01-10.00KG': r8 or 0,
-                    '10.01-15.00KG': r9 or 0,
-                    '15.01KG+': r10 or 0
-                }
-            })
+        logger.debug('Batch ID: %s', batch_id)
         
-        # นับจำนวนที่ไม่ตรงกับฐานข้อมูลพนักงาน
-        cursor.execute('''
-            SELECT 
-                COUNT(*) as total_unmatched,
-                SUM(CASE WHEN weight <= 0.5 THEN 1 ELSE 0 END) as range_1,
-                SUM(CASE WHEN weight > 0.5 AND weight <= 1.0 THEN 1 ELSE 0 END) as range_2,
-                SUM(CASE WHEN weight > 1.0 AND weight <= 1.5 THEN 1 ELSE 0 END) as range_3,
-                SUM(CASE WHEN weight > 1.5 AND weight <= 2.0 THEN 1 ELSE 0 END) as range_4,
-                SUM(CASE WHEN weight > 2.0 AND weight <= 2.5 THEN 1 ELSE 0 END) as range_5,
-                SUM(CASE WHEN weight > 2.5 AND weight <= 3.0 THEN 1 ELSE 0 END) as range_6,
-                SUM(CASE WHEN weight > 3.0 AND weight <= 5.0 THEN 1 ELSE 0 END) as range_7,
-                SUM(CASE WHEN weight > 5.0 AND weight <= 10.0 THEN 1 ELSE 0 END) as range_8,
-                SUM(CASE WHEN weight > 10.0 AND weight <= 15.0 THEN 1 ELSE 0 END) as range_9,
-                SUM(CASE WHEN weight > 15.0 THEN 1 ELSE 0 END) as range_10
-            FROM unmatched_salary_records usr
-            WHERE usr.upload_batch_id = ?
-        ''', (batch_id,))
-        
-        unmatched_data = cursor.fetchone()
-        unmatched_summary = None
-        if unmatched_data and unmatched_data[0] > 0:
-            total_unmatched, r1, r2, r3, r4, r5, r6, r7, r8, r9, r10 = unmatched_data
-            unmatched_summary = {
-                'total_packages': total_unmatched,
-                'weight_ranges': {
-                    '0.00-0.50KG': r1 or 0,
-                    '0.51-1.00KG': r2 or 0,
-                    '1.01-1.50KG': r3 or 0,
-                    '1.51-2.00KG': r4 or 0,
-                    '2.01-2.50KG': r5 or 0,
-                    '2.51-3.00KG': r6 or 0,
-                    '3.01-5.00KG': r7 or 0,
-                    '5.01-10.00KG': r8 or 0,
-                    '10.01-15.00KG': r9 or 0,
-                    '15.01KG+': r10 or 0
-                }
-            }
+        # สรุปผลทั้งชุดด้วยการอ่านตารางละครั้งเดียว
+        total_items, total_employees, employees, _, unmatched_summary = summarize_upload_batch(cursor, batch_id)
+        logger.debug('Total items: %s, employees: %s', total_items, total_employees)
         
         conn.close()
         
@@ -2955,11 +5480,12 @@ def api_upload_results_by_month_year(month, year):
 @app.route('/api/upload-history/<int:month>/<int:year>')
 @login_required
 @role_required(['GM', 'MD', 'HR', 'การเงิน'])
+@cached_response(tables=('salary_uploads', 'employee_salary_records'))
 def api_upload_history(month, year):
     """API สำหรับดึงประวัติการอัพโหลดตามเดือนและปี"""
     try:
-        print(f"DEBUG: API upload-history called with month={month}, year={year}")
-        conn = sqlite3.connect('database/daex_system.db')
+        logger.debug('API upload-history called with month=%s, year=%s', month, year)
+        conn = get_db()
         cursor = conn.cursor()
         
         # ดึงข้อมูลการอัพโหลดตามเดือนและปี
@@ -2971,7 +5497,7 @@ def api_upload_history(month, year):
         ''', (month, year))
         
         uploads = cursor.fetchall()
-        print(f"DEBUG: Found {len(uploads)} uploads for month={month}, year={year}")
+        logger.debug('Found %s uploads for month=%s, year=%s', len(uploads), month, year)
         
         uploads_list = []
         for row in uploads:
@@ -3009,7 +5535,7 @@ def api_upload_history(month, year):
         
         conn.close()
         
-        print(f"DEBUG: Returning {len(uploads_list)} uploads")
+        logger.debug('Returning %s uploads', len(uploads_list))
         return jsonify({
             'success': True,
             'uploads': uploads_list
@@ -3027,12 +5553,12 @@ def api_upload_history(month, year):
 def api_delete_upload(upload_id):
     """API สำหรับลบข้อมูลการอัพโหลดและข้อมูลที่เกี่ยวข้อง"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # ดึงข้อมูลการอัพโหลด
         cursor.execute('''
-            SELECT batch_id, filename FROM salary_uploads 
+            SELECT batch_id, filename, month, year FROM salary_uploads 
             WHERE id = ?
         ''', (upload_id,))
         
@@ -3044,37 +5570,41 @@ def api_delete_upload(upload_id):
                 'message': 'ไม่พบข้อมูลการอัพโหลดที่ต้องการลบ'
             })
         
-        batch_id, filename = upload_data
+        batch_id, filename, month, year = upload_data
         
         # เริ่ม transaction
         cursor.execute('BEGIN TRANSACTION')
         
         try:
-            # ลบข้อมูลจาก employee_salary_records
+            # monthly_salary_data ไม่มี upload_batch_id - อ่านพนักงานใน batch นี้ก่อนลบ employee_salary_records
             cursor.execute('''
-                DELETE FROM employee_salary_records 
+                SELECT DISTINCT employee_id FROM employee_salary_records 
                 WHERE upload_batch_id = ?
             ''', (batch_id,))
-            deleted_records = cursor.rowcount
+            employee_ids = [row[0] for row in cursor.fetchall()]
             
-            # ลบข้อมูลจาก monthly_salary_data ที่เกี่ยวข้องกับ batch นี้
-            # เนื่องจาก monthly_salary_data ไม่มี upload_batch_id เราต้องลบตาม employee_id ที่อยู่ใน batch นี้
+            # ลบข้อมูลจาก employee_salary_records
             cursor.execute('''
-                SELECT DISTINCT employee_id FROM employee_salary_records 
+                DELETE FROM employee_salary_records 
                 WHERE upload_batch_id = ?
             ''', (batch_id,))
+            deleted_records = cursor.rowcount
             
-            employee_ids = [row[0] for row in cursor.fetchall()]
             deleted_monthly = 0
-            
             if employee_ids:
-                # ลบข้อมูล monthly_salary_data สำหรับพนักงานที่อยู่ใน batch นี้
+                # ลบข้อมูล monthly_salary_data ของพนักงานใน batch นี้ เฉพาะเดือนของการอัพโหลด (ทุกเดือนถ้าไม่ทราบเดือน)
+                if not (month and year):
+                    month = year = None
                 placeholders = ','.join(['?' for _ in employee_ids])
+                month_condition = ' AND month = ? AND year = ?' if month else ''
                 cursor.execute(f'''
                     DELETE FROM monthly_salary_data 
-                    WHERE employee_id IN ({placeholders})
-                ''', employee_ids)
+                    WHERE employee_id IN ({placeholders}){month_condition}
+                ''', employee_ids + ([month, year] if month else []))
                 deleted_monthly = cursor.rowcount
+                
+                # คำนวณสรุปเงินเดือนของพนักงานกลุ่มนี้ใหม่ (แถวที่ลบไปแล้วจะหายจาก payroll_snapshot)
+                refresh_payroll_snapshot(cursor, employee_ids=employee_ids, month=month, year=year)
             
             # ลบข้อมูลจาก salary_uploads
             cursor.execute('''
@@ -3082,6 +5612,9 @@ def api_delete_upload(upload_id):
                 WHERE id = ?
             ''', (upload_id,))
             
+            bump_data_version(cursor, 'salary_uploads')
+            bump_data_version(cursor, 'employee_salary_records')
+            
             # ลบไฟล์ที่อัพโหลด (ถ้ามี)
             import os
             upload_folder = 'uploads'
@@ -3134,7 +5667,7 @@ def api_confirm_payment():
         if not work_month:
             return jsonify({'success': False, 'message': 'กรุณาระบุเดือนและปี'})
         
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # ตรวจสอบว่ามีข้อมูลในเดือนนั้นหรือไม่
@@ -3176,7 +5709,7 @@ def api_confirm_payment():
         })
         
     except Exception as e:
-        print(f"❌ เกิดข้อผิดพลาดใน api_confirm_payment: {str(e)}")
+        logger.error('❌ เกิดข้อผิดพลาดใน api_confirm_payment: %s', e)
         return jsonify({'success': False, 'message': f'เกิดข้อผิดพลาด: {str(e)}'})
 
 @app.route('/api/salary/payment-status/<work_month>')
@@ -3185,7 +5718,7 @@ def api_confirm_payment():
 def api_payment_status(work_month):
     """API สำหรับตรวจสอบสถานะการยืนยันการจ่ายเงินเดือน"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # ตรวจสอบสถานะการยืนยัน
@@ -3214,9 +5747,37 @@ def api_payment_status(work_month):
             })
         
     except Exception as e:
-        print(f"❌ เกิดข้อผิดพลาดใน api_payment_status: {str(e)}")
+        logger.error('❌ เกิดข้อผิดพลาดใน api_payment_status: %s', e)
         return jsonify({'success': False, 'message': f'เกิดข้อผิดพลาด: {str(e)}'})
 
+def load_month_weight_ranges(cursor, work_month):
+    """จำนวนชิ้นและยอดเงินแยกตามช่วงน้ำหนักของพนักงานทุกคนในเดือน ด้วย query เดียว
+    
+    คืน dict {employee_id: [{'pieces', 'amount', 'rate'} x 10]}
+    """
+    cursor.execute('''
+        SELECT 
+            employee_id,
+            weight_range_index as range_index,
+            COUNT(*) as pieces,
+            SUM(total_amount) as amount
+        FROM employee_salary_records 
+        WHERE work_month = ?
+        GROUP BY employee_id, range_index
+    ''', (work_month,))
+    
+    ranges_by_employee = {}
+    for emp_id, range_index, piece_count, range_amount in cursor.fetchall():
+        if range_index is None or not 0 <= range_index < 10:
+            continue
+        weight_ranges = ranges_by_employee.setdefault(emp_id, [{'pieces': 0, 'amount': 0, 'rate': 0}] * 10)
+        weight_ranges[range_index] = {
+            'pieces': piece_count,
+            'amount': range_amount or 0,
+            'rate': 0
+        }
+    return ranges_by_employee
+
 @app.route('/api/test-salary-data')
 def api_test_salary_data():
     """API endpoint ทดสอบที่ไม่ต้องใช้ authentication"""
@@ -3224,7 +5785,7 @@ def api_test_salary_data():
         month = request.args.get('month', '6')
         year = request.args.get('year', '2025')
         
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # ดึงข้อมูลจาก employee_salary_records (ข้อมูลจริงจากการอัพโหลด)
@@ -3240,7 +5801,8 @@ def api_test_salary_data():
                 e.employment_type,
                 e.base_salary,
                 e.rate_type,
-                e.status
+                e.status,
+                e.zone
             FROM employee_salary_records esr
             LEFT JOIN employees e ON esr.employee_id = e.employee_id
             WHERE esr.work_month = ?
@@ -3248,12 +5810,12 @@ def api_test_salary_data():
         '''
         params = [f"{year}-{month.zfill(2)}"]
         
-        print(f"🔍 ทดสอบ API - ค้นหาข้อมูลเดือน {month}/{year} (work_month: {params[0]})")
+        logger.debug('🔍 ทดสอบ API - ค้นหาข้อมูลเดือน %s/%s (work_month: %s)', month, year, params[0])
         
         cursor.execute(query, params)
         salary_data = cursor.fetchall()
         
-        print(f"📊 พบข้อมูล {len(salary_data)} รายการ")
+        logger.debug('📊 พบข้อมูล %s รายการ', len(salary_data))
         
         # แปลงข้อมูลเป็น format ที่ template ต้องการ
         employee_data = []
@@ -3263,14 +5825,17 @@ def api_test_salary_data():
         employees_without_rates = 0
         unmatched_packages = 0
         
-        print(f"=== แสดงผลลัพธ์ในเมนูสรุปเงินได้พนักงาน ===")
-        print(f"📊 ข้อมูลเดือน {month}/{year} - พนักงานทั้งหมด: {len(salary_data)} คน")
+        logger.debug('=== แสดงผลลัพธ์ในเมนูสรุปเงินได้พนักงาน ===')
+        logger.debug('📊 ข้อมูลเดือน %s/%s - พนักงานทั้งหมด: %s คน', month, year, len(salary_data))
+        
+        rate_book = get_rate_book(conn)
+        ranges_by_employee = load_month_weight_ranges(cursor, params[0])
         
         for data in salary_data:
             (emp_id, pieces, amount, work_month, name, position, branch_code, 
-             emp_type, base_salary, rate_type, status) = data
+             emp_type, base_salary, rate_type, status, zone) = data
             
-            print(f"  - {emp_id}: {name}, {pieces} ชิ้น, ฿{amount:,.2f}")
+            logger.debug('  - %s: %s, %s ชิ้น, ฿%.2f', emp_id, name, pieces, amount or 0)
             
             # ตรวจสอบสถานะเรท
             rate_status = 'no_rate'
@@ -3285,71 +5850,23 @@ def api_test_salary_data():
                 rate_status = 'unmatched'
                 unmatched_packages += pieces or 0
             
-            # คำนวณข้อมูลช่วงน้ำหนักจาก weight
+            # ข้อมูลช่วงน้ำหนักของพนักงาน (โหลดทั้งเดือนไว้แล้วด้วย query เดียว)
             weight_ranges = []
             if emp_id:
-                cursor.execute('''
-                    SELECT 
-                        CASE 
-                            WHEN weight <= 0.5 THEN 0
-                            WHEN weight <= 1.0 THEN 1
-                            WHEN weight <= 1.5 THEN 2
-                            WHEN weight <= 2.0 THEN 3
-                            WHEN weight <= 2.5 THEN 4
-                            WHEN weight <= 3.0 THEN 5
-                            WHEN weight <= 5.0 THEN 6
-                            WHEN weight <= 10.0 THEN 7
-                            WHEN weight <= 15.0 THEN 8
-                            ELSE 9
-                        END as range_index,
-                        COUNT(*) as pieces,
-                        SUM(total_amount) as amount
-                    FROM employee_salary_records 
-                    WHERE employee_id = ? AND work_month = ?
-                    GROUP BY range_index
-                    ORDER BY range_index
-                ''', (emp_id, work_month))
-                
-                range_data = cursor.fetchall()
-                weight_ranges = [{'pieces': 0, 'amount': 0, 'rate': 0}] * 10
-                
-                for range_index, piece_count, range_amount in range_data:
-                    if 0 <= range_index < 10:
-                        weight_ranges[range_index] = {
-                            'pieces': piece_count,
-                            'amount': range_amount or 0,
-                            'rate': 0
-                        }
+                weight_ranges = ranges_by_employee.get(emp_id) or [{'pieces': 0, 'amount': 0, 'rate': 0}] * 10
             
-            # ดึงข้อมูลเรทจาก piece_rates (ถ้ามี)
+            # ดึงข้อมูลเรทจาก RateBook (ถ้ามี)
             piece_rate_bonus = 0
             allowance = 0
             allowance_bonus = 0
             
-            if position and emp_type:
-                cursor.execute("""
-                    SELECT piece_rate_bonus, allowance, allowance_tiers
-                    FROM piece_rates 
-                    WHERE position = ? AND salary_type = ? 
-                    AND (branch_code = ? OR branch_code = 'ทุกสาขา')
-                    LIMIT 1
-                """, (position, emp_type, branch_code))
-                
-                rate_data = cursor.fetchone()
-                if rate_data:
-                    piece_rate_bonus = rate_data[0] or 0
-                    allowance = rate_data[1] or 0
-                    # คำนวณ allowance_bonus จาก allowance_tiers ถ้ามี
-                    if rate_data[2]:
-                        try:
-                            allowance_tiers = json.loads(rate_data[2])
-                            # คำนวณ allowance_bonus ตามจำนวนชิ้น
-                            if pieces and allowance_tiers:
-                                for tier in allowance_tiers:
-                                    if pieces >= tier.get('min_packages', 0):
-                                        allowance_bonus = tier.get('bonus', 0)
-                        except:
-                            pass
+            rate = rate_book.resolve(position, rate_type, zone, branch_code) if position else None
+            if rate:
+                piece_rate_bonus = rate.piece_rate_bonus
+                allowance = rate.allowance
+                # คำนวณ allowance_bonus ตามจำนวนชิ้นจาก allowance_tiers ถ้ามี
+                if pieces:
+                    allowance_bonus = rate.tier_allowance(pieces) or 0
             
             # คำนวณยอดรวม - รวมเงินเดือนจากเรทจริง
             base_salary_amount = base_salary or 0
@@ -3367,7 +5884,7 @@ def api_test_salary_data():
             
             total_emp_amount = base_salary_amount + piece_rate_amount + allowance_amount + allowance_bonus_amount + piece_work_amount
             
-            print(f"    💰 เงินเดือน: ฐาน={base_salary_amount:,.2f}, ชิ้น={piece_rate_amount:,.2f}, สมทบ={allowance_amount:,.2f}, โบนัส={allowance_bonus_amount:,.2f}, งาน={piece_work_amount:,.2f}, รวม={total_emp_amount:,.2f}")
+            logger.debug('    💰 เงินเดือน: ฐาน=%.2f, ชิ้น=%.2f, สมทบ=%.2f, โบนัส=%.2f, งาน=%.2f, รวม=%.2f', base_salary_amount, piece_rate_amount, allowance_amount, allowance_bonus_amount, piece_work_amount, total_emp_amount)
             
             employee_info = {
                 'employee_id': emp_id,
@@ -3404,7 +5921,7 @@ def api_test_salary_data():
         return jsonify({'employees': employee_data, 'summary': summary})
         
     except Exception as e:
-        print(f"❌ เกิดข้อผิดพลาดใน api_test_salary_data: {str(e)}")
+        logger.error('❌ เกิดข้อผิดพลาดใน api_test_salary_data: %s', e)
         return jsonify({'error': f'เกิดข้อผิดพลาด: {str(e)}'})
 
 @app.route('/api/piece-rate/<int:rate_id>')
@@ -3413,7 +5930,7 @@ def api_test_salary_data():
 def api_get_piece_rate(rate_id):
     """ดึงข้อมูลเรทตาม ID"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -3464,10 +5981,10 @@ def api_get_piece_rate(rate_id):
 @role_required(['GM', 'MD', 'HR', 'การเงิน'])
 def api_save_piece_rate():
     """บันทึกข้อมูลเรท"""
-    print("API endpoint /api/piece-rate/save called")  # Debug log
+    logger.debug('API endpoint /api/piece-rate/save called')
     try:
         data = request.get_json()
-        print(f"Received data: {data}")  # Debug log
+        logger.debug('Received data: %s', data)
         
         # ตรวจสอบข้อมูลที่จำเป็น
         required_fields = ['position', 'zone', 'branch_code', 'salary_type']
@@ -3493,21 +6010,31 @@ def api_save_piece_rate():
         except (ValueError, TypeError) as e:
             return jsonify({'success': False, 'error': f'ข้อมูลตัวเลขไม่ถูกต้อง: {str(e)}'}), 400
         
-        conn = sqlite3.connect('database/daex_system.db')
+        # ตรวจสอบและแปลงขั้นเงินสมทบครั้งเดียวตอนบันทึก (ผู้อ่านใช้ allowance_tier_table โดยไม่ต้องแปลง JSON อีก)
+        allowance_tiers = data.get('allowance_tiers', '')
+        tier_table, tier_error = compile_allowance_tiers(allowance_tiers)
+        if tier_error:
+            return jsonify({'success': False, 'error': tier_error}), 400
+        
+        conn = get_db()
         cursor = conn.cursor()
         
+        # ตำแหน่งที่ต้องคำนวณเงินเดือนใหม่: ตำแหน่งของเรทเดิม (ถ้าแก้ไข) และตำแหน่งใหม่
+        affected_positions = [data['position']]
+        
         if data.get('piece_rate_id'):  # ใช้ piece_rate_id แทน id
+            affected_positions += rate_positions(cursor, data['piece_rate_id'])
             # อัปเดตข้อมูลที่มีอยู่
             cursor.execute("""
                 UPDATE piece_rates SET
                     position = ?, zone = ?, branch_code = ?, salary_type = ?,
-                    base_salary = ?, piece_rate_bonus = ?, allowance = ?, allowance_tiers = ?,
+                    base_salary = ?, piece_rate_bonus = ?, allowance = ?, allowance_tiers = ?, allowance_tier_table = ?,
                     weight_range_1 = ?, weight_range_2 = ?, weight_range_3 = ?, weight_range_4 = ?, weight_range_5 = ?,
                     weight_range_6 = ?, weight_range_7 = ?, weight_range_8 = ?, weight_range_9 = ?, weight_range_10 = ?
                 WHERE id = ?
             """, (
                 data['position'], data['zone'], data['branch_code'], data['salary_type'],
-                base_salary, piece_rate_bonus, allowance, data.get('allowance_tiers', ''),
+                base_salary, piece_rate_bonus, allowance, allowance_tiers, tier_table.pack(),
                 weight_range_1, weight_range_2, weight_range_3, weight_range_4, weight_range_5,
                 weight_range_6, weight_range_7, weight_range_8, weight_range_9, weight_range_10,
                 data['piece_rate_id']
@@ -3517,24 +6044,26 @@ def api_save_piece_rate():
             cursor.execute("""
                 INSERT INTO piece_rates (
                     position, zone, branch_code, salary_type, base_salary, piece_rate_bonus, 
-                    allowance, allowance_tiers, weight_range_1, weight_range_2, weight_range_3, 
+                    allowance, allowance_tiers, allowance_tier_table, weight_range_1, weight_range_2, weight_range_3, 
                     weight_range_4, weight_range_5, weight_range_6, weight_range_7, weight_range_8, 
                     weight_range_9, weight_range_10
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             """, (
                 data['position'], data['zone'], data['branch_code'], data['salary_type'],
-                base_salary, piece_rate_bonus, allowance, data.get('allowance_tiers', ''),
+                base_salary, piece_rate_bonus, allowance, allowance_tiers, tier_table.pack(),
                 weight_range_1, weight_range_2, weight_range_3, weight_range_4, weight_range_5,
                 weight_range_6, weight_range_7, weight_range_8, weight_range_9, weight_range_10
             ))
         
+        bump_data_version(cursor, 'piece_rates')
+        refresh_payroll_snapshot(cursor, positions=affected_positions)
         conn.commit()
         conn.close()
         
         return jsonify({'success': True, 'message': 'บันทึกข้อมูลเรทสำเร็จ'})
         
     except Exception as e:
-        print(f"Error in api_save_piece_rate: {str(e)}")  # Debug log
+        logger.error('Error in api_save_piece_rate: %s', e)
         return jsonify({'success': False, 'error': f'เกิดข้อผิดพลาด: {str(e)}'}), 500
 
 @app.route('/api/piece-rate/<int:rate_id>/delete', methods=['DELETE'])
@@ -3543,10 +6072,13 @@ def api_save_piece_rate():
 def api_delete_piece_rate(rate_id):
     """ลบข้อมูลเรท"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
+        affected_positions = rate_positions(cursor, rate_id)
         cursor.execute("DELETE FROM piece_rates WHERE id = ?", (rate_id,))
+        bump_data_version(cursor, 'piece_rates')
+        refresh_payroll_snapshot(cursor, positions=affected_positions)
         conn.commit()
         conn.close()
         
@@ -3569,10 +6101,22 @@ def api_update_piece_rate_field():
         if not all([rate_id, field, value]):
             return jsonify({'error': 'ข้อมูลไม่ครบถ้วน'}), 400
         
-        conn = sqlite3.connect('database/daex_system.db')
+        if field == 'allowance_tier_table':
+            return jsonify({'error': 'allowance_tier_table คำนวณจาก allowance_tiers - แก้ไขที่ allowance_tiers แทน'}), 400
+        if field == 'allowance_tiers':
+            tier_table, tier_error = compile_allowance_tiers(value)
+            if tier_error:
+                return jsonify({'error': tier_error}), 400
+        
+        conn = get_db()
         cursor = conn.cursor()
         
+        affected_positions = rate_positions(cursor, rate_id)
         cursor.execute(f"UPDATE piece_rates SET {field} = ? WHERE id = ?", (value, rate_id))
+        if field == 'allowance_tiers':
+            cursor.execute("UPDATE piece_rates SET allowance_tier_table = ? WHERE id = ?", (tier_table.pack(), rate_id))
+        bump_data_version(cursor, 'piece_rates')
+        refresh_payroll_snapshot(cursor, positions=affected_positions + rate_positions(cursor, rate_id))
         conn.commit()
         conn.close()
         
@@ -3584,13 +6128,14 @@ def api_update_piece_rate_field():
 @app.route('/api/piece-rate/by-zone-branch')
 @login_required
 @role_required(['GM', 'MD', 'HR', 'การเงิน'])
+@cached_response(tables=('piece_rates',))
 def api_get_piece_rates_by_zone_branch():
     """ดึงข้อมูลเรทตามโซนและสาขา"""
     try:
         zone = request.args.get('zone', '')
         branch = request.args.get('branch', '')
         
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         query = """
@@ -3653,7 +6198,7 @@ def api_get_piece_rates_by_zone_branch():
 def api_get_employee_rate(employee_id):
     """ดึงข้อมูลเรทของพนักงาน"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # ดึงข้อมูลพนักงาน
@@ -3677,22 +6222,17 @@ def api_get_employee_rate(employee_id):
             'rate_type': employee_data[6]
         }
         
-        # ดึงข้อมูลเรทจาก piece_rates
-        cursor.execute("""
-            SELECT id, base_salary, piece_rate_bonus, allowance, allowance_tiers
-            FROM piece_rates 
-            WHERE position = ? AND (zone = ? OR zone = 'ทุกสาขา') AND (branch_code = ? OR branch_code = 'ทุกสาขา')
-            ORDER BY zone DESC, branch_code DESC
-            LIMIT 1
-        """, (employee['position'], employee['zone'], employee['branch_code']))
+        # ดึงข้อมูลเรทจาก RateBook (สาขาเฉพาะ -> ทุกสาขา)
+        rate_entry = get_rate_book(conn).resolve(
+            employee['position'], employee['rate_type'], employee['zone'], employee['branch_code']
+        )
         
-        rate_data = cursor.fetchone()
         rate = {
-            'id': rate_data[0] if rate_data else None,
-            'base_salary': rate_data[1] if rate_data else 0,
-            'piece_rate': rate_data[2] if rate_data else 0,
-            'allowance': rate_data[3] if rate_data else 0,
-            'allowance_tiers': rate_data[4] if rate_data else None,
+            'id': rate_entry.id if rate_entry else None,
+            'base_salary': rate_entry.base_salary if rate_entry else 0,
+            'piece_rate': rate_entry.piece_rate_bonus if rate_entry else 0,
+            'allowance': rate_entry.allowance if rate_entry else 0,
+            'allowance_tiers': rate_entry.allowance_tiers_raw if rate_entry else None,
             'zone': employee['zone'],
             'bonus_rate': 0  # ค่าเริ่มต้น
         }
@@ -3726,7 +6266,7 @@ def api_update_employee_rate():
         if not employee_id:
             return jsonify({'success': False, 'message': 'ไม่พบรหัสพนักงาน'})
         
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # อัปเดตข้อมูลพนักงาน
@@ -3766,7 +6306,12 @@ def api_update_employee_rate():
                     INSERT INTO piece_rates (position, zone, branch_code, salary_type, base_salary, piece_rate_bonus, allowance)
                     VALUES (?, ?, ?, 'piece_rate', ?, ?, ?)
                 """, (position, zone, branch_code, base_salary, piece_rate, allowance))
+            
+            bump_data_version(cursor, 'piece_rates')
+            refresh_payroll_snapshot(cursor, positions=[position])
         
+        bump_data_version(cursor, 'employees')
+        refresh_payroll_snapshot(cursor, employee_ids=[employee_id])
         conn.commit()
         conn.close()
         
@@ -3777,10 +6322,11 @@ def api_update_employee_rate():
 
 @app.route('/api/dashboard/summary')
 @login_required
+@cached_response(tables=('employees', 'salaries', 'leave_requests', 'salary_uploads'))
 def api_dashboard_summary():
     """API สำหรับข้อมูลสรุป dashboard"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # นับจำนวนพนักงานทั้งหมด
@@ -3820,7 +6366,7 @@ def api_dashboard_summary():
 def api_dashboard_recent_activity():
     """API สำหรับกิจกรรมล่าสุด"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # ดึงข้อมูลกิจกรรมล่าสุด (จำลองข้อมูล)
@@ -3909,31 +6455,12 @@ def calculate_salary_unified(employee_data, rate_data, pieces):
                 piece_amount = pieces * piece_rate_per_piece
         
         # คำนวณเงินสมทบตาม allowance_tiers (ช่องหมายเหตุ)
+        # ขั้นเงินสมทบที่แปลงไว้แล้วจาก RateEntry หรือ JSON ดิบ (แปลงด้วย compile_allowance_tiers) - หาขั้นด้วย binary search
         final_allowance = allowance
         if allowance_tiers:
-            try:
-                import json
-                # ตรวจสอบว่า allowance_tiers เป็น JSON string หรือไม่
-                if isinstance(allowance_tiers, str) and allowance_tiers.startswith('['):
-                    tiers = json.loads(allowance_tiers)
-                else:
-                    # ถ้าไม่ใช่ JSON string ให้ใช้ค่าเดิม
-                    tiers = allowance_tiers
-                
-                if tiers and isinstance(tiers, list):
-                    # หาเงินสมทบสูงสุดที่ตรงกับจำนวนชิ้น
-                    for tier in tiers:
-                        if 'pieces' in tier and 'amount' in tier:
-                            if pieces >= tier['pieces']:
-                                final_allowance = float(tier['amount'])
-                                # ไม่ break เพื่อให้ตรวจสอบเกณฑ์ที่สูงกว่าต่อไป
-                        elif 'min_pieces' in tier and 'allowance' in tier:
-                            if pieces >= tier['min_pieces']:
-                                final_allowance = float(tier['allowance'])
-                                # ไม่ break เพื่อให้ตรวจสอบเกณฑ์ที่สูงกว่าต่อไป
-            except Exception as e:
-                print(f"❌ Error parsing allowance_tiers: {e}")
-                final_allowance = allowance
+            tier_amount = allowance_tier_table(allowance_tiers).lookup(pieces)
+            if tier_amount is not None:
+                final_allowance = tier_amount
         
         # คำนวณเงินรวม
         total_amount = base_salary + piece_amount + final_allowance
@@ -3946,7 +6473,7 @@ def calculate_salary_unified(employee_data, rate_data, pieces):
         }
         
     except Exception as e:
-        print(f"❌ Error in calculate_salary_unified: {e}")
+        logger.error('❌ Error in calculate_salary_unified: %s', e)
         return {
             'base_salary': 0,
             'piece_rate_bonus': 0,
@@ -3954,6 +6481,73 @@ def calculate_salary_unified(employee_data, rate_data, pieces):
             'total_amount': 0
         }
 
+def allowance_tier_steps(allowance_tiers):
+    """ขั้นเงินสมทบเป็น numpy array (thresholds เรียงน้อยไปมาก, amounts) - แปลงด้วย allowance_tier_table เดียวกับ calculate_salary_unified
+    
+    จำนวนชิ้น p ได้ amounts[i] ของขั้นสุดท้ายที่ thresholds[i] <= p
+    """
+    table = allowance_tier_table(allowance_tiers)
+    return np.array(table.thresholds, dtype=float), np.array(table.amounts, dtype=float)
+
+def calculate_salary_batch(pieces, rate_rows, rate_types=None):
+    """คำนวณเงินเดือนของพนักงานหลายคนพร้อมกันด้วย NumPy - ให้ผลเหมือน calculate_salary_unified ทีละคน
+    
+    รับเฉพาะจำนวนชิ้นรวมต่อคน: calculate_salary_unified คิดเงินชิ้นเป็น จำนวนชิ้นรวม x weight_range_1
+    (ไม่แยกเรทตามช่วงน้ำหนัก) ฟังก์ชันนี้จึง vectorise เฉพาะเส้นทางยอดรวมนั้น - ถ้าจะคิดเรทรายช่วงต้องแก้ทั้งสองฟังก์ชันพร้อมกัน
+    
+    Parameters:
+    - pieces: จำนวนชิ้นรวมต่อคน (N)
+    - rate_rows: เรทของแต่ละคนในรูปแบบ tuple เดียวกับ rate_data (RateEntry.row) หรือ None
+    - rate_types: rate_type ของแต่ละคน (ถ้ามี) - 'base_salary' ไม่คิดเงินชิ้น
+    
+    Returns:
+    - dict ของ numpy array: base_salary, piece_rate_bonus, allowance, total_amount
+    """
+    pieces = np.asarray(pieces, dtype=float)
+    if pieces.ndim != 1:
+        raise ValueError('pieces ต้องเป็นจำนวนชิ้นรวมต่อคน (array 1 มิติ) - ไม่รองรับจำนวนชิ้นแยกช่วงน้ำหนัก')
+    count = len(pieces)
+    
+    # รวมเรทที่ซ้ำกัน (พนักงานส่วนใหญ่ใช้เรทร่วมกัน) แล้วสร้าง rate matrix ครั้งเดียว
+    unique_rows = {}
+    rate_index = np.full(count, -1, dtype=int)
+    for i, row in enumerate(rate_rows):
+        if row:
+            rate_index[i] = unique_rows.setdefault(id(row), (len(unique_rows), row))[0]
+    rates = [row for _, row in unique_rows.values()]
+    
+    rate_matrix = np.zeros((len(rates) + 1, 13))
+    for r, row in enumerate(rates):
+        rate_matrix[r, :len(row[:13])] = [float(value or 0) for value in row[:13]]
+    has_rate = rate_index >= 0
+    per_employee = rate_matrix[rate_index]  # แถวสุดท้าย (index -1) เป็นศูนย์สำหรับคนที่ไม่มีเรท
+    
+    base_salary = np.where(has_rate, per_employee[:, 0], 0.0)
+    base_allowance = np.where(has_rate, per_employee[:, 2], 0.0)
+    
+    # เงินชิ้น: จำนวนชิ้น x เรทช่วงแรก (ยกเว้นพนักงาน base_salary)
+    piece_amount = np.where(has_rate & (pieces > 0), pieces * per_employee[:, 3], 0.0)
+    if rate_types is not None:
+        piece_amount = np.where(np.asarray(rate_types, dtype=object) == 'base_salary', 0.0, piece_amount)
+    
+    # เงินสมทบตามขั้นจำนวนชิ้น: หาขั้นด้วย searchsorted ทีละเรท (ครั้งเดียวต่อกลุ่มพนักงานที่ใช้เรทเดียวกัน)
+    allowance = base_allowance.copy()
+    for r, row in enumerate(rates):
+        thresholds, amounts = allowance_tier_steps(row[13] if len(row) > 13 else None)
+        if not len(thresholds):
+            continue
+        members = np.flatnonzero(rate_index == r)
+        step = np.searchsorted(thresholds, pieces[members], side='right') - 1
+        reached = step >= 0
+        allowance[members[reached]] = amounts[step[reached]]
+    
+    return {
+        'base_salary': base_salary,
+        'piece_rate_bonus': piece_amount,
+        'allowance': allowance,
+        'total_amount': base_salary + piece_amount + allowance
+    }
+
 # API endpoints สำหรับจัดการ permissions
 @app.route('/api/permissions/<int:user_id>')
 @login_required
@@ -3961,7 +6555,7 @@ def calculate_salary_unified(employee_data, rate_data, pieces):
 def api_get_user_permissions(user_id):
     """ดึงข้อมูลสิทธิ์ของผู้ใช้"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # ดึงข้อมูลเมนูทั้งหมด
@@ -4013,7 +6607,7 @@ def api_update_user_permissions(user_id):
         data = request.get_json()
         permissions = data.get('permissions', [])
         
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # ลบสิทธิ์เดิม
@@ -4056,7 +6650,7 @@ def api_update_user_permissions(user_id):
 def api_get_users():
     """ดึงรายการผู้ใช้ทั้งหมด"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('SELECT id, username, role, name, email FROM users ORDER BY role, username')
@@ -4091,7 +6685,7 @@ def api_get_users():
 def api_get_user_by_username(username):
     """ดึงข้อมูลผู้ใช้ตาม username"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('SELECT id, username, role, name, email, branch_code FROM users WHERE username = ?', (username,))
@@ -4141,7 +6735,7 @@ def api_create_user():
                 'message': 'กรุณากรอกข้อมูลให้ครบถ้วน'
             })
         
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # ตรวจสอบว่ามี username นี้อยู่แล้วหรือไม่
@@ -4206,7 +6800,7 @@ def api_create_user():
 def api_delete_user(username):
     """ลบผู้ใช้"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # ตรวจสอบว่ามีผู้ใช้นี้หรือไม่
@@ -4311,10 +6905,11 @@ def mobile_app():
 @app.route('/api/vehicle/dashboard-stats')
 @login_required
 @role_required(['GM', 'MD', 'HR', 'การเงิน', 'SPV'])
+@cached_response(tables=('vehicles', 'vehicle_fuel_usage'))
 def api_vehicle_dashboard_stats():
     """API สำหรับข้อมูลสถิติ Dashboard รถ"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # นับรถทั้งหมด
@@ -4334,8 +6929,8 @@ def api_vehicle_dashboard_stats():
         cursor.execute('''
             SELECT COALESCE(SUM(total_cost), 0) 
             FROM vehicle_fuel_usage 
-            WHERE fuel_date LIKE ?
-        ''', (f'{current_month}%',))
+            WHERE fuel_date >= ? AND fuel_date < ?
+        ''', like_prefix_bounds(current_month))
         monthly_fuel_cost = cursor.fetchone()[0]
         
         conn.close()
@@ -4357,7 +6952,7 @@ def api_vehicle_dashboard_stats():
 def api_vehicle_recent_activities():
     """API สำหรับกิจกรรมล่าสุด"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # ดึงข้อมูลการใช้งานล่าสุด
@@ -4417,7 +7012,7 @@ def api_vehicle_recent_activities():
 def api_vehicle_notifications():
     """API สำหรับการแจ้งเตือน"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # ตรวจสอบว่าตาราง vehicle_notifications มีอยู่หรือไม่
@@ -4457,12 +7052,10 @@ def api_vehicle_notifications():
         return jsonify({'notifications': result})
         
     except sqlite3.OperationalError as e:
-        print(f"Vehicle notifications table error: {str(e)}")
+        logger.warning('Vehicle notifications table error: %s', e)
         return jsonify({'notifications': []})
     except Exception as e:
-        import traceback
-        error_msg = f"Error in api_vehicle_notifications: {str(e)}\n{traceback.format_exc()}"
-        print(error_msg)
+        logger.exception('Error in api_vehicle_notifications: %s', e)
         return jsonify({'notifications': []})
 
 @app.route('/api/vehicle/list')
@@ -4560,7 +7153,7 @@ def api_vehicle_maintenance_requests():
         branch_code = request.args.get('branch_code', '')
         vehicle_id = request.args.get('vehicle_id', '')
 
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         ensure_vehicle_maintenance_requests_table(cursor)
 
@@ -4597,8 +7190,8 @@ def api_vehicle_maintenance_requests():
 
         result = []
         for row in rows:
-            before_list = parse_images_json(row[17])
-            after_list = parse_images_json(row[18])
+            before_list = image_refs(row[17])
+            after_list = image_refs(row[18])
             result.append({
                 'id': row[0],
                 'vehicle_id': row[1],
@@ -4625,8 +7218,7 @@ def api_vehicle_maintenance_requests():
         return jsonify(result)
 
     except Exception as e:
-        import traceback
-        print(f"Error in api_vehicle_maintenance_requests: {str(e)}\n{traceback.format_exc()}")
+        logger.exception('Error in api_vehicle_maintenance_requests: %s', e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/vehicle/maintenance/requests', methods=['POST'])
@@ -4664,42 +7256,43 @@ def api_create_vehicle_maintenance_request():
             except ValueError:
                 return jsonify({'success': False, 'message': 'กรุณาระบุประมาณการค่าใช้จ่ายเป็นตัวเลข'}), 400
 
-        quote_filename, quote_data = encode_file_storage(request.files.get('quoteAttachment'))
-        if not quote_data:
+        conn = get_db()
+        cursor = conn.cursor()
+        ensure_vehicle_maintenance_requests_table(cursor)
+
+        # ไฟล์แนบเก็บในคลังไฟล์ แถวเก็บเฉพาะ hash
+        quote_filename, quote_hash = store_uploaded_file(cursor, request.files.get('quoteAttachment'))
+        if not quote_hash:
             return jsonify({'success': False, 'message': 'กรุณาแนบใบเสนอราคา'}), 400
 
         before_images_files = request.files.getlist('beforeImages[]')
-        before_images = encode_multiple_images(before_images_files)
+        before_images = store_uploaded_images(cursor, before_images_files)
         if len(before_images) == 0:
             return jsonify({'success': False, 'message': 'กรุณาแนบรูปภาพก่อนซ่อมอย่างน้อย 1 รูป'}), 400
 
-        conn = sqlite3.connect('database/daex_system.db')
-        cursor = conn.cursor()
-        ensure_vehicle_maintenance_requests_table(cursor)
-
         now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
         cursor.execute('''
             INSERT INTO vehicle_maintenance_requests (
                 vehicle_id, branch_code, request_date, maintenance_items,
-                garage_name, estimated_cost, quote_attachment, quote_filename,
+                garage_name, estimated_cost, quote_media_hash, quote_filename,
                 before_images, status, created_by, created_at, updated_at
             ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (
             vehicle_id, branch_code, request_date, maintenance_items,
-            garage_name, estimated_cost, quote_data, quote_filename,
+            garage_name, estimated_cost, quote_hash, quote_filename,
             json.dumps(before_images), 'requested', user_id, now_str, now_str
         ))
 
         request_id = cursor.lastrowid
         conn.commit()
+        schedule_media_variants()
         conn.close()
 
         return jsonify({'success': True, 'message': 'บันทึกคำขอซ่อมบำรุงเรียบร้อย', 'request_id': request_id})
 
     except Exception as e:
-        import traceback
-        print(f"Error in api_create_vehicle_maintenance_request: {str(e)}\n{traceback.format_exc()}")
+        logger.exception('Error in api_create_vehicle_maintenance_request: %s', e)
         return jsonify({'success': False, 'message': str(e)}), 500
 
 @app.route('/api/vehicle/maintenance/requests/<int:request_id>', methods=['GET'])
@@ -4708,7 +7301,7 @@ def api_create_vehicle_maintenance_request():
 def api_vehicle_maintenance_request_detail(request_id):
     """API สำหรับรายละเอียดคำขอซ่อมบำรุง"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         ensure_vehicle_maintenance_requests_table(cursor)
 
@@ -4719,7 +7312,8 @@ def api_vehicle_maintenance_request_detail(request_id):
                    vmr.created_at, vmr.updated_at, vmr.completion_date,
                    vmr.actual_cost, vmr.quote_attachment, vmr.quote_filename,
                    vmr.receipt_attachment, vmr.receipt_filename,
-                   vmr.before_images, vmr.after_images
+                   vmr.before_images, vmr.after_images,
+                   vmr.quote_media_hash, vmr.receipt_media_hash
             FROM vehicle_maintenance_requests vmr
             LEFT JOIN vehicles v ON vmr.vehicle_id = v.vehicle_id
             WHERE vmr.id = ?
@@ -4730,8 +7324,16 @@ def api_vehicle_maintenance_request_detail(request_id):
         if not row:
             return jsonify({'error': 'ไม่พบคำขอ'}), 404
 
-        before_images = parse_images_json(row[19])
-        after_images = parse_images_json(row[20])
+        before_images = normalize_image_field(row[19])
+        after_images = normalize_image_field(row[20])
+        
+        # ไฟล์แนบในคลังไฟล์: ส่ง URL และ base64 (รูปแบบเดิมสำหรับ client ที่ยังใช้ data:)
+        def attachment_fields(prefix, legacy_data, digest):
+            file_data = read_media(digest) if digest else None
+            return {
+                f'{prefix}_attachment': base64.b64encode(file_data).decode('utf-8') if file_data is not None else legacy_data,
+                f'{prefix}_url': media_url(digest) if digest else None
+            }
 
         return jsonify({
             'id': row[0],
@@ -4750,17 +7352,16 @@ def api_vehicle_maintenance_request_detail(request_id):
             'updated_at': row[12],
             'completion_date': row[13],
             'actual_cost': row[14],
-            'quote_attachment': row[15],
+            **attachment_fields('quote', row[15], row[21]),
             'quote_filename': row[16],
-            'receipt_attachment': row[17],
+            **attachment_fields('receipt', row[17], row[22]),
             'receipt_filename': row[18],
             'before_images': before_images,
             'after_images': after_images
         })
 
     except Exception as e:
-        import traceback
-        print(f"Error in api_vehicle_maintenance_request_detail: {str(e)}\n{traceback.format_exc()}")
+        logger.exception('Error in api_vehicle_maintenance_request_detail: %s', e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/vehicle/maintenance/requests/<int:request_id>/complete', methods=['POST'])
@@ -4769,7 +7370,7 @@ def api_vehicle_maintenance_request_detail(request_id):
 def api_complete_vehicle_maintenance_request(request_id):
     """API สำหรับบันทึกผลหลังซ่อมบำรุง (รอบที่ 2)"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         ensure_vehicle_maintenance_requests_table(cursor)
 
@@ -4799,13 +7400,13 @@ def api_complete_vehicle_maintenance_request(request_id):
                 conn.close()
                 return jsonify({'success': False, 'message': 'กรุณาระบุค่าใช้จ่ายจริงเป็นตัวเลข'}), 400
 
-        receipt_filename, receipt_data = encode_file_storage(request.files.get('receiptAttachment'))
-        if not receipt_data:
+        receipt_filename, receipt_hash = store_uploaded_file(cursor, request.files.get('receiptAttachment'))
+        if not receipt_hash:
             conn.close()
             return jsonify({'success': False, 'message': 'กรุณาแนบใบเสร็จ'}), 400
 
         after_images_files = request.files.getlist('afterImages[]')
-        after_images = encode_multiple_images(after_images_files)
+        after_images = store_uploaded_images(cursor, after_images_files)
         if len(after_images) == 0:
             conn.close()
             return jsonify({'success': False, 'message': 'กรุณาแนบรูปภาพหลังซ่อมอย่างน้อย 1 รูป'}), 400
@@ -4814,31 +7415,100 @@ def api_complete_vehicle_maintenance_request(request_id):
 
         cursor.execute('''
             UPDATE vehicle_maintenance_requests
-            SET actual_cost = ?, completion_date = ?, receipt_attachment = ?, receipt_filename = ?,
+            SET actual_cost = ?, completion_date = ?, receipt_media_hash = ?, receipt_filename = ?,
                 after_images = ?, status = ?, updated_at = ?
             WHERE id = ?
         ''', (
-            actual_cost, completion_date, receipt_data, receipt_filename,
+            actual_cost, completion_date, receipt_hash, receipt_filename,
             json.dumps(after_images), 'completed', now_str, request_id
         ))
 
         conn.commit()
+        schedule_media_variants()
         conn.close()
 
         return jsonify({'success': True, 'message': 'บันทึกผลการซ่อมบำรุงเรียบร้อย'})
 
     except Exception as e:
-        import traceback
-        print(f"Error in api_complete_vehicle_maintenance_request: {str(e)}\n{traceback.format_exc()}")
+        logger.exception('Error in api_complete_vehicle_maintenance_request: %s', e)
         return jsonify({'success': False, 'message': str(e)}), 500
 
+@app.route('/media/<digest>')
+@login_required
+def media_file(digest):
+    """ส่งไฟล์จากคลังไฟล์ตาม hash - รองรับ ETag/If-None-Match และ Range (ไฟล์ไม่เปลี่ยนจึง cache ได้ถาวร)
+    
+    ?variant=thumb|preview ส่งรูปย่อแทนต้นฉบับ ถ้ายังสร้างไม่เสร็จจะส่งต้นฉบับไปก่อนโดยไม่ให้ cache ถาวร
+    เฉพาะ MEDIA_INLINE_TYPES ที่เปิดใน browser ได้ ชนิดอื่นส่งเป็น application/octet-stream แบบดาวน์โหลด
+    """
+    if not MEDIA_HASH_PATTERN.match(digest):
+        return jsonify({'error': 'ไม่พบไฟล์'}), 404
+    variant = request.args.get('variant', 'original')
+    if variant != 'original' and variant not in MEDIA_VARIANTS:
+        return jsonify({'error': f'ไม่รู้จักขนาดรูป {variant}'}), 400
+    
+    cursor = get_db().cursor()
+    serve_digest = digest
+    variant_ready = True
+    if variant != 'original':
+        try:
+            cursor.execute('SELECT sha256 FROM media_variants WHERE source_sha256 = ? AND variant = ?', (digest, variant))
+            row = cursor.fetchone()
+        except sqlite3.OperationalError:
+            row = None
+        if row is None:
+            # ยังไม่ได้สร้าง - ปลุก thread เบื้องหลังแล้วส่งต้นฉบับไปก่อน
+            variant_ready = False
+            schedule_media_variants()
+        elif row[0]:
+            serve_digest = row[0]
+    
+    path = media_path(serve_digest)
+    if not os.path.exists(path):
+        return jsonify({'error': 'ไม่พบไฟล์'}), 404
+    
+    try:
+        cursor.execute('SELECT mime_type FROM media_blobs WHERE sha256 = ?', (serve_digest,))
+        row = cursor.fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    if row and row[0]:
+        mime_type = row[0]
+    else:
+        with open(path, 'rb') as f:
+            mime_type = guess_media_type(f.read(16))
+    
+    download_name = request.args.get('name')
+    inline = mime_type in MEDIA_INLINE_TYPES
+    response = send_file(
+        os.path.abspath(path),
+        mimetype=mime_type if inline else 'application/octet-stream',
+        as_attachment=bool(download_name) or not inline,
+        download_name=download_name or serve_digest,
+        conditional=True,
+        etag=serve_digest,
+        max_age=365 * 24 * 3600 if variant_ready else 0
+    )
+    # ห้าม browser เดาชนิดไฟล์เองจากเนื้อไฟล์ (ไฟล์ที่ผู้ใช้อัพโหลด)
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    # ไฟล์ของผู้ใช้ที่ล็อกอิน - ห้าม proxy กลางเก็บ cache
+    response.cache_control.public = False
+    response.cache_control.private = True
+    if variant_ready:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    if response.status_code in (200, 206):
+        metrics.inc('daex_media_bytes_served_total', response.content_length or 0, variant=variant if variant_ready else 'original')
+    return response
+
 @app.route('/api/vehicle/statistics')
 @login_required
 @role_required(['GM', 'MD', 'HR', 'การเงิน', 'SPV'])
 def api_vehicle_statistics():
     """API สำหรับสถิติรถ"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # นับรถทั้งหมด
@@ -4872,10 +7542,11 @@ def api_vehicle_statistics():
 @app.route('/api/vehicle/drivers')
 @login_required
 @role_required(['GM', 'MD', 'HR', 'การเงิน', 'SPV'])
+@cached_response(tables=('employees',))
 def api_vehicle_drivers():
     """API สำหรับรายการคนขับ"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('SELECT employee_id, name FROM employees WHERE status = "active" ORDER BY name')
@@ -4898,6 +7569,7 @@ def api_vehicle_drivers():
 @app.route('/api/branches')
 @login_required
 @role_required(['GM', 'MD', 'HR', 'การเงิน', 'SPV'])
+@cached_response(ttl=3600)
 def api_branches():
     """API สำหรับรายการสาขา"""
     try:
@@ -4920,7 +7592,7 @@ def api_branches():
 def api_vehicle_edit(vehicle_id):
     try:
         data = request.get_json()
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         cursor.execute('''
             UPDATE vehicles SET
@@ -4960,6 +7632,7 @@ def api_vehicle_edit(vehicle_id):
             data.get('registration_expiry'),
             vehicle_id
         ))
+        bump_data_version(cursor, 'vehicles')
         conn.commit()
         conn.close()
         return jsonify({'success': True})
@@ -4976,7 +7649,7 @@ def api_vehicle_detail_alias(vehicle_id):
 def api_vehicle_details(vehicle_id):
     """API สำหรับรายละเอียดรถ"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # ดึงข้อมูลรถ
@@ -5050,7 +7723,7 @@ def api_vehicle_add():
     try:
         data = request.get_json()
         
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -5066,6 +7739,7 @@ def api_vehicle_add():
             data['assigned_driver_id'], data['purchase_date'], data['purchase_price'],
             data['insurance_expiry'], data['registration_expiry']
         ))
+        bump_data_version(cursor, 'vehicles')
         
         conn.commit()
         conn.close()
@@ -5081,10 +7755,11 @@ def api_vehicle_add():
 def api_vehicle_delete(vehicle_id):
     """API สำหรับลบรถ"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('DELETE FROM vehicles WHERE vehicle_id = ?', (vehicle_id,))
+        bump_data_version(cursor, 'vehicles')
         conn.commit()
         conn.close()
         
@@ -5101,7 +7776,7 @@ def api_vehicle_register_usage():
     try:
         data = request.get_json()
         
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -5202,6 +7877,10 @@ def api_vehicle_check():
             'overallImage': 'overall_image'
         }
         
+        conn = get_db()
+        cursor = conn.cursor()
+        
+        # รูปภาพเก็บในคลังไฟล์ - คอลัมน์เก็บ JSON อ้างอิง hash
         image_data = {}
         max_images_per_field = 3
         # อ่านรูปภาพ field ใหม่ (รองรับหลายไฟล์)
@@ -5213,8 +7892,8 @@ def api_vehicle_check():
                     files = [single_file]
             
             if files:
-                encoded_images = encode_multiple_images(files[:max_images_per_field])
-                image_data[db_field] = json.dumps(encoded_images) if encoded_images else None
+                stored_images = store_uploaded_images(cursor, files[:max_images_per_field])
+                image_data[db_field] = json.dumps(stored_images) if stored_images else None
             else:
                 image_data[db_field] = None
         
@@ -5222,14 +7901,8 @@ def api_vehicle_check():
         for form_field, db_field in old_image_fields_map.items():
             if db_field not in image_data or image_data[db_field] is None:
                 file = request.files.get(form_field)
-                if file and file.filename:
-                    filename, encoded = encode_file_storage(file)
-                    image_data[db_field] = encoded
-                else:
-                    image_data[db_field] = None
-        
-        conn = sqlite3.connect('database/daex_system.db')
-        cursor = conn.cursor()
+                stored_images = store_uploaded_images(cursor, [file]) if file and file.filename else []
+                image_data[db_field] = json.dumps(stored_images) if stored_images else None
         
         # ตรวจสอบและเพิ่ม column ใหม่ถ้ายังไม่มี
         cursor.execute("PRAGMA table_info(vehicle_weekly_checks)")
@@ -5273,9 +7946,9 @@ def api_vehicle_check():
             if col_name not in columns:
                 try:
                     cursor.execute(f'ALTER TABLE vehicle_weekly_checks ADD COLUMN {col_name} {col_type}')
-                    print(f"Added column {col_name} to vehicle_weekly_checks")
+                    logger.info('Added column %s to vehicle_weekly_checks', col_name)
                 except sqlite3.OperationalError as e:
-                    print(f"Error adding column {col_name}: {e}")
+                    logger.error('Error adding column %s: %s', col_name, e)
         
         conn.commit()
         
@@ -5337,23 +8010,85 @@ def api_vehicle_check():
         ''', tuple(values))
         
         conn.commit()
+        schedule_media_variants()
         conn.close()
         
         return jsonify({'success': True, 'message': 'บันทึกการตรวจเช็คสำเร็จ'})
         
     except Exception as e:
-        import traceback
-        error_msg = f"Error: {str(e)}\n{traceback.format_exc()}"
-        print(error_msg)  # Debug log
+        logger.exception('Error in api_vehicle_check: %s', e)
         return jsonify({'success': False, 'message': str(e)}), 500
 
+# คอลัมน์รูปภาพของ vehicle_weekly_checks (field ใหม่ก่อน ตามด้วย field เก่า)
+VEHICLE_CHECK_IMAGE_FIELDS = (
+    'oil_image', 'battery_image', 'tires_image', 'brake_fluid_image',
+    'clutch_fluid_image', 'ac_fluid_image', 'coolant_image',
+    'doors_image', 'lights_image', 'mirrors_image', 'others_image',
+    'hood_image', 'driver_cabin_image', 'cargo_area_image',
+    'engine_image', 'body_image', 'brakes_image', 'interior_image',
+    'overall_image'
+)
+
+# export ขนาดใหญ่: ดึงแถวจากฐานข้อมูลทีละชุด และเก็บไฟล์ผลลัพธ์ในหน่วยความจำไม่เกินขนาดนี้ก่อนย้ายลงดิสก์
+EXPORT_FETCH_ROWS = 200
+EXPORT_SPOOL_MAX_BYTES = 8 * 1024 * 1024
+EXPORT_MIN_COLUMN_WIDTH = 12
+# openpyxl เก็บรูปที่ฝังทั้งหมดไว้ในหน่วยความจำจนกว่าจะ save - เกินจำนวนนี้ใส่ลิงก์ไปยัง /media แทนการฝังรูป
+EXPORT_MAX_EMBEDDED_IMAGES = 300
+
+def iter_cursor_batches(cursor, size=EXPORT_FETCH_ROWS):
+    """อ่านผลลัพธ์ของ cursor ทีละชุดด้วย fetchmany - ไม่โหลดทั้งตารางเข้าหน่วยความจำ"""
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield rows
+
+def iter_csv_chunks(header, row_batches, transform=None):
+    """แปลงแถวเป็น CSV ที่ encode แล้วทีละชุด - ก้อนแรกมี UTF-8 BOM เพื่อให้ Excel อ่านภาษาไทยถูกต้อง"""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    yield codecs.BOM_UTF8 + buffer.getvalue().encode('utf-8')
+    for rows in row_batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows if transform is None else map(transform, rows))
+        yield buffer.getvalue().encode('utf-8')
+
+def iter_gzip_chunks(chunks):
+    """บีบอัดแบบ gzip ทีละก้อนระหว่างส่ง (wbits=31 คือรูปแบบ gzip)"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def csv_stream_response(filename, header, row_batches, transform=None):
+    """Response ไฟล์ CSV แบบ streaming (query ต้องรันแล้ว เพื่อให้ error ของ SQL ตอบกลับเป็น JSON ได้ตามปกติ)
+    
+    บีบอัด gzip เมื่อ client รับได้ ส่ง ?gzip=0 เพื่อปิด
+    """
+    chunks = iter_csv_chunks(header, row_batches, transform)
+    headers = {'Content-Disposition': f'attachment; filename={filename}', 'Vary': 'Accept-Encoding'}
+    if request.args.get('gzip') != '0' and 'gzip' in request.accept_encodings:
+        chunks = iter_gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    # stream_with_context ให้การเชื่อมต่อฐานข้อมูลของ request ยังใช้ได้จนส่งครบ
+    return Response(stream_with_context(chunks), mimetype='text/csv', headers=headers)
+
 @app.route('/api/vehicle/check-history')
 @login_required
 @role_required(['GM', 'MD', 'HR', 'การเงิน', 'SPV'])
 def api_vehicle_check_history():
-    """API สำหรับประวัติการตรวจเช็คสภาพรถ"""
+    """API สำหรับประวัติการตรวจเช็คสภาพรถ
+    
+    ค่าเริ่มต้นส่งเฉพาะจำนวนรูปต่อ field (image_counts นับใน SQL ไม่อ่านคอลัมน์รูปภาพ) ตัวรูปดึงผ่าน
+    /api/vehicle/check-history/<id>/images/<field> - ส่ง ?images=full เพื่อรับ base64 ในรายการแบบเดิม
+    """
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # ตรวจสอบว่าตาราง vehicle_weekly_checks มีอยู่หรือไม่
@@ -5371,6 +8106,7 @@ def api_vehicle_check_history():
         vehicle_id = request.args.get('vehicle_id', '')
         start_date = request.args.get('start_date', '')
         end_date = request.args.get('end_date', '')
+        full_images = request.args.get('images') == 'full'
         
         # ตรวจสอบ columns ที่มีอยู่
         cursor.execute("PRAGMA table_info(vehicle_weekly_checks)")
@@ -5432,6 +8168,11 @@ def api_vehicle_check_history():
             if col_name in existing_columns:
                 base_fields.append(field_expr)
         
+        if not full_images:
+            # แบบย่อ: นับรูปใน SQL แทนการดึงคอลัมน์รูปภาพ (แถวเก่าอาจยังเก็บ base64 ขนาดใหญ่)
+            base_fields = [image_count_sql(field) if field.split('.')[-1] in VEHICLE_CHECK_IMAGE_FIELDS else field
+                           for field in base_fields]
+        
         query = f'''
             SELECT {', '.join(base_fields)}
             FROM vehicle_weekly_checks vwc
@@ -5499,38 +8240,67 @@ def api_vehicle_check_history():
             # เพิ่ม vehicle_display
             record_dict['vehicle_display'] = f"{record_dict.get('license_plate') or ''} {record_dict.get('brand') or ''} {record_dict.get('model') or ''}".strip()
 
-            image_field_keys = [
-                'oil_image', 'battery_image', 'tires_image', 'brake_fluid_image',
-                'clutch_fluid_image', 'ac_fluid_image', 'coolant_image',
-                'doors_image', 'lights_image', 'mirrors_image', 'others_image',
-                'hood_image', 'driver_cabin_image', 'cargo_area_image',
-                'engine_image', 'body_image', 'brakes_image', 'interior_image',
-                'overall_image'
-            ]
-            for image_key in image_field_keys:
+            image_counts = {}
+            for image_key in VEHICLE_CHECK_IMAGE_FIELDS:
                 if image_key in record_dict:
-                    record_dict[image_key] = normalize_image_field(record_dict.get(image_key))
+                    if full_images:
+                        record_dict[image_key] = normalize_image_field(record_dict.get(image_key))
+                        image_counts[image_key] = len(record_dict[image_key])
+                    else:
+                        image_counts[image_key] = record_dict.pop(image_key) or 0
+            record_dict['image_counts'] = image_counts
             
             result.append(record_dict)
         
         return jsonify(result)
         
     except sqlite3.OperationalError as e:
-        print(f"Vehicle check history table error: {str(e)}")
+        logger.warning('Vehicle check history table error: %s', e)
         return jsonify([])
     except Exception as e:
-        import traceback
-        error_msg = f"Error in api_vehicle_check_history: {str(e)}\n{traceback.format_exc()}"
-        print(error_msg)
+        logger.exception('Error in api_vehicle_check_history: %s', e)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/vehicle/check-history/<int:check_id>/images/<field>')
+@login_required
+@role_required(['GM', 'MD', 'HR', 'การเงิน', 'SPV'])
+def api_vehicle_check_images(check_id, field):
+    """API รูปภาพของการตรวจเช็ค 1 รายการเฉพาะ field ที่ขอ (ใช้คู่กับ check-history แบบย่อ)"""
+    if field not in VEHICLE_CHECK_IMAGE_FIELDS:
+        return jsonify({'success': False, 'message': f'ไม่รู้จัก field รูปภาพ {field}'}), 400
+    try:
+        cursor = get_db().cursor()
+        # field ผ่าน whitelist ด้านบนแล้วจึงใส่ใน SQL ได้
+        cursor.execute(f'SELECT {field} FROM vehicle_weekly_checks WHERE id = ?', (check_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return jsonify({'success': False, 'message': 'ไม่พบข้อมูลการตรวจเช็ค'}), 404
+        
+        return jsonify({
+            'success': True,
+            'check_id': check_id,
+            'field': field,
+            'images': normalize_image_field(row[0])
+        })
+    
+    except sqlite3.OperationalError as e:
+        # ฐานข้อมูลเก่าที่ยังไม่มีตาราง/คอลัมน์นี้ ถือว่าไม่มีรูป
+        logger.warning('Vehicle check images error: %s', e)
+        return jsonify({'success': True, 'check_id': check_id, 'field': field, 'images': []})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'เกิดข้อผิดพลาด: {str(e)}'}), 500
+
 @app.route('/api/vehicle/export-check-history')
 @login_required
 @role_required(['GM', 'MD', 'HR', 'การเงิน', 'SPV'])
 def api_export_check_history():
-    """API สำหรับ export ประวัติการตรวจเช็คสภาพรถเป็น Excel"""
+    """API สำหรับ export ประวัติการตรวจเช็คสภาพรถเป็น Excel
+    
+    แถวเขียนแบบ stream แต่รูปที่ฝังอยู่ในหน่วยความจำจนถึงตอน save จึงฝังรูปย่อได้ไม่เกิน EXPORT_MAX_EMBEDDED_IMAGES รูป
+    รูปหลังจากนั้นเป็นลิงก์ "ดูรูป" ไปยัง /media/<hash> (รูปแบบ base64 เดิมที่ไม่มี hash แสดงเป็นข้อความ)
+    """
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # ตรวจสอบว่าตาราง vehicle_weekly_checks มีอยู่หรือไม่
@@ -5635,8 +8405,6 @@ def api_export_check_history():
         query += ' ORDER BY vwc.check_date DESC'
         
         cursor.execute(query, params)
-        records = cursor.fetchall()
-        conn.close()
         
         # สร้าง mapping ระหว่าง field names กับ index
         field_names = ['id', 'check_date', 'overall_status',
@@ -5666,35 +8434,10 @@ def api_export_check_history():
             if col_name in existing_columns:
                 field_names.append(col_name)
         
-        # สร้าง DataFrame (เก็บข้อมูลรูปภาพแยกไว้)
-        data = []
-        images_data = []  # เก็บข้อมูลรูปภาพสำหรับแทรกลง Excel
-        
         status_map = {'good': 'ดี', 'warning': 'ควรระวัง', 'bad': 'ต้องซ่อม'}
         
-        for record in records:
-            # แปลง record เป็น dictionary
-            record_dict = {}
-            for idx, field_name in enumerate(field_names):
-                if idx < len(record):
-                    record_dict[field_name] = record[idx]
-                else:
-                    record_dict[field_name] = None
-            
-            # เก็บข้อมูลรูปภาพ - field ใหม่และ field เก่า
-            image_record = {}
-            image_fields = ['oil_image', 'battery_image', 'tires_image', 'brake_fluid_image',
-                           'clutch_fluid_image', 'ac_fluid_image', 'coolant_image',
-                           'doors_image', 'lights_image', 'mirrors_image', 'others_image',
-                           'hood_image', 'driver_cabin_image', 'cargo_area_image',
-                           'engine_image', 'body_image', 'brakes_image', 'interior_image', 'overall_image']
-            
-            for img_field in image_fields:
-                image_record[img_field] = normalize_image_field(record_dict.get(img_field))
-            
-            images_data.append(image_record)
-            
-            # สร้างข้อมูลสำหรับ DataFrame - ใช้ field ใหม่เป็นหลัก
+        def build_export_row(record_dict, image_record):
+            """แถวข้อมูล 1 แถวของไฟล์ Excel (ลำดับ key = ลำดับคอลัมน์) - ใช้ field ใหม่เป็นหลัก"""
             def image_count_text(field_name):
                 images_list = image_record.get(field_name) or []
                 return f"{len(images_list)} รูป" if images_list else ''
@@ -5761,114 +8504,124 @@ def api_export_check_history():
                 'คำแนะนำ': record_dict.get('recommendations') or '',
                 'ตรวจครั้งถัดไป': record_dict.get('next_check_date') or ''
             }
-            
-            data.append(row_data)
-        
-        df = pd.DataFrame(data)
+            return row_data
+        
+        # หา index ของคอลัมน์รูปภาพ - รองรับ field ใหม่และ field เก่า
+        image_columns = {
+            # Field ใหม่
+            'รูปภาพน้ำมันเครื่อง': 'oil_image',
+            'รูปภาพแบตเตอรี่': 'battery_image',
+            'รูปภาพยาง': 'tires_image',
+            'รูปภาพน้ำมันเบรค': 'brake_fluid_image',
+            'รูปภาพน้ำมันครัช': 'clutch_fluid_image',
+            'รูปภาพน้ำยาแอร์': 'ac_fluid_image',
+            'รูปภาพน้ำหล่อเย็น': 'coolant_image',
+            'รูปภาพประตูรถ': 'doors_image',
+            'รูปภาพไฟ': 'lights_image',
+            'รูปภาพกระจกมองข้าง': 'mirrors_image',
+            'รูปภาพอื่นๆ': 'others_image',
+            'รูปภาพฝากระโปรงรถ': 'hood_image',
+            'รูปภาพภายในห้องคนขับ': 'driver_cabin_image',
+            'รูปภาพภายในตู้': 'cargo_area_image',
+            # Field เก่า (รองรับข้อมูลเก่า)
+            'รูปภาพเครื่องยนต์': 'engine_image',
+            'รูปภาพตัวถัง': 'body_image',
+            'รูปภาพเบรก': 'brakes_image',
+            'รูปภาพภายใน': 'interior_image',
+            'รูปภาพภาพรวม': 'overall_image'
+        }
+
+        header = list(build_export_row({}, {}).keys())
+        col_indices = {col_name: idx for idx, col_name in enumerate(header, 1) if col_name in image_columns}
         
-        # สร้าง Excel file
-        output = BytesIO()
+        # เขียนแบบ write-only: แถวถูกเขียนลงไฟล์ชั่วคราวทันที ไม่เก็บทั้งตารางไว้ในหน่วยความจำ
+        from openpyxl import Workbook
+        from openpyxl.cell import WriteOnlyCell
         from openpyxl.drawing.image import Image as OpenpyxlImage
+        from openpyxl.utils import get_column_letter
         
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='ประวัติการตรวจเช็ค')
-            
-            worksheet = writer.sheets['ประวัติการตรวจเช็ค']
-            
-            # หา index ของคอลัมน์รูปภาพ - รองรับ field ใหม่และ field เก่า
-            image_columns = {
-                # Field ใหม่
-                'รูปภาพน้ำมันเครื่อง': 'oil_image',
-                'รูปภาพแบตเตอรี่': 'battery_image',
-                'รูปภาพยาง': 'tires_image',
-                'รูปภาพน้ำมันเบรค': 'brake_fluid_image',
-                'รูปภาพน้ำมันครัช': 'clutch_fluid_image',
-                'รูปภาพน้ำยาแอร์': 'ac_fluid_image',
-                'รูปภาพน้ำหล่อเย็น': 'coolant_image',
-                'รูปภาพประตูรถ': 'doors_image',
-                'รูปภาพไฟ': 'lights_image',
-                'รูปภาพกระจกมองข้าง': 'mirrors_image',
-                'รูปภาพอื่นๆ': 'others_image',
-                'รูปภาพฝากระโปรงรถ': 'hood_image',
-                'รูปภาพภายในห้องคนขับ': 'driver_cabin_image',
-                'รูปภาพภายในตู้': 'cargo_area_image',
-                # Field เก่า (รองรับข้อมูลเก่า)
-                'รูปภาพเครื่องยนต์': 'engine_image',
-                'รูปภาพตัวถัง': 'body_image',
-                'รูปภาพเบรก': 'brakes_image',
-                'รูปภาพภายใน': 'interior_image',
-                'รูปภาพภาพรวม': 'overall_image'
-            }
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet('ประวัติการตรวจเช็ค')
+        
+        # ความกว้างคอลัมน์ต้องกำหนดก่อนเขียนแถวแรก (ไม่รู้ความยาวข้อมูลล่วงหน้าจึงใช้ความยาวหัวคอลัมน์)
+        for idx, col in enumerate(header, 1):
+            if col in image_columns:
+                # สำหรับคอลัมน์รูปภาพ ให้ความกว้างมากขึ้น
+                worksheet.column_dimensions[get_column_letter(idx)].width = 15
+            else:
+                worksheet.column_dimensions[get_column_letter(idx)].width = min(max(len(col) + 2, EXPORT_MIN_COLUMN_WIDTH), 50)
+        worksheet.append(header)
+        
+        lookup_cursor = conn.cursor()
+        row_idx = 1
+        embedded_images = 0
+        media_base_url = request.host_url.rstrip('/')
+        while True:
+            # ดึงทีละชุดจาก cursor เดียวกับ query หลัก - หน่วยความจำคงที่ไม่ขึ้นกับจำนวนแถว
+            records = cursor.fetchmany(EXPORT_FETCH_ROWS)
+            if not records:
+                break
             
-            # หาคอลัมน์ index
-            col_indices = {}
-            for idx, col_name in enumerate(df.columns, 1):
-                if col_name in image_columns:
-                    col_indices[col_name] = idx
+            batch = []
+            for record in records:
+                record_dict = dict(zip(field_names, record))
+                # เก็บข้อมูลรูปภาพ - field ใหม่และ field เก่า
+                image_record = {img_field: image_refs(record_dict.get(img_field)) for img_field in VEHICLE_CHECK_IMAGE_FIELDS}
+                batch.append((record_dict, image_record))
             
-            # ปรับความกว้างของคอลัมน์และแทรกรูปภาพ
-            for idx, col in enumerate(df.columns, 1):
-                try:
-                    max_length = max(
-                        df[col].astype(str).map(len).max() if len(df) > 0 else len(col),
-                        len(col)
-                    )
-                    adjusted_width = min(max_length + 2, 50)
-                    # แปลง index เป็น Excel column (A, B, C, ... AA, AB, ...)
-                    col_letter = ''
-                    col_idx = idx
-                    while col_idx > 0:
-                        col_idx -= 1
-                        col_letter = chr(65 + (col_idx % 26)) + col_letter
-                        col_idx //= 26
-                    
-                    if col in image_columns:
-                        # สำหรับคอลัมน์รูปภาพ ให้ความกว้างมากขึ้น
-                        worksheet.column_dimensions[col_letter].width = 15
-                    else:
-                        worksheet.column_dimensions[col_letter].width = adjusted_width
-                except Exception as e:
-                    print(f"Error adjusting column width for {col}: {e}")
+            # รูปย่อ thumb ที่สร้างไว้แล้วของทั้งชุด (query เดียว) - รูปที่ยังไม่มีรูปย่อจะย่อจากต้นฉบับตอนนี้
+            thumb_digests = {}
+            if embedded_images < EXPORT_MAX_EMBEDDED_IMAGES:
+                thumb_digests = media_variant_digests(
+                    lookup_cursor,
+                    (image_list[0].get('hash') for _, images in batch for image_list in images.values() if image_list),
+                    'thumb'
+                )
             
-            # ปรับความสูงของแถวและแทรกรูปภาพ
-            for row_idx, images in enumerate(images_data, start=2):  # เริ่มที่แถว 2 (ข้าม header)
-                # ปรับความสูงแถวครั้งเดียวต่อแถว
-                worksheet.row_dimensions[row_idx].height = 100
+            for record_dict, image_record in batch:
+                row_idx += 1
+                values = list(build_export_row(record_dict, image_record).values())
                 
-                for col_name, image_key in image_columns.items():
-                    if col_name in col_indices:
-                        col_idx = col_indices[col_name]
-                        cell = worksheet.cell(row=row_idx, column=col_idx)
+                # แทรกรูปภาพแรกของแต่ละ field (อ่านจากคลังไฟล์ หรือ base64 ของข้อมูลเดิม)
+                for col_name, col_idx in col_indices.items():
+                    image_list = image_record.get(image_columns[col_name]) or []
+                    if not image_list:
+                        continue
+                    if embedded_images >= EXPORT_MAX_EMBEDDED_IMAGES:
+                        digest = image_list[0].get('hash')
+                        if digest:
+                            link = WriteOnlyCell(worksheet, value='ดูรูป')
+                            link.hyperlink = media_base_url + media_url(digest)
+                            values[col_idx - 1] = link
+                        else:
+                            values[col_idx - 1] = 'มี (เกินจำนวนรูปที่ฝังได้)'
+                        continue
+                    try:
+                        img_bytes = media_thumbnail_bytes(image_list[0], thumb_digests.get(image_list[0].get('hash')))
+                        if img_bytes is None:
+                            raise FileNotFoundError(f"ไม่พบไฟล์รูปภาพ {image_list[0].get('hash')}")
+                        img = OpenpyxlImage(BytesIO(img_bytes))
                         
-                        # แทรกรูปภาพถ้ามี
-                        image_list = images.get(image_key) or []
-                        first_image = None
-                        if image_list and isinstance(image_list[0], dict):
-                            first_image = image_list[0].get('data')
-                        elif image_list and isinstance(image_list[0], str):
-                            first_image = image_list[0]
+                        # ปรับขนาดรูปภาพ (80x80 pixels)
+                        img.width = 80
+                        img.height = 80
                         
-                        if first_image:
-                            try:
-                                # แปลง base64 เป็น bytes
-                                img_bytes = base64.b64decode(first_image)
-                                img_io = BytesIO(img_bytes)
-                                
-                                # สร้าง Image object
-                                img = OpenpyxlImage(img_io)
-                                
-                                # ปรับขนาดรูปภาพ (80x80 pixels)
-                                img.width = 80
-                                img.height = 80
-                                
-                                # แทรกรูปภาพใน cell
-                                cell.value = ''  # ล้างข้อความ
-                                worksheet.add_image(img, cell.coordinate)
-                            except Exception as e:
-                                print(f"Error inserting image at row {row_idx}, col {col_name}: {e}")
-                                # ถ้า error ให้แสดง "มี" แทน
-                                cell.value = 'มี (แสดงรูปไม่ได้)'
+                        worksheet.add_image(img, f'{get_column_letter(col_idx)}{row_idx}')
+                        embedded_images += 1
+                        values[col_idx - 1] = ''  # ล้างข้อความ
+                    except Exception as e:
+                        log_sampled('export-image', LOG_SAMPLE_EVERY, logging.WARNING, 'Error inserting image at row %s, col %s: %s', row_idx, col_name, e)
+                        # ถ้า error ให้แสดง "มี" แทน
+                        values[col_idx - 1] = 'มี (แสดงรูปไม่ได้)'
+                
+                # ความสูงแถวถูกอ่านตอนเขียนแถว แล้วลบทิ้งเพื่อไม่ให้สะสม
+                worksheet.row_dimensions[row_idx].height = 100
+                worksheet.append(values)
+                del worksheet.row_dimensions[row_idx]
         
+        # ไฟล์ผลลัพธ์เก็บในหน่วยความจำถ้าเล็ก ถ้าใหญ่กว่า EXPORT_SPOOL_MAX_BYTES จะย้ายไปเป็นไฟล์ชั่วคราวบนดิสก์
+        output = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES)
+        workbook.save(output)
         output.seek(0)
         
         # สร้างชื่อไฟล์
@@ -5882,9 +8635,7 @@ def api_export_check_history():
         )
         
     except Exception as e:
-        import traceback
-        error_msg = f"Error in api_export_check_history: {str(e)}\n{traceback.format_exc()}"
-        print(error_msg)
+        logger.exception('Error in api_export_check_history: %s', e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/vehicle/delete-check-history', methods=['POST'])
@@ -5899,7 +8650,7 @@ def api_delete_check_history():
         if not ids or len(ids) == 0:
             return jsonify({'success': False, 'message': 'กรุณาเลือกรายการที่ต้องการลบ'}), 400
         
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # ตรวจสอบว่าตาราง vehicle_weekly_checks มีอยู่หรือไม่
@@ -5930,9 +8681,7 @@ def api_delete_check_history():
         })
         
     except Exception as e:
-        import traceback
-        error_msg = f"Error in api_delete_check_history: {str(e)}\n{traceback.format_exc()}"
-        print(error_msg)
+        logger.exception('Error in api_delete_check_history: %s', e)
         return jsonify({'success': False, 'message': str(e)}), 500
 
 @app.route('/api/vehicle/fuel-statistics')
@@ -5941,7 +8690,7 @@ def api_delete_check_history():
 def api_fuel_statistics():
     """API สำหรับสถิติน้ำมัน"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # คำนวณค่าใช้จ่ายน้ำมันเดือนนี้
@@ -5949,8 +8698,8 @@ def api_fuel_statistics():
         cursor.execute('''
             SELECT COALESCE(SUM(total_cost), 0), COALESCE(SUM(quantity), 0)
             FROM vehicle_fuel_usage 
-            WHERE fuel_date LIKE ?
-        ''', (f'{current_month}%',))
+            WHERE fuel_date >= ? AND fuel_date < ?
+        ''', like_prefix_bounds(current_month))
         result = cursor.fetchone()
         monthly_total = result[0]
         total_quantity = result[1]
@@ -5963,8 +8712,8 @@ def api_fuel_statistics():
         cursor.execute('''
             SELECT COALESCE(AVG(unit_price), 0)
             FROM vehicle_fuel_usage 
-            WHERE fuel_date LIKE ?
-        ''', (f'{current_month}%',))
+            WHERE fuel_date >= ? AND fuel_date < ?
+        ''', like_prefix_bounds(current_month))
         avg_price = cursor.fetchone()[0]
         
         conn.close()
@@ -5985,7 +8734,7 @@ def api_fuel_statistics():
 def api_fuel_records():
     """API สำหรับรายการเบิกจ่ายน้ำมัน"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # ดึงพารามิเตอร์การกรอง
@@ -6072,7 +8821,6 @@ def api_add_fuel_record():
         # ใช้ timeout เพื่อป้องกัน database locked
         conn = get_db_connection(timeout=10.0)
         cursor = conn.cursor()
-        cursor.execute('PRAGMA journal_mode=WAL')
         
         cursor.execute('''
             INSERT INTO vehicle_fuel_usage (
@@ -6093,6 +8841,7 @@ def api_add_fuel_record():
             data.get('fuel_card_number'),
             data.get('notes', '')
         ))
+        bump_data_version(cursor, 'vehicle_fuel_usage')
         
         conn.commit()
         return jsonify({'success': True, 'message': 'เพิ่มรายการน้ำมันสำเร็จ'})
@@ -6102,9 +8851,7 @@ def api_add_fuel_record():
             return jsonify({'success': False, 'message': 'ฐานข้อมูลถูกใช้งานอยู่ กรุณาลองใหม่อีกครั้ง'}), 500
         return jsonify({'success': False, 'message': f'เกิดข้อผิดพลาดฐานข้อมูล: {str(e)}'}), 500
     except Exception as e:
-        import traceback
-        error_msg = f"Error in api_add_fuel_record: {str(e)}\n{traceback.format_exc()}"
-        print(error_msg)
+        logger.exception('Error in api_add_fuel_record: %s', e)
         return jsonify({'success': False, 'message': str(e)}), 500
     finally:
         # ปิด connection ใน finally เพื่อให้แน่ใจว่าจะปิดเสมอ
@@ -6120,10 +8867,11 @@ def api_add_fuel_record():
 def api_delete_fuel_record(record_id):
     """API สำหรับลบรายการน้ำมัน"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('DELETE FROM vehicle_fuel_usage WHERE id = ?', (record_id,))
+        bump_data_version(cursor, 'vehicle_fuel_usage')
         conn.commit()
         conn.close()
         
@@ -6138,44 +8886,56 @@ def api_delete_fuel_record(record_id):
 def api_export_fuel_data():
     """API สำหรับส่งออกข้อมูลน้ำมัน"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
-        cursor.execute('''
+        # ใช้ตัวกรองเดียวกับหน้ารายการเบิกจ่ายน้ำมัน (หน้าเว็บส่งมาพร้อมลิงก์ export)
+        vehicle_id = request.args.get('vehicle_id', '')
+        fuel_type = request.args.get('fuel_type', '')
+        start_date = request.args.get('start_date', '')
+        end_date = request.args.get('end_date', '')
+        search = request.args.get('search', '')
+        
+        query = '''
             SELECT vf.fuel_date, v.license_plate, v.brand, v.model, e.name as driver_name,
                    vf.fuel_type, vf.quantity, vf.unit_price, vf.total_cost, vf.gas_station,
                    vf.receipt_number, vf.mileage_at_fuel
             FROM vehicle_fuel_usage vf
             JOIN vehicles v ON vf.vehicle_id = v.vehicle_id
             JOIN employees e ON vf.driver_id = e.employee_id
-            ORDER BY vf.fuel_date DESC
-        ''')
-        records = cursor.fetchall()
+            WHERE 1=1
+        '''
+        params = []
         
-        conn.close()
+        if vehicle_id:
+            query += ' AND vf.vehicle_id = ?'
+            params.append(vehicle_id)
+        
+        if fuel_type:
+            query += ' AND vf.fuel_type = ?'
+            params.append(fuel_type)
         
-        # สร้างไฟล์ CSV
-        import csv
-        from io import StringIO
+        if start_date:
+            query += ' AND vf.fuel_date >= ?'
+            params.append(start_date)
         
-        output = StringIO()
-        writer = csv.writer(output)
-        writer.writerow([
-            'วันที่', 'เลขทะเบียน', 'ยี่ห้อ', 'รุ่น', 'คนขับ', 'ประเภทน้ำมัน',
-            'ปริมาณ (ลิตร)', 'ราคาต่อลิตร', 'ยอดรวม', 'สถานีน้ำมัน', 'หมายเลขใบเสร็จ', 'ไมล์'
-        ])
+        if end_date:
+            query += ' AND vf.fuel_date <= ?'
+            params.append(end_date)
         
-        for record in records:
-            writer.writerow(record)
+        if search:
+            query += ' AND (vf.receipt_number LIKE ? OR vf.gas_station LIKE ?)'
+            search_param = f'%{search}%'
+            params.extend([search_param, search_param])
         
-        output.seek(0)
+        query += ' ORDER BY vf.fuel_date DESC'
+        cursor.execute(query, params)
         
-        from flask import Response
-        return Response(
-            output.getvalue(),
-            mimetype='text/csv',
-            headers={'Content-Disposition': 'attachment; filename=fuel_records.csv'}
-        )
+        # ส่ง CSV ทีละชุดระหว่างอ่าน cursor - หน่วยความจำคงที่ไม่ขึ้นกับจำนวนแถว
+        return csv_stream_response('fuel_records.csv', [
+            'วันที่', 'เลขทะเบียน', 'ยี่ห้อ', 'รุ่น', 'คนขับ', 'ประเภทน้ำมัน',
+            'ปริมาณ (ลิตร)', 'ราคาต่อลิตร', 'ยอดรวม', 'สถานีน้ำมัน', 'หมายเลขใบเสร็จ', 'ไมล์'
+        ], iter_cursor_batches(cursor))
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -6186,7 +8946,7 @@ def api_export_fuel_data():
 def api_export_vehicle_data():
     """API สำหรับส่งออกข้อมูลรถ"""
     try:
-        conn = sqlite3.connect('database/daex_system.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -6198,37 +8958,24 @@ def api_export_vehicle_data():
             LEFT JOIN employees e ON v.assigned_driver_id = e.employee_id
             ORDER BY v.created_at DESC
         ''')
-        records = cursor.fetchall()
-        
-        conn.close()
-        
-        # สร้างไฟล์ CSV
-        import csv
-        from io import StringIO
         
-        output = StringIO()
-        writer = csv.writer(output)
-        writer.writerow([
+        # ส่ง CSV ทีละชุดระหว่างอ่าน cursor
+        return csv_stream_response('vehicles.csv', [
             'รหัสรถ', 'เลขทะเบียน', 'ยี่ห้อ', 'รุ่น', 'ปี', 'สี', 'ขนาดเครื่องยนต์',
             'เชื้อเพลิง', 'เกียร์', 'ไมล์', 'สถานะ', 'สาขา', 'คนขับ', 'วันที่ซื้อ',
             'ราคาซื้อ', 'ประกันหมด', 'ทะเบียนหมด'
-        ])
-        
-        for record in records:
-            writer.writerow(record)
-        
-        output.seek(0)
-        
-        from flask import Response
-        return Response(
-            output.getvalue(),
-            mimetype='text/csv',
-            headers={'Content-Disposition': 'attachment; filename=vehicles.csv'}
-        )
+        ], iter_cursor_batches(cursor))
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# รัน migration หลังนิยามฟังก์ชันทั้งหมดแล้ว (migration บางตัวใช้ค่าคงที่ของส่วนเงินเดือน)
+if not SALARY_WORKER_PROCESS:
+    try:
+        run_schema_migrations()
+    except sqlite3.Error as e:
+        logger.error('❌ รัน schema migration ไม่สำเร็จ: %s', e)
+
 if __name__ == '__main__':
     init_db()
     app.run(host='0.0.0.0', port=8080, debug=True)
@@ -0,0 +1,175 @@
+"""fixture สำหรับทดสอบ app.py กับฐานข้อมูลทดสอบ (ไม่แตะไฟล์ฐานข้อมูลจริงใน repo)
+
+สร้างตารางจาก schema ของ database/daex_system.db (เปิดแบบอ่านอย่างเดียว) ใส่ข้อมูลสุ่มแบบกำหนด seed
+แล้ว import app ด้วย DAEX_DB_PATH ชี้ไปที่ไฟล์ทดสอบ - migration ทั้งหมดรันตอน import เหมือนตอนเริ่มระบบจริง
+"""
+import importlib
+import json
+import os
+import random
+import sqlite3
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATE_DB = os.path.join(REPO_DIR, 'database', 'daex_system.db')
+
+WORK_MONTH = '2025-01'
+BATCH_ID = 'batch-2025-01'
+
+def copy_schema(target):
+    """สร้างตารางและดัชนีเดิมของฐานข้อมูลจริงลงใน target (ยังไม่มีตาราง/ดัชนีที่ migration สร้าง)"""
+    source = sqlite3.connect(f'file:{TEMPLATE_DB}?mode=ro', uri=True)
+    try:
+        statements = source.execute(
+            "SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+            "ORDER BY type = 'index'"
+        ).fetchall()
+    finally:
+        source.close()
+    for (sql,) in statements:
+        target.execute(sql)
+
+def seed_rows(conn, seed=20250101):
+    """ข้อมูลตัวอย่าง: พนักงาน 40 คน, เรท 4 แบบ, พัสดุ 3000 ชิ้น, รถ 5 คัน, คำขอลา/ค่าใช้จ่าย"""
+    rng = random.Random(seed)
+
+    conn.execute(
+        "INSERT INTO users (id, username, password_hash, role, branch_code) VALUES (1, 'gm', 'x', 'GM', '671180')"
+    )
+    conn.execute(
+        "INSERT INTO users (id, username, password_hash, role, branch_code) VALUES (2, 'E0001', 'x', 'SPT', '671180')"
+    )
+
+    tiers = json.dumps([{'pieces': 500, 'amount': 300}, {'pieces': 1000, 'amount': 800}])
+    rates = [
+        ('Z1', '671180', 'SPT', 'piece_rate', 0, 0, 200, 8.5, tiers),
+        ('Z2', '671181', 'SPT', 'base_salary', 9750, 0, 0, 6.0, '[]'),
+        ('Z1', '671180', 'SPT', 'DEFAULT', 5000, 0, 100, 7.25, tiers),
+        ('Z2', '671181', 'SPT', 'DEFAULT', 0, 0, 50, 5.5, '[]'),
+    ]
+    for zone, branch, position, salary_type, base, bonus, allowance, first_rate, allowance_tiers in rates:
+        weight_rates = [round(first_rate + step * 1.5, 2) for step in range(10)]
+        conn.execute(f'''
+            INSERT INTO piece_rates (zone, branch_code, position, salary_type, base_salary, piece_rate_bonus, allowance,
+                {', '.join(f'weight_range_{i}' for i in range(1, 11))}, allowance_tiers)
+            VALUES ({', '.join('?' for _ in range(18))})
+        ''', (zone, branch, position, salary_type, base, bonus, allowance, *weight_rates, allowance_tiers))
+
+    employees = [f'E{i:04d}' for i in range(1, 41)]
+    for i, emp_id in enumerate(employees):
+        zone, branch = ('Z1', '671180') if i % 2 == 0 else ('Z2', '671181')
+        rate_type = ['piece_rate', 'base_salary', 'DEFAULT', None][i % 4]
+        status = 'inactive' if i % 13 == 12 else 'active'
+        conn.execute('''
+            INSERT INTO employees (employee_id, name, position, branch_code, status, zone, rate_type, employment_type, base_salary)
+            VALUES (?, ?, 'SPT', ?, ?, ?, ?, 'piece_rate', 0)
+        ''', (emp_id, f'พนักงาน {i + 1:02d}', branch, status, zone, rate_type))
+
+    conn.execute('''
+        INSERT INTO salary_uploads (filename, original_name, month, year, batch_id, uploaded_by, created_at)
+        VALUES ('salary.csv', 'salary.csv', 1, 2025, ?, 'gm', '2025-02-01 08:00:00')
+    ''', (BATCH_ID,))
+
+    # พนักงาน 3 คนสุดท้ายไม่มีในตาราง employees (ทดสอบ LEFT JOIN / unmatched)
+    record_employees = employees + ['X0001', 'X0002', 'X0003']
+    weights = [-0.2, 0, 0.5, 0.505, 1, 1.5, 2, 2.5, 3, 5, 10, 15, 15.01, 30]
+    records = []
+    for n in range(3000):
+        emp_id = rng.choice(record_employees)
+        weight = rng.choice(weights) if n % 5 == 0 else round(rng.uniform(0, 20), 2)
+        day = rng.randint(1, 31)
+        records.append((
+            BATCH_ID, emp_id, f'AWB{n:06d}', '671180', weight,
+            f'2025-01-{day:02d} 10:00:00', f'2025-01-{day:02d}', WORK_MONTH, 1, round(rng.uniform(5, 40), 2)
+        ))
+    conn.executemany('''
+        INSERT INTO employee_salary_records
+        (upload_batch_id, employee_id, awb_number, branch_code, weight, receive_time, close_date, work_month, total_pieces, total_amount)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', records)
+    conn.executemany('''
+        INSERT INTO unmatched_salary_records
+        (upload_batch_id, employee_id, employee_name, awb_number, branch_code, weight, receive_time, weight_range_index, range_name)
+        VALUES (?, ?, '', ?, '671180', ?, ?, 0, '0-0.5 KG')
+    ''', [(BATCH_ID, emp_id, awb, weight, receive)
+          for _, emp_id, awb, _, weight, receive, *_ in records if emp_id.startswith('X')])
+
+    for emp_id in employees:
+        range_pieces = [rng.randint(0, 150) for _ in range(10)]
+        conn.execute(f'''
+            INSERT INTO monthly_salary_data (employee_id, month, year, package_count, total_weight,
+                {', '.join(f'range_{i}_pieces' for i in range(1, 11))})
+            VALUES (?, 1, 2025, ?, 0, {', '.join('?' for _ in range(10))})
+        ''', (emp_id, sum(range_pieces), *range_pieces))
+
+    for v in range(1, 6):
+        conn.execute('''
+            INSERT INTO vehicles (vehicle_id, license_plate, brand, model, year, branch_code)
+            VALUES (?, ?, 'Toyota', 'Hilux', 2020, '671180')
+        ''', (f'V{v:03d}', f'กข-{v:04d}'))
+    for n in range(200):
+        vehicle_id = f'V{n % 5 + 1:03d}'
+        date = f'2025-{n % 12 + 1:02d}-{n % 28 + 1:02d}'
+        conn.execute('''
+            INSERT INTO vehicle_weekly_checks (vehicle_id, inspector_id, check_date, engine_status, body_status, tires_status,
+                lights_status, brakes_status, interior_status, overall_status)
+            VALUES (?, '1', ?, 'good', 'good', 'good', 'good', 'good', 'good', 'good')
+        ''', (vehicle_id, date))
+        conn.execute('''
+            INSERT INTO vehicle_fuel_usage (vehicle_id, driver_id, fuel_date, fuel_type, quantity, unit_price, total_cost)
+            VALUES (?, 'E0001', ?, 'diesel', 40, 32.5, 1300)
+        ''', (vehicle_id, date))
+
+    for n in range(120):
+        emp_id = employees[n % len(employees)]
+        status = ['pending', 'approved', 'rejected'][n % 3]
+        conn.execute('''
+            INSERT INTO leave_requests (employee_id, leave_type, start_date, end_date, days_requested, status, created_at)
+            VALUES (?, 'sick', '2025-01-10', '2025-01-11', 2, ?, ?)
+        ''', (emp_id, status, f'2025-01-{n % 28 + 1:02d} 09:00:00'))
+        conn.execute('''
+            INSERT INTO expenses (employee_id, expense_date, expense_type, description, amount, status, created_at)
+            VALUES (?, '2025-01-10', 'fuel', 'ค่าน้ำมัน', 500, ?, ?)
+        ''', (emp_id, status, f'2025-01-{n % 28 + 1:02d} 09:00:00'))
+
+def build_fixture_db(path):
+    conn = sqlite3.connect(path)
+    try:
+        copy_schema(conn)
+        seed_rows(conn)
+        conn.commit()
+    finally:
+        conn.close()
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """โมดูล app ที่ใช้ฐานข้อมูลทดสอบ - cwd ย้ายไปโฟลเดอร์ชั่วคราวเพราะ logs/, uploads/, database/metrics.db อิงตาม cwd"""
+    workdir = tmp_path_factory.mktemp('daex')
+    db_path = str(workdir / 'daex_system.db')
+    build_fixture_db(db_path)
+
+    previous_cwd = os.getcwd()
+    os.environ['DAEX_DB_PATH'] = db_path
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    try:
+        module = importlib.import_module('app')
+        module.app.config['TESTING'] = True
+        yield module
+    finally:
+        os.chdir(previous_cwd)
+        os.environ.pop('DAEX_DB_PATH', None)
+
+@pytest.fixture
+def gm_client(app_module):
+    """test client ที่ล็อกอินเป็น GM แล้ว"""
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+        session['username'] = 'gm'
+        session['user_name'] = 'gm'
+        session['user_role'] = 'GM'
+        session['branch_code'] = '671180'
+    return client
@@ -0,0 +1,65 @@
+"""ประวัติการตรวจเช็คแบบย่อ: นับรูปใน SQL (ไม่ส่งคอลัมน์รูปภาพ) ตัวรูปดึงผ่าน API รูปภาพราย field เท่านั้น"""
+import json
+import sqlite3
+
+import pytest
+
+BASE64 = 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk'
+
+IMAGE_VALUES = [
+    None,
+    '',
+    '[]',
+    '[abc',
+    '  [1, 2]',
+    '{"hash": "abc"}',
+    '"ข้อความ"',
+    BASE64,
+    json.dumps([{'hash': 'a' * 64, 'filename': 'a.png'}, {'hash': 'b' * 64, 'filename': 'b.png'}]),
+    json.dumps([{'filename': 'legacy.png', 'data': BASE64}, {'filename': 'empty.png', 'data': ''}]),
+    json.dumps([{'hash': ''}, {'note': 'x'}, 'text', 3, {'hash': 'c' * 64}]),
+]
+
+@pytest.mark.parametrize('value', IMAGE_VALUES)
+def test_image_count_sql_matches_image_refs(app_module, value):
+    conn = sqlite3.connect(':memory:')
+    count = conn.execute(f'SELECT {app_module.image_count_sql("?1")}', (value,)).fetchone()[0]
+    assert count == len(app_module.image_refs(value))
+
+@pytest.fixture
+def checks_with_images(app_module):
+    """ตรวจเช็ครถ V004 ในปี 2031 (ไม่ชนกับข้อมูลตั้งต้น) แต่ละครั้งใช้รูปเครื่องยนต์คนละรูปแบบ"""
+    conn = app_module.connect_db()
+    cursor = conn.cursor()
+    values = [value for value in IMAGE_VALUES if value is not None]
+    ids = []
+    for n, value in enumerate(values):
+        cursor.execute('''
+            INSERT INTO vehicle_weekly_checks (vehicle_id, inspector_id, check_date, engine_status, engine_image,
+                body_status, tires_status, lights_status, brakes_status, interior_status, overall_status)
+            VALUES ('V004', '1', ?, 'good', ?, 'good', 'good', 'good', 'good', 'good', 'good')
+        ''', (f'2031-01-{n + 1:02d}', value))
+        ids.append(cursor.lastrowid)
+    conn.commit()
+    yield dict(zip(ids, values))
+    cursor.executemany('DELETE FROM vehicle_weekly_checks WHERE id = ?', [(row_id,) for row_id in ids])
+    conn.commit()
+    conn.close()
+
+def test_compact_list_sends_counts_only(app_module, gm_client, checks_with_images):
+    response = gm_client.get('/api/vehicle/check-history?vehicle_id=V004&start_date=2031-01-01')
+    assert response.status_code == 200
+
+    records = {record['id']: record for record in response.get_json()}
+    assert set(records) == set(checks_with_images)
+    for check_id, value in checks_with_images.items():
+        record = records[check_id]
+        assert not any(field in record for field in app_module.VEHICLE_CHECK_IMAGE_FIELDS)
+        assert record['image_counts']['engine_image'] == len(app_module.image_refs(value)), value
+        assert record['image_counts']['body_image'] == 0
+
+def test_images_endpoint_returns_the_counted_images(app_module, gm_client, checks_with_images):
+    for check_id, value in checks_with_images.items():
+        response = gm_client.get(f'/api/vehicle/check-history/{check_id}/images/engine_image')
+        assert response.status_code == 200
+        assert len(response.get_json()['images']) == len(app_module.image_refs(value))
@@ -0,0 +1,51 @@
+"""export ประวัติการตรวจเช็ค: ฝังรูปไม่เกิน EXPORT_MAX_EMBEDDED_IMAGES รูป ที่เหลือเป็นลิงก์ไปยัง /media"""
+import io
+import json
+
+import pytest
+from openpyxl import load_workbook
+
+PILImage = pytest.importorskip('PIL.Image')
+
+def png_bytes(shade):
+    output = io.BytesIO()
+    PILImage.new('RGB', (120, 90), (shade, 80, 160)).save(output, format='PNG')
+    return output.getvalue()
+
+@pytest.fixture
+def checks_with_images(app_module):
+    """ตรวจเช็ค 5 ครั้งของรถ V005 ในปี 2030 (ไม่ชนกับข้อมูลตั้งต้น) แต่ละครั้งมีรูปเครื่องยนต์ 1 รูป"""
+    conn = app_module.connect_db()
+    cursor = conn.cursor()
+    ids = []
+    for n in range(5):
+        ref = app_module.store_media(cursor, png_bytes(n * 40), f'engine{n}.png')
+        cursor.execute('''
+            INSERT INTO vehicle_weekly_checks (vehicle_id, inspector_id, check_date, engine_status, engine_image,
+                body_status, tires_status, lights_status, brakes_status, interior_status, overall_status)
+            VALUES ('V005', '1', ?, 'good', ?, 'good', 'good', 'good', 'good', 'good', 'good')
+        ''', (f'2030-01-{n + 1:02d}', json.dumps([ref])))
+        ids.append((cursor.lastrowid, ref['hash']))
+    conn.commit()
+    yield ids
+    cursor.executemany('DELETE FROM vehicle_weekly_checks WHERE id = ?', [(row_id,) for row_id, _ in ids])
+    conn.commit()
+    conn.close()
+
+def test_images_above_cap_become_media_links(app_module, gm_client, checks_with_images, monkeypatch):
+    monkeypatch.setattr(app_module, 'EXPORT_MAX_EMBEDDED_IMAGES', 2)
+
+    response = gm_client.get('/api/vehicle/export-check-history?vehicle_id=V005&start_date=2030-01-01')
+    assert response.status_code == 200, response.data[:300]
+
+    worksheet = load_workbook(io.BytesIO(response.data)).active
+    header = [cell.value for cell in worksheet[1]]
+    column = header.index('รูปภาพเครื่องยนต์') + 1
+    assert len(worksheet._images) == 2
+
+    links = [worksheet.cell(row=row, column=column).hyperlink for row in range(2, worksheet.max_row + 1)]
+    linked = [link.target for link in links if link is not None]
+    assert len(linked) == 3
+    # เรียงวันที่ใหม่ไปเก่า - 3 แถวท้าย (วันที่ 3, 2, 1) เป็นลิงก์
+    expected = [digest for _, digest in reversed(checks_with_images)][2:]
+    assert linked == [f'http://localhost/media/{digest}' for digest in expected]
@@ -0,0 +1,76 @@
+"""คลังไฟล์แนบ: ไม่รับ SVG/HTML และ /media ส่ง inline เฉพาะรูป raster/PDF พร้อม nosniff ทุกครั้ง"""
+import hashlib
+import io
+import os
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 32
+SVG = b'<?xml version="1.0"?><svg xmlns="http://www.w3.org/2000/svg"><script>alert(1)</script></svg>'
+
+@pytest.fixture
+def media_cursor(app_module):
+    conn = app_module.connect_db()
+    yield conn.cursor()
+    conn.commit()
+    conn.close()
+
+def store_raw_blob(app_module, cursor, data, mime_type):
+    """ไฟล์ที่อยู่ในคลังมาก่อนมีการตรวจชนิดไฟล์ (เช่น SVG ที่อัพโหลดไว้แล้ว)"""
+    digest = hashlib.sha256(data).hexdigest()
+    path = app_module.media_path(digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    app_module.ensure_media_blobs_table(cursor)
+    cursor.execute('INSERT OR REPLACE INTO media_blobs (sha256, size, mime_type) VALUES (?, ?, ?)',
+                   (digest, len(data), mime_type))
+    cursor.connection.commit()
+    return digest
+
+@pytest.mark.parametrize('data, filename', [
+    (SVG, 'photo.svg'),
+    (SVG, 'photo.png'),
+    (b'\xef\xbb\xbf  <html><body onload="alert(1)"></body></html>', 'receipt.jpg'),
+    (PNG, 'page.html'),
+])
+def test_store_media_rejects_markup(app_module, media_cursor, data, filename):
+    with pytest.raises(ValueError):
+        app_module.store_media(media_cursor, data, filename)
+
+def test_store_uploaded_file_skips_svg(app_module, media_cursor):
+    upload = FileStorage(stream=io.BytesIO(SVG), filename='quote.svg')
+    assert app_module.store_uploaded_file(media_cursor, upload) == (None, None)
+
+def test_raster_image_is_served_inline(app_module, media_cursor, gm_client):
+    digest = app_module.store_media(media_cursor, PNG, 'photo.png')['hash']
+    media_cursor.connection.commit()
+
+    response = gm_client.get(f'/media/{digest}')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert 'attachment' not in response.headers.get('Content-Disposition', '')
+    assert response.headers['X-Content-Type-Options'] == 'nosniff'
+
+@pytest.mark.parametrize('data, mime_type', [
+    (SVG, 'image/svg+xml'),
+    (b'<html><script>alert(1)</script></html>', 'text/html'),
+    (b'plain text note', 'text/plain'),
+])
+def test_other_types_are_downloaded_as_octet_stream(app_module, media_cursor, gm_client, data, mime_type):
+    digest = store_raw_blob(app_module, media_cursor, data, mime_type)
+
+    response = gm_client.get(f'/media/{digest}')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/octet-stream'
+    assert response.headers['Content-Disposition'].startswith('attachment')
+    assert response.headers['X-Content-Type-Options'] == 'nosniff'
+
+def test_not_modified_response_keeps_nosniff(app_module, media_cursor, gm_client):
+    digest = app_module.store_media(media_cursor, PNG + b'304', 'photo.png')['hash']
+    media_cursor.connection.commit()
+
+    response = gm_client.get(f'/media/{digest}', headers={'If-None-Match': f'"{digest}"'})
+    assert response.status_code == 304
+    assert response.headers['X-Content-Type-Options'] == 'nosniff'
@@ -0,0 +1,110 @@
+"""/metrics ผ่าน Flask test client: ข้อความต้อง parse ได้ตามรูปแบบ Prometheus และปิดไว้ถ้าไม่ใช่ loopback/ไม่มี token"""
+import math
+import re
+
+import pytest
+
+try:
+    from prometheus_client.parser import text_string_to_metric_families
+except ImportError:
+    text_string_to_metric_families = None
+
+SAMPLE_LINE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+LABEL_PAIR = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"(?:,|$)')
+
+def parse_text_format(text):
+    """ตัวแทน prometheus_client.parser (เมื่อไม่ได้ติดตั้ง): ตรวจไวยากรณ์ 0.0.4 แล้วคืน {family: (type, samples)}"""
+    families = {}
+    current = None
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            continue
+        if line.startswith('# TYPE '):
+            _, _, name, kind = line.split(' ', 3)
+            assert kind in ('counter', 'gauge', 'histogram', 'summary', 'untyped'), line
+            assert name not in families, f'TYPE ซ้ำ: {name}'
+            current = name
+            families[name] = (kind, [])
+            continue
+        match = SAMPLE_LINE.match(line)
+        assert match, f'บรรทัดไม่ถูกรูปแบบ: {line!r}'
+        name, label_text, value = match.groups()
+        assert current and name.startswith(current), f'{name} ไม่อยู่ใต้ TYPE ของตัวเอง'
+        labels = {}
+        if label_text:
+            consumed = ''.join(pair.group(0) for pair in LABEL_PAIR.finditer(label_text))
+            assert consumed == label_text, f'label ไม่ถูกรูปแบบ: {label_text!r}'
+            labels = {key: value.replace('\\"', '"').replace('\\n', '\n').replace('\\\\', '\\')
+                      for key, value in LABEL_PAIR.findall(label_text)}
+        families[current][1].append((name, labels, float(value)))
+    return families
+
+def parse_metrics(text):
+    if text_string_to_metric_families is None:
+        return parse_text_format(text)
+    return {family.name: (family.type, [(sample.name, sample.labels, sample.value) for sample in family.samples])
+            for family in text_string_to_metric_families(text)}
+
+def find_family(families, name):
+    """prometheus_client ตัด _total ออกจากชื่อ family ของ counter"""
+    return families.get(name) or families[name[:-len('_total')]]
+
+@pytest.fixture
+def metrics_settings(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'METRICS_TOKEN', None)
+    monkeypatch.setattr(app_module, 'METRICS_PUBLIC', False)
+    return app_module
+
+def test_metrics_body_parses_as_prometheus_text(metrics_settings, gm_client):
+    app = metrics_settings.app
+    for _ in range(3):
+        assert gm_client.get('/api/test-salary-data?month=1&year=2025').status_code == 200
+
+    response = app.test_client().get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    families = parse_metrics(response.get_data(as_text=True))
+
+    kind, samples = find_family(families, 'daex_http_requests_total')
+    assert kind == 'counter'
+    route_requests = sum(value for name, labels, value in samples
+                         if labels.get('route') == '/api/test-salary-data' and labels.get('status') == '200')
+    assert route_requests >= 3
+
+    kind, samples = families['daex_http_request_duration_seconds']
+    assert kind == 'histogram'
+    series = {}
+    for name, labels, value in samples:
+        key = tuple(sorted((k, v) for k, v in labels.items() if k != 'le'))
+        series.setdefault(key, {'buckets': [], 'count': None})
+        if name.endswith('_bucket'):
+            series[key]['buckets'].append((float(labels['le']), value))
+        elif name.endswith('_count'):
+            series[key]['count'] = value
+    assert series
+    for key, parts in series.items():
+        buckets = sorted(parts['buckets'])
+        counts = [count for _, count in buckets]
+        assert counts == sorted(counts), key
+        assert buckets[-1][0] == math.inf and buckets[-1][1] == parts['count'], key
+
+def test_metrics_rejects_remote_clients_without_token(metrics_settings):
+    client = metrics_settings.app.test_client()
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '10.1.2.3'}).status_code == 403
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '::1'}).status_code == 200
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '::ffff:127.0.0.1'}).status_code == 200
+
+def test_metrics_public_setting_allows_remote_clients(metrics_settings, monkeypatch):
+    monkeypatch.setattr(metrics_settings, 'METRICS_PUBLIC', True)
+    client = metrics_settings.app.test_client()
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '10.1.2.3'}).status_code == 200
+
+def test_metrics_token_is_required_even_from_loopback(metrics_settings, monkeypatch):
+    monkeypatch.setattr(metrics_settings, 'METRICS_TOKEN', 's3cret')
+    client = metrics_settings.app.test_client()
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer ทดสอบ'}).status_code == 401
+    response = client.get('/metrics', headers={'Authorization': 'Bearer s3cret'},
+                          environ_base={'REMOTE_ADDR': '10.1.2.3'})
+    assert response.status_code == 200
@@ -0,0 +1,97 @@
+"""SQL ที่ endpoint ที่ใช้บ่อยรันจริงต้องไม่ SCAN ตารางใหญ่ทั้งตาราง (ตรวจหลัง run_schema_migrations)
+
+HOT_QUERY_PLANS ตรวจเฉพาะ SQL ที่คัดลอกไว้ - ที่นี่เก็บคำสั่งที่ route รันจริงผ่าน InstrumentedCursor แล้วตรวจ plan ทีละคำสั่ง
+"""
+import re
+import sqlite3
+
+import pytest
+
+from conftest import WORK_MONTH
+
+# ตารางที่โตตามจำนวนพัสดุ/วัน - อ่านทั้งตารางไม่ได้ใน endpoint ที่ถูกเรียกบ่อย
+LARGE_TABLES = {
+    'employee_salary_records', 'unmatched_salary_records', 'salary_uploads', 'monthly_salary_data',
+    'payroll_snapshot', 'vehicle_weekly_checks', 'vehicle_fuel_usage', 'leave_requests', 'expenses',
+}
+
+HOT_ENDPOINTS = [
+    ('gm', '/api/upload-results/latest'),
+    ('gm', '/api/upload-results/1/2025'),
+    ('gm', '/api/salary/monthly-data?month=1&year=2025'),
+    ('gm', '/api/salary/monthly-data?month=1&year=2025&branch=671180'),
+    ('gm', f'/api/salary/employee-details/E0001?work_month={WORK_MONTH}&month=1&year=2025'),
+    ('gm', '/api/test-salary-data?month=1&year=2025'),
+    ('gm', '/api/vehicle/check-history?vehicle_id=V001&start_date=2025-01-01'),
+    ('gm', '/api/vehicle/fuel-statistics'),
+    ('gm', '/hr/leave-approvals'),
+    ('gm', '/finance/expense-approvals'),
+    ('employee', '/api/leave/my-requests'),
+]
+
+TABLE_ALIAS = re.compile(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+
+def large_table_names(sql):
+    """ชื่อและ alias ของตารางใหญ่ที่ SQL อ้างถึง (plan ของ SQLite แสดง alias แทนชื่อตาราง)"""
+    names = set()
+    for table, alias in TABLE_ALIAS.findall(sql):
+        if table in LARGE_TABLES:
+            names.add(table)
+            if alias and alias.upper() not in ('WHERE', 'LEFT', 'JOIN', 'INNER', 'ON', 'GROUP', 'ORDER', 'LIMIT'):
+                names.add(alias)
+    return names
+
+@pytest.fixture
+def issued_statements(app_module, monkeypatch):
+    """เก็บ StatementTiming ทุกคำสั่งที่ request รัน (แทน QueryStats ที่ start_request_timing สร้าง)"""
+    collected = []
+
+    class RecordingQueryStats(app_module.QueryStats):
+        def add_statement(self, sql, parameters, seconds):
+            timing = super().add_statement(sql, parameters, seconds)
+            collected.append(timing)
+            return timing
+
+    monkeypatch.setattr(app_module, 'QueryStats', RecordingQueryStats)
+    return collected
+
+@pytest.fixture
+def employee_client(app_module):
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 2
+        session['username'] = 'E0001'
+        session['user_role'] = 'SPT'
+        session['branch_code'] = '671180'
+    return client
+
+def test_migrations_are_applied(app_module):
+    assert app_module.run_schema_migrations() == []
+    assert app_module.explain_hot_queries() == []
+
+@pytest.mark.parametrize('who, url', HOT_ENDPOINTS)
+def test_hot_endpoint_does_not_scan_large_tables(app_module, gm_client, employee_client, issued_statements, who, url):
+    client = gm_client if who == 'gm' else employee_client
+    response = client.get(url)
+    assert response.status_code == 200, response.data[:300]
+
+    checked = [timing for timing in issued_statements
+               if timing.parameters is not None and large_table_names(timing.sql)]
+    assert checked, f'{url} ไม่ได้อ่านตารางใหญ่เลย - ตรวจ URL ของ test'
+
+    conn = app_module.connect_db()
+    try:
+        problems = []
+        for timing in checked:
+            watched = large_table_names(timing.sql)
+            try:
+                scans = app_module.full_table_scans(conn, timing.sql, timing.parameters)
+            except sqlite3.OperationalError:
+                # คำสั่งที่ route ลองแล้วล้มเหลว (เช่น query คอลัมน์ใหม่ก่อน fallback ไป schema เดิม) ไม่ได้อ่านข้อมูล
+                continue
+            for names, detail in scans:
+                if names & watched:
+                    problems.append((' '.join(timing.sql.split()), detail))
+    finally:
+        conn.close()
+    assert not problems, problems
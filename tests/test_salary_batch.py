@@ -0,0 +1,115 @@
+"""calculate_salary_batch ต้องให้ผลเท่ากับ calculate_salary_unified ทีละคนถึงหลักสตางค์ (ชุดข้อมูลสุ่มแบบกำหนด seed)"""
+import json
+import random
+
+import numpy as np
+import pytest
+
+FIELDS = ('base_salary', 'piece_rate_bonus', 'allowance', 'total_amount')
+
+def money(rng):
+    return round(rng.uniform(0, 12000), 2) if rng.random() < 0.8 else 0
+
+def random_tiers(app_module, rng):
+    """allowance_tiers หลายรูปแบบที่พบในฐานข้อมูล (key ทุกแบบใน ALLOWANCE_TIER_KEYS) รวมถึงค่าที่ไม่ถูกต้อง"""
+    steps = [{'pieces': rng.randint(0, 4000), 'amount': round(rng.uniform(0, 3000), 2)}
+             for _ in range(rng.randint(1, 5))]
+    kind = rng.randrange(10)
+    if kind == 0:
+        return None
+    if kind == 1:
+        return '[]'
+    if kind == 2:
+        return json.dumps(steps)
+    if kind == 3:
+        return json.dumps([{'min_pieces': step['pieces'], 'allowance': step['amount']} for step in steps])
+    if kind == 4:
+        # ขั้นที่แปลงเงินไม่ได้ - ทั้งสองฟังก์ชันต้องจัดการเหมือนกัน
+        steps[rng.randrange(len(steps))]['amount'] = 'ไม่ระบุ'
+        return json.dumps(steps)
+    if kind == 5:
+        return '[{"pieces": 100,'
+    if kind == 6:
+        return 'หมายเหตุ'
+    if kind == 7:
+        return steps
+    if kind == 8:
+        return json.dumps([{'min_packages': step['pieces'], 'bonus': step['amount']} for step in steps])
+    return app_module.compile_allowance_tiers(json.dumps(steps))[0]
+
+def random_rate_row(app_module, rng):
+    if rng.random() < 0.1:
+        return None
+    weight_ranges = [round(rng.uniform(0, 40), 2) for _ in range(10)]
+    return (money(rng), round(rng.uniform(0, 20), 2), money(rng), *weight_ranges, random_tiers(app_module, rng))
+
+def random_pieces(rng, rate_row):
+    tiers = rate_row[13] if rate_row else None
+    if isinstance(tiers, str) and tiers.startswith('[{"pieces": ') and tiers.endswith(']'):
+        # ทดสอบค่าที่ตรงเกณฑ์พอดีด้วย
+        thresholds = [step['pieces'] for step in json.loads(tiers)]
+        if rng.random() < 0.5:
+            return rng.choice(thresholds)
+    return rng.choice([0, rng.randint(1, 50), rng.randint(0, 6000)])
+
+@pytest.mark.parametrize('seed', range(5))
+def test_batch_matches_unified_to_the_satang(app_module, seed):
+    rng = random.Random(seed)
+    rate_pool = [random_rate_row(app_module, rng) for _ in range(25)]
+    rate_rows = [rng.choice(rate_pool) for _ in range(400)]
+    pieces = [random_pieces(rng, row) for row in rate_rows]
+    rate_types = [rng.choice(['piece_rate', 'base_salary', 'DEFAULT', None]) for _ in rate_rows]
+
+    batch = app_module.calculate_salary_batch(pieces, rate_rows, rate_types)
+
+    for i, (row, count, rate_type) in enumerate(zip(rate_rows, pieces, rate_types)):
+        expected = app_module.calculate_salary_unified({'rate_type': rate_type}, row, count)
+        for field in FIELDS:
+            assert round(float(batch[field][i]), 2) == round(expected[field], 2), (i, field, row, count, rate_type)
+
+def test_batch_without_rate_types_matches_unified(app_module):
+    rng = random.Random(99)
+    rate_rows = [random_rate_row(app_module, rng) for _ in range(200)]
+    pieces = [random_pieces(rng, row) for row in rate_rows]
+
+    batch = app_module.calculate_salary_batch(pieces, rate_rows)
+
+    for i, (row, count) in enumerate(zip(rate_rows, pieces)):
+        expected = app_module.calculate_salary_unified({}, row, count)
+        for field in FIELDS:
+            assert round(float(batch[field][i]), 2) == round(expected[field], 2), (i, field, row, count)
+
+def test_batch_rejects_pieces_split_by_weight_range(app_module):
+    with pytest.raises(ValueError):
+        app_module.calculate_salary_batch(np.ones((3, 10)), [None, None, None])
+
+@pytest.mark.parametrize('keys', [('pieces', 'amount'), ('min_pieces', 'allowance'), ('min_packages', 'bonus')])
+def test_every_tier_key_pair_gives_the_same_allowance(app_module, keys):
+    tiers = json.dumps([{keys[0]: 100, keys[1]: 250}, {keys[0]: 1000, keys[1]: 900}])
+    row = (0, 0, 50, 1.0, *([0] * 9), tiers)
+    pieces = [0, 99, 100, 999, 1000, 5000]
+
+    batch = app_module.calculate_salary_batch(pieces, [row] * len(pieces))
+
+    expected = [50, 50, 250, 250, 900, 900]
+    assert batch['allowance'].tolist() == expected
+    assert [app_module.calculate_salary_unified({}, row, count)['allowance'] for count in pieces] == expected
+    assert app_module.compile_allowance_tiers(tiers)[0].lookup(1000) == 900
+
+def test_malformed_tier_is_skipped_and_valid_tiers_are_kept(app_module):
+    tiers = json.dumps([
+        {'pieces': 100, 'amount': 250},
+        {'pieces': 500, 'amount': 'ไม่ระบุ'},
+        {'note': 'ขั้นพิเศษ'},
+        {'pieces': -1, 'amount': 50},
+        {'min_packages': 1000, 'bonus': 900},
+    ])
+    table, error = app_module.compile_allowance_tiers(tiers)
+    assert error is None
+    assert (table.thresholds, table.amounts) == ([100.0, 1000.0], [250.0, 900.0])
+
+    row = (0, 0, 50, 1.0, *([0] * 9), tiers)
+    pieces = [0, 100, 500, 1000]
+    expected = [50, 250, 250, 900]
+    assert app_module.calculate_salary_batch(pieces, [row] * len(pieces))['allowance'].tolist() == expected
+    assert [app_module.calculate_salary_unified({}, row, count)['allowance'] for count in pieces] == expected
@@ -0,0 +1,192 @@
+"""/api/test-salary-data ที่โหลดทั้งเดือนครั้งเดียว (ช่วงน้ำหนัก + RateBook) ต้องเท่ากับการ query ทีละพนักงานแบบเดิม"""
+import json
+
+import pytest
+
+from conftest import WORK_MONTH
+
+ALL_BRANCHES = 'ทุกสาขา'
+
+def per_employee_weight_ranges(cursor, emp_id, work_month):
+    """เส้นทางเดิมของ api_test_salary_data: 1 query ต่อพนักงาน"""
+    cursor.execute('''
+        SELECT
+            weight_range_index as range_index,
+            COUNT(*) as pieces,
+            SUM(total_amount) as amount
+        FROM employee_salary_records
+        WHERE employee_id = ? AND work_month = ?
+        GROUP BY range_index
+        ORDER BY range_index
+    ''', (emp_id, work_month))
+
+    weight_ranges = [{'pieces': 0, 'amount': 0, 'rate': 0}] * 10
+    for range_index, piece_count, range_amount in cursor.fetchall():
+        if 0 <= range_index < 10:
+            weight_ranges[range_index] = {
+                'pieces': piece_count,
+                'amount': range_amount or 0,
+                'rate': 0
+            }
+    return weight_ranges
+
+def month_employee_ids(cursor, work_month):
+    cursor.execute('SELECT DISTINCT employee_id FROM employee_salary_records WHERE work_month = ?', (work_month,))
+    return [row[0] for row in cursor.fetchall()]
+
+def test_load_month_weight_ranges_matches_per_employee_queries(app_module):
+    conn = app_module.connect_db()
+    try:
+        cursor = conn.cursor()
+        employee_ids = month_employee_ids(cursor, WORK_MONTH)
+        assert len(employee_ids) > 40
+
+        ranges_by_employee = app_module.load_month_weight_ranges(cursor, WORK_MONTH)
+        assert sorted(ranges_by_employee) == sorted(employee_ids)
+        for emp_id in employee_ids:
+            assert ranges_by_employee[emp_id] == per_employee_weight_ranges(cursor, emp_id, WORK_MONTH), emp_id
+    finally:
+        conn.close()
+
+def per_employee_rate(cursor, position, rate_type, zone, branch_code):
+    """เรทของพนักงาน 1 คนด้วย query ตามลำดับเดียวกับ RateBook.resolve (สาขา -> ทุกสาขา -> โซนทุกสาขา)"""
+    for rate_zone, rate_branch in ((zone, branch_code), (zone, ALL_BRANCHES), (ALL_BRANCHES, branch_code),
+                                   (ALL_BRANCHES, ALL_BRANCHES)):
+        cursor.execute('''
+            SELECT piece_rate_bonus, allowance, allowance_tiers FROM piece_rates
+            WHERE position = ? AND salary_type = ? AND zone = ? AND branch_code = ?
+            ORDER BY id LIMIT 1
+        ''', (position, rate_type, rate_zone, rate_branch))
+        row = cursor.fetchone()
+        if row:
+            return row
+    return None
+
+def tier_bonus(raw_tiers, pieces):
+    """เงินสมทบตามขั้น: วนทุกขั้น ขั้นหลังที่ถึงเกณฑ์ชนะ (ข้ามขั้นที่ไม่ถูกต้อง)"""
+    bonus = 0
+    for tier in json.loads(raw_tiers or '[]'):
+        for threshold_key, amount_key in (('pieces', 'amount'), ('min_pieces', 'allowance'), ('min_packages', 'bonus')):
+            if threshold_key in tier and amount_key in tier:
+                try:
+                    threshold, amount = float(tier[threshold_key]), float(tier[amount_key])
+                except ValueError:
+                    break
+                if pieces >= threshold:
+                    bonus = amount
+                break
+    return bonus
+
+def per_employee_payload(cursor, month, year):
+    """เส้นทางอ้างอิงของ api_test_salary_data: query ทีละพนักงานสำหรับข้อมูลพนักงาน ยอดรวม ช่วงน้ำหนัก และเรท"""
+    work_month = f'{year}-{month.zfill(2)}'
+    employees = []
+    with_rates = 0
+    for emp_id in sorted(month_employee_ids(cursor, work_month)):
+        cursor.execute('''
+            SELECT SUM(total_pieces), SUM(total_amount) FROM employee_salary_records
+            WHERE employee_id = ? AND work_month = ?
+        ''', (emp_id, work_month))
+        pieces, amount = cursor.fetchone()
+        cursor.execute('''
+            SELECT name, position, branch_code, employment_type, base_salary, rate_type, status, zone
+            FROM employees WHERE employee_id = ?
+        ''', (emp_id,))
+        name, position, branch_code, emp_type, base_salary, rate_type, status, zone = cursor.fetchone() or (None,) * 8
+
+        rate_status = 'assigned' if rate_type and rate_type.strip() else 'no_rate'
+        with_rates += rate_status == 'assigned'
+        if not name or status != 'active':
+            rate_status = 'unmatched'
+
+        piece_rate_bonus = allowance = allowance_bonus = 0
+        rate = per_employee_rate(cursor, position, rate_type, zone, branch_code) if position else None
+        if rate:
+            piece_rate_bonus, allowance = rate[0] or 0, rate[1] or 0
+            allowance_bonus = tier_bonus(rate[2], pieces) if pieces else 0
+        piece_work_amount = (pieces * piece_rate_bonus if pieces and piece_rate_bonus else 0) + (amount or 0)
+
+        employees.append({
+            'employee_id': emp_id,
+            'name': name or 'ไม่ระบุชื่อ',
+            'position': position or 'ไม่ระบุตำแหน่ง',
+            'branch_code': branch_code or 'ไม่ระบุสาขา',
+            'piece_rate': emp_type or 'ไม่ระบุ',
+            'base_salary': base_salary or 0,
+            'piece_rate_bonus': piece_rate_bonus,
+            'allowance': allowance,
+            'allowance_bonus': allowance_bonus,
+            'packages': pieces or 0,
+            'total_amount': (base_salary or 0) + piece_rate_bonus + allowance + allowance_bonus + piece_work_amount,
+            'weight_ranges': per_employee_weight_ranges(cursor, emp_id, work_month),
+            'rate_status': rate_status
+        })
+
+    summary = {
+        'total_employees': len(employees),
+        'total_packages': sum(employee['packages'] for employee in employees),
+        'total_amount': sum(employee['total_amount'] for employee in employees),
+        'month': month,
+        'year': year,
+        'employees_with_rates': with_rates,
+        'employees_without_rates': len(employees) - with_rates,
+        'unmatched_packages': sum(employee['packages'] for employee in employees if employee['rate_status'] == 'unmatched')
+    }
+    return {'employees': employees, 'summary': summary}
+def test_month_without_records_returns_no_employees(app_module):
+    payload = app_module.app.test_client().get('/api/test-salary-data?month=3&year=2025').get_json()
+    assert payload['employees'] == []
+    assert payload['summary']['total_packages'] == 0
+
+def rounded(value):
+    """ปัดทศนิยมก่อนเทียบ - ผลรวมทั้งเดือนบวกคนละลำดับกับเส้นทางอ้างอิง"""
+    if isinstance(value, dict):
+        return {key: rounded(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [rounded(item) for item in value]
+    if isinstance(value, float):
+        return round(value, 6)
+    return value
+
+@pytest.fixture
+def low_allowance_tiers(app_module):
+    """ขั้นเงินสมทบที่พนักงานในข้อมูลทดสอบถึงเกณฑ์ได้ (ทุก key ที่รองรับ) ให้เรท piece_rate ของ Z1 ชั่วคราว"""
+    tiers = json.dumps([{'min_pieces': 40, 'allowance': 120}, {'pieces': 60, 'amount': 300},
+                        {'min_packages': 80, 'bonus': 450}, {'pieces': 'ไม่ระบุ', 'amount': 999}])
+    conn = app_module.connect_db()
+    cursor = conn.cursor()
+    rate_id, original = cursor.execute(
+        "SELECT id, allowance_tiers FROM piece_rates WHERE zone = 'Z1' AND salary_type = 'piece_rate'"
+    ).fetchone()
+
+    def set_tiers(raw_tiers):
+        table = app_module.compile_allowance_tiers(raw_tiers)[0]
+        cursor.execute('UPDATE piece_rates SET allowance_tiers = ?, allowance_tier_table = ? WHERE id = ?',
+                       (raw_tiers, table.pack(), rate_id))
+        app_module.bump_data_version(cursor, 'piece_rates')
+        conn.commit()
+
+    set_tiers(tiers)
+    yield tiers
+    set_tiers(original)
+    conn.close()
+
+def test_test_salary_data_matches_per_employee_reference(app_module, low_allowance_tiers):
+    response = app_module.app.test_client().get('/api/test-salary-data?month=1&year=2025')
+    payload = response.get_json()
+    assert 'error' not in payload, payload
+
+    conn = app_module.connect_db()
+    try:
+        expected = per_employee_payload(conn.cursor(), '1', '2025')
+    finally:
+        conn.close()
+
+    returned = sorted(payload['employees'], key=lambda employee: employee['employee_id'])
+    assert len(returned) == len(expected['employees']) > 40
+    for employee, reference in zip(returned, expected['employees']):
+        assert rounded(employee) == rounded(reference), reference['employee_id']
+    assert rounded(payload['summary']) == rounded(expected['summary'])
+    # ข้อมูลทดสอบต้องครอบคลุมทั้งกรณีถึงขั้นเงินสมทบ ไม่มีเรท และไม่อยู่ในระบบ
+    assert {employee['allowance_bonus'] for employee in returned} >= {0, 300, 450}
+    assert {employee['rate_status'] for employee in returned} == {'assigned', 'no_rate', 'unmatched'}
@@ -0,0 +1,98 @@
+"""ingest_salary_chunks: จับคู่เรทเหมือนหน้าสรุปเงินเดือน และพนักงานที่หาเรทไม่ได้ถูกรายงานเป็น unmatched"""
+import pandas as pd
+import pytest
+
+FOUND_COLUMNS = {
+    'awb': 'AWB', 'branch': 'Branch', 'time': 'Time',
+    'employee_name': 'Name', 'employee_id': 'EmployeeID', 'weight': 'Weight',
+}
+
+def parcels(employee_ids, prefix):
+    return pd.DataFrame({
+        'AWB': [f'{prefix}{n:05d}' for n in range(len(employee_ids))],
+        'Branch': ['671181'] * len(employee_ids),
+        'Time': ['2025-05-10 09:00:00'] * len(employee_ids),
+        'Name': ['ทดสอบ'] * len(employee_ids),
+        'EmployeeID': employee_ids,
+        'Weight': [0.4] * len(employee_ids),
+    })
+
+@pytest.fixture
+def unpriced_employee(app_module):
+    """พนักงานที่มีในระบบแต่ไม่มีเรทของตำแหน่งนี้เลย"""
+    conn = app_module.connect_db()
+    conn.execute('''
+        INSERT OR IGNORE INTO employees (employee_id, name, position, branch_code, status, zone, rate_type)
+        VALUES ('T0001', 'ไม่มีเรท', 'DRV', '671181', 'active', 'Z2', NULL)
+    ''')
+    conn.commit()
+    conn.close()
+    return 'T0001'
+
+def test_null_rate_type_employee_uses_default_rate(app_module):
+    conn = app_module.connect_db()
+    try:
+        rate_type, position, zone = conn.execute(
+            "SELECT rate_type, position, zone FROM employees WHERE employee_id = 'E0004'"
+        ).fetchone()
+    finally:
+        conn.close()
+    assert rate_type is None
+
+    result = app_module.ingest_salary_chunks([parcels(['E0004'] * 4, 'N')], 'null_rate.csv', FOUND_COLUMNS, 5, 2025, 'gm')
+    assert result['success_count'] == 4
+    assert result['unmatched_count'] == 0
+    assert result['error_count'] == 0
+
+    conn = app_module.connect_db()
+    try:
+        package_count, = conn.execute(
+            "SELECT package_count FROM monthly_salary_data WHERE employee_id = 'E0004' AND month = 5 AND year = 2025"
+        ).fetchone()
+        snapshot = conn.execute(
+            "SELECT has_rate, total_pieces FROM payroll_snapshot WHERE employee_id = 'E0004' AND month = 5 AND year = 2025"
+        ).fetchone()
+    finally:
+        conn.close()
+    assert package_count == 4
+    # หน้าสรุปเงินเดือน (compute_payroll_rows) ก็จับคู่เรทเดียวกันได้
+    assert snapshot == (1, 4)
+
+def test_employee_without_rate_is_reported_unmatched(app_module, unpriced_employee):
+    result = app_module.ingest_salary_chunks(
+        [parcels([unpriced_employee] * 3 + ['E0006'] * 2, 'U')], 'no_rate.csv', FOUND_COLUMNS, 6, 2025, 'gm'
+    )
+    assert result['success_count'] == 2
+    assert result['unmatched_count'] == 3
+    assert result['error_count'] == 3
+
+    conn = app_module.connect_db()
+    try:
+        unmatched = conn.execute(
+            'SELECT employee_id, COUNT(*) FROM unmatched_salary_records WHERE upload_batch_id = ? GROUP BY employee_id',
+            (result['batch_id'],)
+        ).fetchall()
+    finally:
+        conn.close()
+    assert unmatched == [(unpriced_employee, 3)]
+
+def snapshot_months(app_module, employee_id):
+    conn = app_module.connect_db()
+    try:
+        return conn.execute(
+            'SELECT month, year FROM payroll_snapshot WHERE employee_id = ? ORDER BY year, month', (employee_id,)
+        ).fetchall()
+    finally:
+        conn.close()
+
+def test_delete_upload_removes_its_month_from_the_snapshot(app_module, gm_client):
+    result = app_module.ingest_salary_chunks([parcels(['E0009'] * 3, 'D')], 'delete_me.csv', FOUND_COLUMNS, 7, 2025, 'gm')
+    assert result['success_count'] == 3
+    assert snapshot_months(app_module, 'E0009') == [(1, 2025), (7, 2025)]
+
+    response = gm_client.delete(f"/api/delete-upload/{result['upload_id']}")
+    assert response.get_json()['success'] is True
+    assert response.get_json()['details']['deleted_monthly_records'] == 1
+
+    # เดือนอื่นของพนักงานคนเดียวกันยังอยู่ครบ
+    assert snapshot_months(app_module, 'E0009') == [(1, 2025)]
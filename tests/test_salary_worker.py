@@ -0,0 +1,72 @@
+"""process ประมวลผลคิวอัพโหลด: เริ่มได้ครั้งละ 1 ตัว และลบทะเบียนตัวเองเมื่อคิวว่างเท่านั้น"""
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+class FakeProcess:
+    pid = 999999999
+
+    def __init__(self, args, env):
+        self.args = args
+        self.env = env
+
+    def wait(self):
+        return 0
+
+@pytest.fixture
+def jobs(app_module):
+    conn = app_module.get_salary_jobs_connection()
+    conn.execute('DELETE FROM salary_upload_worker')
+    conn.commit()
+    yield conn
+    conn.execute('DELETE FROM salary_upload_worker')
+    conn.execute("DELETE FROM salary_upload_jobs WHERE filename = 'worker-test.csv'")
+    conn.commit()
+    conn.close()
+
+@pytest.fixture
+def popen_calls(monkeypatch):
+    import subprocess
+    calls = []
+    def fake_popen(args, env):
+        calls.append(FakeProcess(args, env))
+        return calls[-1]
+    monkeypatch.setattr(subprocess, 'Popen', fake_popen)
+    return calls
+
+def register(jobs, pid, heartbeat):
+    jobs.execute('INSERT OR REPLACE INTO salary_upload_worker (id, pid, heartbeat_at) VALUES (1, ?, ?)',
+                 (pid, heartbeat.isoformat(sep=' ', timespec='seconds')))
+    jobs.commit()
+
+def test_live_worker_is_not_started_twice(app_module, jobs, popen_calls):
+    register(jobs, os.getpid(), datetime.now())
+
+    assert app_module.start_salary_upload_worker() is None
+    assert popen_calls == []
+
+def test_stale_registration_is_replaced(app_module, jobs, popen_calls):
+    register(jobs, os.getpid(), datetime.now() - timedelta(seconds=app_module.SALARY_JOB_STALE_SECONDS + 5))
+
+    process = app_module.start_salary_upload_worker()
+    assert popen_calls == [process]
+    assert process.env['DAEX_SALARY_WORKER'] == '1'
+    assert jobs.execute('SELECT pid FROM salary_upload_worker').fetchone()['pid'] == FakeProcess.pid
+    # ลงทะเบียนแล้ว - request ถัดไปไม่เริ่มซ้ำ (pid ปลอมไม่มีอยู่จริง จึงตรวจด้วยทะเบียนของ process นี้แทน)
+    register(jobs, os.getpid(), datetime.now())
+    assert app_module.start_salary_upload_worker() is None
+    assert len(popen_calls) == 1
+
+def test_worker_keeps_registration_while_jobs_are_queued(app_module, jobs):
+    register(jobs, os.getpid(), datetime.now())
+    jobs.execute("INSERT INTO salary_upload_jobs (filename, file_path) VALUES ('worker-test.csv', 'worker-test.csv')")
+    jobs.commit()
+
+    assert app_module.release_salary_upload_worker() is False
+    assert jobs.execute('SELECT COUNT(*) FROM salary_upload_worker').fetchone()[0] == 1
+
+    jobs.execute("DELETE FROM salary_upload_jobs WHERE filename = 'worker-test.csv'")
+    jobs.commit()
+    assert app_module.release_salary_upload_worker() is True
+    assert jobs.execute('SELECT COUNT(*) FROM salary_upload_worker').fetchone()[0] == 0